@@ -0,0 +1,147 @@
+"""
+attach_head.py の bulk_ops（NumPy/foreach の経路）と従来の bpy.ops の経路で、書き出したGLBが同じになるかを比べる。
+
+同じ頭部・テンプレートで run_job を bulk_ops=true / false の2回実行し、それぞれのGLBを読み込み直して
+メッシュの頂点座標・法線・シェイプキー・頂点ウェイト、オブジェクトの親と行列(ローカル/ワールド)、ボーンのレスト行列を
+許容誤差内で比べる。工程ごとの所要時間(timing)も並べて出す。差があれば終了コード1。
+
+Blenderの中で実行する（ATTACH_HEAD_BULK_OPS を変えた時の確認用）:
+  blender -b --python bench/bulk_ops_compare.py -- --template worker/blender/template_blend.fbx --head head.glb
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import bpy
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "worker", "blender"))
+import attach_head  # noqa: E402
+
+# ---- 書き出し
+
+def run(args, bulk_ops: bool, out: str) -> dict:
+    timings = {}
+
+    def on_event(event: dict):
+        if event.get("event") == "timing":
+            timings[event["stage"]] = timings.get(event["stage"], 0.0) + event["seconds"]
+
+    attach_head.run_job({
+        "targets": [[args.template, out]],
+        "head": args.head,
+        "head_bone": args.head_bone,
+        "calib": args.calib,
+        "delete_template_head": args.delete_template_head,
+        "decimate_ratio": args.decimate_ratio,
+        "bulk_ops": bulk_ops,
+    }, on_event=on_event)
+    return timings
+
+# ---- 読み込み直して比べる
+
+def read_co(elements) -> np.ndarray:
+    co = np.empty(len(elements) * 3, dtype=np.float32)
+    elements.foreach_get("co", co)
+    return co.reshape(-1, 3)
+
+def read_weights(obj) -> dict:
+    # 頂点グループ名 → 頂点ごとのウェイト（属さない頂点は0）
+    names = {vg.index: vg.name for vg in obj.vertex_groups}
+    weights = {name: np.zeros(len(obj.data.vertices)) for name in names.values()}
+    for v in obj.data.vertices:
+        for g in v.groups:
+            weights[names[g.group]][v.index] = g.weight
+    return weights
+
+def snapshot(path: str) -> dict:
+    # GLBを空のシーンに読み込み、比べる値をオブジェクト名ごとに取り出す
+    attach_head.reset_scene()
+    bpy.ops.import_scene.gltf(filepath=path)
+    objects = {}
+    for obj in bpy.data.objects:
+        item = {
+            "type": obj.type,
+            "parent": obj.parent.name if obj.parent else None,
+            "parent_bone": obj.parent_bone or None,
+            "matrix_local": np.array(obj.matrix_local),
+            "matrix_world": np.array(obj.matrix_world),
+        }
+        if obj.type == "MESH":
+            item["positions"] = read_co(obj.data.vertices)
+            item["normals"] = attach_head.read_corner_normals(obj.data)
+            key_blocks = obj.data.shape_keys.key_blocks if obj.data.shape_keys else []
+            item["shape_keys"] = {kb.name: read_co(kb.data) for kb in key_blocks}
+            item["weights"] = read_weights(obj)
+        elif obj.type == "ARMATURE":
+            item["bones"] = {b.name: np.array(b.matrix_local) for b in obj.data.bones}
+        objects[obj.name] = item
+    return objects
+
+def compare_arrays(diffs: list, where: str, a: np.ndarray, b: np.ndarray, tolerance: float):
+    if a.shape != b.shape:
+        diffs.append(f"{where}: shape {a.shape} != {b.shape}")
+        return
+    if a.size and (err := float(np.abs(a - b).max())) > tolerance:
+        diffs.append(f"{where}: max abs diff {err:.3g}")
+
+def compare_dicts(diffs: list, where: str, a: dict, b: dict, tolerance: float):
+    if a.keys() != b.keys():
+        diffs.append(f"{where}: keys differ {sorted(a.keys() ^ b.keys())}")
+    for name in a.keys() & b.keys():
+        compare_arrays(diffs, f"{where}[{name}]", a[name], b[name], tolerance)
+
+def compare(bulk: dict, ops: dict, tolerance: float) -> list[str]:
+    diffs = []
+    if bulk.keys() != ops.keys():
+        diffs.append(f"objects differ: {sorted(bulk.keys() ^ ops.keys())}")
+    for name in sorted(bulk.keys() & ops.keys()):
+        a, b = bulk[name], ops[name]
+        for field in ("type", "parent", "parent_bone"):
+            if a[field] != b[field]:
+                diffs.append(f"{name}.{field}: {a[field]!r} != {b[field]!r}")
+        for field in ("matrix_local", "matrix_world", "positions", "normals"):
+            if field in a and field in b:
+                compare_arrays(diffs, f"{name}.{field}", a[field], b[field], tolerance)
+        for field in ("shape_keys", "weights", "bones"):
+            if field in a and field in b:
+                compare_dicts(diffs, f"{name}.{field}", a[field], b[field], tolerance)
+    return diffs
+
+def main():
+    ap = argparse.ArgumentParser(prog="bulk_ops_compare.py")
+    ap.add_argument("--template", required=True)
+    ap.add_argument("--head", required=True)
+    ap.add_argument("--head_bone", default="mixamorig7:Head")
+    ap.add_argument("--calib", default=None)
+    ap.add_argument("--delete_template_head", default="false")
+    ap.add_argument("--decimate_ratio", type=float, default=1.0)
+    ap.add_argument("--tolerance", type=float, default=1e-5, help="座標・行列・ウェイトの許容誤差（絶対値）")
+    ap.add_argument("--keep", default=None, help="書き出したGLBを残すディレクトリ")
+    args = attach_head.parse_after_double_dash(ap)
+
+    out_dir = args.keep or tempfile.mkdtemp(prefix="bulk_ops_compare_")
+    os.makedirs(out_dir, exist_ok=True)
+    outs = {mode: os.path.join(out_dir, f"avatar_{mode}.glb") for mode in ("bulk", "ops")}
+    timings = {
+        "bulk": run(args, True, outs["bulk"]),
+        "ops": run(args, False, outs["ops"]),
+    }
+    diffs = compare(snapshot(outs["bulk"]), snapshot(outs["ops"]), args.tolerance)
+
+    print(json.dumps({
+        "tolerance": args.tolerance,
+        "outputs": outs,
+        "timings": {
+            stage: {mode: round(timings[mode].get(stage, 0.0), 4) for mode in timings}
+            for stage in timings["bulk"].keys() | timings["ops"].keys()
+        },
+        "diffs": diffs,
+    }, indent=2))
+    print("MATCH" if not diffs else f"MISMATCH ({len(diffs)} differences)")
+    sys.exit(1 if diffs else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+"""
+hub APIの負荷試験。
+
+- seed: Redis に scan を大量に（既定100万件）登録し、成果物の実体を S3 に置く。
+  scan_id は loadtest-00000000 の連番で、状態・作成時刻は番号から決まる（run側で問い合わせずに選べる）。
+  done の scan はそれぞれ自分の out/<scan_id>/ のキーとETagを持つ（hubの署名付きURLのキャッシュが共有されないように）。
+  成果物の実体をアップロードするのは先頭 --objects 件のうち done の scan だけで、download 系の操作はその中から選ぶ。
+  それ以外は存在しないキーと seed-<番号> のETagで、署名付きURLを作るだけの asset でだけ使う。
+  キュー(queue:lane:*)には入れないので worker は拾わない
+- run: 一覧・ステータス・一括ステータス・asset・download を混ぜたトラフィックを --clients 並列で流し、
+  エンドポイントごとのレイテンシ(p50/p95/p99)・ステータスコード・エラー率を集計する。
+  先にエンドポイントごとに --calls 回ずつ順番に呼び、GET /metrics の差分から1リクエストあたりの
+  Redisコマンド数・boto3呼び出し数を出す（hubが1プロセスで動いている前提）
+- cleanup: seed で作ったものを消す
+
+  python bench/hub_load.py seed --scans 1000000
+  python bench/hub_load.py run --profile mixed --clients 200 --duration 60
+  python bench/hub_load.py run --in-process   # hub/app.py をこのプロセスに読み込んで ASGI で直接呼ぶ
+  python bench/hub_load.py cleanup
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+from pipeline_bench import git_commit, percentiles
+
+ID_PREFIX = "loadtest-"
+# created_at = BASE_TIME + 番号（一覧のカーソルを番号から作れるようにする）
+BASE_TIME = 1_600_000_000.0
+# 実運用に近い状態の内訳（合計1.0）
+STATUS_MIX = (("done", 0.90), ("failed", 0.04), ("queued", 0.04), ("processing", 0.02))
+SCAN_STATUSES = ("queued", "processing", "done", "failed")
+SEED_BATCH = 10000
+
+# プロファイル: 操作名 -> 重み
+PROFILES = {
+    "mixed": {
+        "list": 10, "list_status": 5, "status": 35, "batch_status": 10,
+        "asset": 25, "download": 10, "download_revalidate": 5,
+    },
+    # ロビー画面: 一括ステータスと一覧が中心
+    "lobby": {"batch_status": 50, "status": 30, "list": 15, "list_status": 5},
+    # ゲームクライアントの取得: 署名付きURLとダウンロード（Range・再検証を含む）
+    "download": {"asset": 30, "download": 40, "download_range": 15, "download_revalidate": 15},
+}
+
+def scan_id_of(i: int) -> str:
+    return f"{ID_PREFIX}{i:08d}"
+
+def status_of(i: int) -> str:
+    # 番号から決まる疑似乱数で状態を振る（seedとrunで同じ結果になる）
+    x = (i * 2654435761 % 2**32) / 2**32
+    for status, share in STATUS_MIX:
+        if x < share:
+            return status
+        x -= share
+    return STATUS_MIX[0][0]
+
+def object_key(i: int, blend: bool = False) -> str:
+    return f"out/{scan_id_of(i)}/avatar{'_blend' if blend else ''}.glb"
+
+# ---- seed / cleanup（Redis・S3を直接操作する）
+
+def connect(args):
+    import boto3
+    import redis
+
+    r = redis.Redis.from_url(args.redis, decode_responses=True)
+    kwargs: dict = {}
+    if args.s3_endpoint:
+        kwargs["endpoint_url"] = args.s3_endpoint
+        if os.environ.get("S3_ACCESS_KEY") and os.environ.get("S3_SECRET_KEY"):
+            kwargs["aws_access_key_id"] = os.environ["S3_ACCESS_KEY"]
+            kwargs["aws_secret_access_key"] = os.environ["S3_SECRET_KEY"]
+    else:
+        kwargs["region_name"] = os.environ.get("AWS_REGION")
+    return r, boto3.client("s3", **kwargs)
+
+def scan_fields(i: int, objects: dict[int, dict]) -> dict:
+    created_at = BASE_TIME + i
+    status = status_of(i)
+    d = {
+        "status": status,
+        "created_at": created_at,
+        "updated_at": created_at + 90,
+        "attempts": 1,
+        "profile": "standard",
+        "queue_lane": "interactive",
+        "queue_score": created_at,
+        "glb_bytes": 20_000_000,
+        "glb_triangles": 200_000,
+    }
+    if status == "processing":
+        d["started_at"] = created_at + 5
+    elif status == "failed":
+        d["error"] = "seeded failure"
+    elif status == "done":
+        obj = objects.get(i, {})
+        for prefix, blend in (("asset", False), ("asset_blend", True)):
+            # 実体の無いscanも、キーとETagはscanごとに別にする
+            o = obj.get(prefix) or {"key": object_key(i, blend), "size": 20_000_000, "etag": f'"seed-{i}"'}
+            d.update({
+                f"{prefix}_key": o["key"],
+                f"{prefix}_size": o["size"],
+                f"{prefix}_etag": o["etag"],
+                f"{prefix}_content_type": "model/gltf-binary",
+                f"{prefix}_filename": f"avatar{'_blend' if blend else ''}_{scan_id_of(i)}.glb",
+            })
+        d["timing_total"] = 60.0
+    return d
+
+def seed(args):
+    r, s3 = connect(args)
+    objects = {}
+    for i in range(min(args.objects, args.scans)):
+        if status_of(i) != "done":
+            continue
+        obj = {}
+        for prefix, blend in (("asset", False), ("asset_blend", True)):
+            key = object_key(i, blend)
+            body = os.urandom(args.asset_bytes)
+            resp = s3.put_object(Bucket=args.bucket, Key=key, Body=body, ContentType="model/gltf-binary")
+            obj[prefix] = {"key": key, "size": len(body), "etag": resp["ETag"]}
+        objects[i] = obj
+    print("uploaded objects", len(objects) * 2)
+
+    t0 = time.time()
+    for start in range(0, args.scans, SEED_BATCH):
+        ids = range(start, min(start + SEED_BATCH, args.scans))
+        by_status: dict[str, dict] = {}
+        with r.pipeline(transaction=False) as pipe:
+            for i in ids:
+                pipe.hset(f"scan:{scan_id_of(i)}", mapping=scan_fields(i, objects))
+                by_status.setdefault(status_of(i), {})[scan_id_of(i)] = BASE_TIME + i
+            pipe.zadd("scans:index", {scan_id_of(i): BASE_TIME + i for i in ids})
+            for status, mapping in by_status.items():
+                pipe.zadd(f"scans:status:{status}", mapping)
+            pipe.execute()
+        print(f"seeded {ids.stop}/{args.scans} ({time.time() - t0:.0f}s)", flush=True)
+
+def cleanup(args):
+    r, s3 = connect(args)
+    removed = 0
+    batch = []
+
+    def flush():
+        with r.pipeline(transaction=False) as pipe:
+            pipe.delete(*(f"scan:{scan_id}" for scan_id in batch))
+            pipe.zrem("scans:index", *batch)
+            for status in SCAN_STATUSES:
+                pipe.zrem(f"scans:status:{status}", *batch)
+            pipe.execute()
+        batch.clear()
+
+    for key in r.scan_iter(match=f"scan:{ID_PREFIX}*", count=SEED_BATCH):
+        batch.append(key[len("scan:"):])
+        removed += 1
+        if len(batch) >= SEED_BATCH:
+            flush()
+    if batch:
+        flush()
+    print("removed scans", removed)
+
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=args.bucket, Prefix=f"out/{ID_PREFIX}"):
+        keys = [{"Key": o["Key"]} for o in page.get("Contents", [])]
+        if keys:
+            s3.delete_objects(Bucket=args.bucket, Delete={"Objects": keys})
+    print("removed objects")
+
+# ---- run
+
+# 操作名 -> 集計に使うルート名
+ROUTES = {
+    "list": "GET /scans",
+    "list_status": "GET /scans?status",
+    "status": "GET /scan/{id}/status",
+    "batch_status": "POST /scans/status",
+    "asset": "GET /scan/{id}/asset",
+    "download": "GET /scan/{id}/download",
+    "download_range": "GET /scan/{id}/download (range)",
+    "download_revalidate": "GET /scan/{id}/download (revalidate)",
+}
+
+class Ops:
+    """負荷の1操作 = 1リクエスト。メソッド名は ROUTES のキー"""
+
+    def __init__(self, client: httpx.AsyncClient, scans: int, objects: int, rng: random.Random):
+        self.client = client
+        self.scans = scans
+        # 成果物の実体があるのは先頭 objects 件のうち done の scan
+        self.objects = max(min(objects, scans), 1)
+        self.rng = rng
+        # 再検証(If-None-Match)用に、ダウンロード済みのETagを覚えておく
+        self.etags: dict[str, str] = {}
+
+    def any_id(self) -> str:
+        return scan_id_of(self.rng.randrange(self.scans))
+
+    def done_id(self, with_object: bool = False) -> str:
+        limit = self.objects if with_object else self.scans
+        while True:
+            i = self.rng.randrange(limit)
+            if status_of(i) == "done":
+                return scan_id_of(i)
+
+    async def list(self):
+        # 先頭ページだけでなく、深い位置からのページングも混ぜる
+        params = {"limit": 100}
+        if self.rng.random() < 0.5:
+            params["cursor"] = BASE_TIME + self.rng.randrange(self.scans)
+        return await self.client.get("/scans", params=params)
+
+    async def list_status(self):
+        status = self.rng.choice(SCAN_STATUSES)
+        params = {"limit": 100, "status": status, "cursor": BASE_TIME + self.rng.randrange(self.scans)}
+        return await self.client.get("/scans", params=params)
+
+    async def status(self):
+        return await self.client.get(f"/scan/{self.any_id()}/status")
+
+    async def batch_status(self):
+        ids = [self.any_id() for _ in range(100)]
+        return await self.client.post("/scans/status", json={"scan_ids": ids})
+
+    async def asset(self):
+        return await self.client.get(f"/scan/{self.done_id()}/asset")
+
+    async def download(self, headers: dict | None = None, scan_id: str | None = None):
+        scan_id = scan_id or self.done_id(with_object=True)
+        async with self.client.stream("GET", f"/scan/{scan_id}/download", headers=headers or {}) as resp:
+            async for _ in resp.aiter_bytes():
+                pass
+        if resp.headers.get("etag"):
+            self.etags[scan_id] = resp.headers["etag"]
+        return resp
+
+    async def download_range(self):
+        return await self.download({"Range": "bytes=0-65535"})
+
+    async def download_revalidate(self):
+        if not self.etags:
+            return await self.download()
+        scan_id = self.rng.choice(list(self.etags))
+        return await self.download({"If-None-Match": self.etags[scan_id]}, scan_id=scan_id)
+
+class Results:
+    def __init__(self):
+        self.latency: dict[str, list[float]] = {}
+        self.statuses: dict[str, Counter] = {}
+        self.errors: dict[str, Counter] = {}
+
+    def add(self, route: str, seconds: float, status: int | None = None, error: str | None = None):
+        self.latency.setdefault(route, []).append(seconds)
+        self.statuses.setdefault(route, Counter())[str(status or "error")] += 1
+        if error or (status and status >= 500):
+            self.errors.setdefault(route, Counter())[error or str(status)] += 1
+
+    def report(self, wall: float) -> dict:
+        out = {}
+        for route, values in sorted(self.latency.items()):
+            errors = sum(self.errors.get(route, Counter()).values())
+            out[route] = {
+                "requests": len(values),
+                "rps": round(len(values) / wall, 2) if wall else None,
+                "latency": percentiles(values),
+                "statuses": dict(self.statuses[route]),
+                "errors": dict(self.errors.get(route, Counter())),
+                "error_rate": round(errors / len(values), 5),
+            }
+        return out
+
+async def timed(results: Results, ops: Ops, name: str):
+    t0 = time.perf_counter()
+    try:
+        resp = await getattr(ops, name)()
+    except httpx.HTTPError as e:
+        results.add(ROUTES[name], time.perf_counter() - t0, error=type(e).__name__)
+    else:
+        results.add(ROUTES[name], time.perf_counter() - t0, status=resp.status_code)
+
+# /metrics の hub_redis_command_duration_seconds_count{command="..."} と
+# hub_s3_call_duration_seconds_count{operation="..."} を呼び出し回数として読む
+METRIC_COUNT_RE = re.compile(r'^hub_(redis_command|s3_call)_duration_seconds_count\{(?:command|operation)="([^"]+)"\} (\S+)$')
+
+async def call_counts(client: httpx.AsyncClient) -> dict[str, float]:
+    resp = await client.get("/metrics")
+    resp.raise_for_status()
+    counts = {}
+    for line in resp.text.splitlines():
+        m = METRIC_COUNT_RE.match(line)
+        if m:
+            kind = "redis" if m.group(1) == "redis_command" else "s3"
+            counts[f"{kind}:{m.group(2)}"] = float(m.group(3))
+    return counts
+
+def count_diff(before: dict, after: dict, requests: int) -> dict:
+    diff = {k: after[k] - before.get(k, 0) for k in after}
+    # 後の /metrics 自体がゲージ更新のパイプラインを1回実行している
+    diff["redis:pipeline"] = diff.get("redis:pipeline", 0) - 1
+    per_request = {k: round(v / requests, 3) for k, v in sorted(diff.items()) if v > 0}
+    return {
+        "redis": sum(v for k, v in per_request.items() if k.startswith("redis:")),
+        "s3": sum(v for k, v in per_request.items() if k.startswith("s3:")),
+        "by_call": per_request,
+    }
+
+async def calibrate(client: httpx.AsyncClient, ops: Ops, names: list[str], calls: int) -> dict:
+    # 他のリクエストと混ざらないよう、エンドポイントごとに順番に呼んで差分を取る
+    out = {}
+    for name in names:
+        results = Results()
+        before = await call_counts(client)
+        for _ in range(calls):
+            await timed(results, ops, name)
+        after = await call_counts(client)
+        out[name] = count_diff(before, after, calls)
+    return out
+
+def make_client(args) -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    timeout = httpx.Timeout(args.timeout)
+    if not args.in_process:
+        return httpx.AsyncClient(base_url=args.hub, limits=limits, timeout=timeout)
+    # hub/app.py をこのプロセスに読み込む（REDIS_URL / S3_* は hub と同じ環境変数で渡す）
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hub"))
+    from app import app
+
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://hub", limits=limits, timeout=timeout)
+
+async def run(args) -> dict:
+    weights = PROFILES[args.profile]
+    names = list(weights)
+    rng = random.Random(args.seed)
+    async with make_client(args) as client:
+        ops = Ops(client, args.scans, args.objects, rng)
+        per_request = await calibrate(client, ops, names, args.calls) if args.calls else {}
+
+        results = Results()
+        before = await call_counts(client)
+        deadline = time.perf_counter() + args.duration
+
+        async def user():
+            while time.perf_counter() < deadline:
+                name = rng.choices(names, weights=[weights[n] for n in names])[0]
+                await timed(results, ops, name)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(args.clients)))
+        wall = time.perf_counter() - t0
+        after = await call_counts(client)
+
+    total = sum(len(v) for v in results.latency.values())
+    return {
+        "wall_seconds": round(wall, 3),
+        "requests": total,
+        "rps": round(total / wall, 2) if wall else None,
+        "endpoints": results.report(wall),
+        "calls_per_request": per_request,
+        "calls_per_request_mixed": count_diff(before, after, total) if total else {},
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    for name in ("seed", "cleanup"):
+        p = sub.add_parser(name)
+        p.add_argument("--redis", default=os.environ.get("REDIS_URL", "redis://localhost:6379/0"))
+        p.add_argument("--s3-endpoint", default=os.environ.get("S3_ENDPOINT", "http://localhost:9000"))
+        p.add_argument("--bucket", default=os.environ.get("S3_BUCKET", "hack"))
+        if name == "seed":
+            p.add_argument("--scans", type=int, default=1_000_000)
+            p.add_argument("--objects", type=int, default=100, help="upload real outputs for done scans among the first N")
+            p.add_argument("--asset-bytes", type=int, default=4 * 1024 * 1024)
+
+    p = sub.add_parser("run")
+    p.add_argument("--hub", default=os.environ.get("HUB_URL", "http://localhost:8000"))
+    p.add_argument("--in-process", action="store_true", help="load hub/app.py in this process instead of using --hub")
+    p.add_argument("--profile", choices=sorted(PROFILES), default="mixed")
+    p.add_argument("--scans", type=int, default=1_000_000, help="same value as seed --scans")
+    p.add_argument("--objects", type=int, default=100, help="same value as seed --objects (download targets)")
+    p.add_argument("--clients", type=int, default=200)
+    p.add_argument("--duration", type=float, default=60)
+    p.add_argument("--calls", type=int, default=20, help="sequential calls per endpoint for call counting (0 = skip)")
+    p.add_argument("--timeout", type=float, default=30)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--out", default=None, help="report path (default: bench_results/hub_load-<profile>-<commit>.json)")
+    args = ap.parse_args()
+
+    if args.command == "seed":
+        return seed(args)
+    if args.command == "cleanup":
+        return cleanup(args)
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "created_at": time.time(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("command", "out")},
+        **asyncio.run(run(args)),
+    }
+    for route, e in report["endpoints"].items():
+        lat = e["latency"]
+        print(
+            f"{route:40s} n={e['requests']:7d} p50={lat['p50'] * 1000:8.1f}ms p95={lat['p95'] * 1000:8.1f}ms "
+            f"p99={lat['p99'] * 1000:8.1f}ms errors={e['error_rate'] * 100:.2f}%"
+        )
+    for name, c in report["calls_per_request"].items():
+        print(f"{name:24s} redis={c['redis']:.2f} s3={c['s3']:.2f} per request")
+
+    out = args.out or os.path.join("bench_results", f"hub_load-{args.profile}-{commit or int(time.time())}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("report:", out)
+
+if __name__ == "__main__":
+    main()
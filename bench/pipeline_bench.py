@@ -0,0 +1,304 @@
+"""
+パイプライン全体(hub → キュー → worker → S3)のベンチマーク。
+
+合成した頭部GLB（三角形数・テクスチャサイズを振る）を POST /scan でアップロードし、
+done になるまでの時間・workerが記録した工程ごとの所要時間(timing_*)・BlenderのRSS・成果物サイズを集計して
+JSONに保存する。コミットごとの結果を --compare で比べられる。
+
+docker compose で hub / worker / redis / minio を起動した状態で実行する:
+  python bench/pipeline_bench.py --hub http://localhost:8000 --triangles 20000,200000 --textures 1024,4096 --scans 5
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import struct
+import subprocess
+import time
+import zlib
+from array import array
+
+import httpx
+
+# ---- 合成GLB
+
+def sphere_mesh(triangles: int) -> tuple[array, array, array, array]:
+    # UV球。三角形数 ≒ 2 * segments * (rings - 1)
+    segments = max(int(math.sqrt(triangles)), 3)
+    rings = max(triangles // (2 * segments) + 1, 2)
+    positions, normals, uvs = array("f"), array("f"), array("f")
+    for i in range(rings + 1):
+        v = i / rings
+        theta = v * math.pi
+        for j in range(segments + 1):
+            u = j / segments
+            phi = u * 2 * math.pi
+            # 頭らしく少しだけ凹凸を付ける（デシメートが一様に崩さないように）
+            radius = 0.1 * (1 + 0.03 * math.sin(7 * phi) * math.sin(5 * theta))
+            x, y, z = math.sin(theta) * math.cos(phi), math.cos(theta), math.sin(theta) * math.sin(phi)
+            positions.extend((x * radius, y * radius + 1.6, z * radius))
+            normals.extend((x, y, z))
+            uvs.extend((u, v))
+    indices = array("I")
+    row = segments + 1
+    for i in range(rings):
+        for j in range(segments):
+            a, b = i * row + j, (i + 1) * row + j
+            if i != 0:
+                indices.extend((a, b, a + 1))
+            if i != rings - 1:
+                indices.extend((a + 1, b, b + 1))
+    return positions, normals, uvs, indices
+
+def noise_png(size: int, seed: int) -> bytes:
+    # 写真テクスチャと同じく圧縮の効きにくい画像（PILに依存しないよう自前でPNGにする）
+    rng = random.Random(seed)
+    row_bytes = size * 3
+    raw = bytearray()
+    for _ in range(size):
+        raw.append(0)  # filter: none
+        raw += rng.randbytes(row_bytes)
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    ihdr = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(bytes(raw), 1)) + chunk(b"IEND", b"")
+
+def synthetic_head_glb(triangles: int, texture: int, seed: int = 0) -> bytes:
+    positions, normals, uvs, indices = sphere_mesh(triangles)
+    image = noise_png(texture, seed) if texture else b""
+    n_verts = len(positions) // 3
+
+    blobs = [positions.tobytes(), normals.tobytes(), uvs.tobytes(), indices.tobytes(), image]
+    views, offset = [], 0
+    for blob in blobs:
+        views.append({"buffer": 0, "byteOffset": offset, "byteLength": len(blob)})
+        offset += len(blob)
+        offset += -offset % 4
+    bin_chunk = b"".join(blob + b"\x00" * (-len(blob) % 4) for blob in blobs)
+
+    xs, ys, zs = positions[0::3], positions[1::3], positions[2::3]
+    doc = {
+        "asset": {"version": "2.0", "generator": "pipeline_bench"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0, "name": "head"}],
+        "meshes": [{
+            "name": "head",
+            "primitives": [{
+                "attributes": {"POSITION": 0, "NORMAL": 1, "TEXCOORD_0": 2},
+                "indices": 3,
+                "material": 0,
+            }],
+        }],
+        "accessors": [
+            {"bufferView": 0, "componentType": 5126, "count": n_verts, "type": "VEC3",
+             "min": [min(xs), min(ys), min(zs)], "max": [max(xs), max(ys), max(zs)]},
+            {"bufferView": 1, "componentType": 5126, "count": n_verts, "type": "VEC3"},
+            {"bufferView": 2, "componentType": 5126, "count": n_verts, "type": "VEC2"},
+            {"bufferView": 3, "componentType": 5125, "count": len(indices), "type": "SCALAR"},
+        ],
+        "bufferViews": views if image else views[:4],
+        "buffers": [{"byteLength": len(bin_chunk)}],
+        "materials": [{"pbrMetallicRoughness": {"metallicFactor": 0.0}}],
+    }
+    if image:
+        doc["images"] = [{"bufferView": 4, "mimeType": "image/png"}]
+        doc["textures"] = [{"source": 0}]
+        doc["materials"][0]["pbrMetallicRoughness"]["baseColorTexture"] = {"index": 0}
+
+    json_chunk = json.dumps(doc, separators=(",", ":")).encode()
+    json_chunk += b" " * (-len(json_chunk) % 4)
+    total = 12 + 8 + len(json_chunk) + 8 + len(bin_chunk)
+    return (
+        struct.pack("<4sII", b"glTF", 2, total)
+        + struct.pack("<II", len(json_chunk), 0x4E4F534A) + json_chunk
+        + struct.pack("<II", len(bin_chunk), 0x004E4942) + bin_chunk
+    )
+
+# ---- 実行
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(q: float) -> float:
+        return values[min(max(math.ceil(q * len(values)) - 1, 0), len(values) - 1)]
+
+    return {"count": len(values), "p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": values[-1]}
+
+async def run_scan(client: httpx.AsyncClient, glb: bytes, lane: str, timeout: float) -> dict:
+    t0 = time.perf_counter()
+    while True:
+        resp = await client.post(
+            "/scan",
+            params={"lane": lane},
+            files={"head": ("head.glb", glb, "model/gltf-binary")},
+        )
+        if resp.status_code != 429:
+            break
+        # 混雑時の受付制限。待ち時間もレイテンシに含める
+        await asyncio.sleep(float(resp.headers.get("Retry-After", 5)))
+    resp.raise_for_status()
+    scan_id = resp.json()["scan_id"]
+    uploaded = time.perf_counter()
+
+    since = 0.0
+    deadline = t0 + timeout
+    while True:
+        if time.perf_counter() > deadline:
+            return {"scan_id": scan_id, "status": "timeout", "latency": time.perf_counter() - t0}
+        polled = time.perf_counter()
+        resp = await client.get(f"/scan/{scan_id}/wait", params={"since": since, "timeout": 25})
+        resp.raise_for_status()
+        d = resp.json()
+        if d.get("status") in ("done", "failed"):
+            return {
+                "scan_id": scan_id,
+                "status": d["status"],
+                "upload_seconds": uploaded - t0,
+                "latency": time.perf_counter() - t0,
+                "scan": d,
+            }
+        # updated_at の無いscan（古いhub）は created_at を基準にする
+        prev, since = since, float(d.get("updated_at") or d.get("created_at") or since)
+        if since <= prev and time.perf_counter() - polled < 1:
+            # 待たずに同じ状態が返ってきた。hubを叩き続けないよう少し空ける
+            await asyncio.sleep(1)
+
+async def run_case(args, triangles: int, texture: int) -> dict:
+    # 同じ内容はhubの重複判定で弾かれるので、scanごとにシードを変える
+    glbs = [synthetic_head_glb(triangles, texture, seed=random.randrange(1 << 30)) for _ in range(args.scans)]
+    sem = asyncio.Semaphore(args.concurrency)
+    async with httpx.AsyncClient(base_url=args.hub, timeout=httpx.Timeout(120)) as client:
+
+        async def one(glb: bytes) -> dict:
+            async with sem:
+                return await run_scan(client, glb, args.lane, args.timeout)
+
+        t0 = time.perf_counter()
+        results = await asyncio.gather(*(one(g) for g in glbs))
+        wall = time.perf_counter() - t0
+
+    done = [res for res in results if res["status"] == "done"]
+    stages: dict[str, list[float]] = {}
+    for res in done:
+        for k, v in res["scan"].items():
+            if k.startswith("timing_"):
+                stages.setdefault(k[len("timing_"):], []).append(float(v))
+
+    def field(name: str) -> list[float]:
+        return [float(res["scan"][name]) for res in done if res["scan"].get(name)]
+
+    return {
+        "triangles": triangles,
+        "texture": texture,
+        "input_bytes": sum(len(g) for g in glbs) // len(glbs),
+        "scans": len(results),
+        "done": len(done),
+        "failed": [res["scan_id"] for res in results if res["status"] != "done"],
+        "wall_seconds": round(wall, 3),
+        "throughput_per_min": round(len(done) / wall * 60, 3) if wall else None,
+        "latency": percentiles([res["latency"] for res in done]),
+        "upload": percentiles([res["upload_seconds"] for res in done]),
+        "stages": {stage: percentiles(values) for stage, values in sorted(stages.items())},
+        "peak_rss_mb": max(field("blender_rss_mb"), default=None),
+        "head": {
+            "vertices": percentiles(field("head_vertices")),
+            "vertices_decimated": percentiles(field("head_vertices_decimated")),
+            "texture_bytes": percentiles(field("head_texture_bytes")),
+            "texture_bytes_processed": percentiles(field("head_texture_bytes_processed")),
+        },
+        "output_bytes": {
+            "asset": percentiles(field("asset_size")),
+            "asset_blend": percentiles(field("asset_blend_size")),
+            "asset_uncompressed": percentiles(field("asset_uncompressed_size")),
+            "asset_images": percentiles(field("asset_image_bytes")),
+            "asset_blend_images": percentiles(field("asset_blend_image_bytes")),
+        },
+        "compression": sorted({res["scan"].get("asset_compression", "none") for res in done}),
+    }
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old: dict, new: dict):
+    # 同じ (triangles, texture) のケースどうしで p50 を比べる
+    old_cases = {(c["triangles"], c["texture"]): c for c in old["cases"]}
+    print(f"compare {old.get('commit')} -> {new.get('commit')}")
+    for case in new["cases"]:
+        prev = old_cases.get((case["triangles"], case["texture"]))
+        if not prev:
+            continue
+        print(f"- triangles={case['triangles']} texture={case['texture']}")
+        rows = [("latency", prev["latency"], case["latency"])]
+        rows += [(s, prev["stages"].get(s, {}), v) for s, v in case["stages"].items()]
+        for name, a, b in rows:
+            if a.get("p50") and b.get("p50"):
+                print(f"    {name:24s} p50 {a['p50']:8.3f}s -> {b['p50']:8.3f}s ({(b['p50'] / a['p50'] - 1) * 100:+.1f}%)")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--hub", default=os.environ.get("HUB_URL", "http://localhost:8000"))
+    ap.add_argument("--triangles", default="20000,200000", help="comma separated triangle counts")
+    ap.add_argument("--textures", default="1024,4096", help="comma separated texture sizes (0 = no texture)")
+    ap.add_argument("--scans", type=int, default=5, help="scans per case")
+    ap.add_argument("--concurrency", type=int, default=4, help="scans in flight at once")
+    ap.add_argument("--lane", default="bulk")
+    ap.add_argument("--timeout", type=float, default=1800, help="per-scan timeout (seconds)")
+    ap.add_argument("--out", default=None, help="report path (default: bench_results/pipeline-<commit>.json)")
+    ap.add_argument("--compare", default=None, help="previous report to compare against")
+    ap.add_argument("--write-glb", default=None, metavar="DIR", help="only write the synthetic GLBs to DIR")
+    args = ap.parse_args()
+
+    triangles = [int(x) for x in args.triangles.split(",")]
+    textures = [int(x) for x in args.textures.split(",")]
+
+    if args.write_glb:
+        os.makedirs(args.write_glb, exist_ok=True)
+        for t in triangles:
+            for tex in textures:
+                path = os.path.join(args.write_glb, f"head_{t}_{tex}.glb")
+                with open(path, "wb") as f:
+                    f.write(synthetic_head_glb(t, tex))
+                print(path)
+        return
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "created_at": time.time(),
+        "hub": args.hub,
+        "params": {k: v for k, v in vars(args).items() if k not in ("out", "compare", "write_glb")},
+        "cases": [],
+    }
+    for t in triangles:
+        for tex in textures:
+            print(f"case triangles={t} texture={tex} ...", flush=True)
+            case = asyncio.run(run_case(args, t, tex))
+            print(
+                f"  done {case['done']}/{case['scans']} latency p50={case['latency'].get('p50')} "
+                f"throughput={case['throughput_per_min']}/min peak_rss={case['peak_rss_mb']}MB",
+                flush=True,
+            )
+            report["cases"].append(case)
+
+    out = args.out or os.path.join("bench_results", f"pipeline-{commit or int(time.time())}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("report:", out)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,28 @@
 import os
+import json
 import uuid
+import hashlib
+import math
 import time
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query
-from fastapi.responses import JSONResponse
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from email.utils import format_datetime
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel, Field
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
-import redis
+import redis.asyncio as aioredis
 import mimetypes
+import statistics
+from collections import OrderedDict
+from glbinfo import GlbError, GlbInspector
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 
 REDIS_URL = os.environ["REDIS_URL"]
 S3_BUCKET = os.environ["S3_BUCKET"]
@@ -16,8 +30,139 @@ AWS_REGION = os.environ.get("AWS_REGION")
 S3_ENDPOINT = os.environ.get("S3_ENDPOINT")
 S3_ACCESS_KEY = os.environ.get("S3_ACCESS_KEY")
 S3_SECRET_KEY = os.environ.get("S3_SECRET_KEY")
+# S3マルチパートの1パートは最後以外5MiB以上が必須
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = max(int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024)), S3_MIN_PART_SIZE)
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", 1024 * 1024))
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 64))
+REDIS_POOL_TIMEOUT = float(os.environ.get("REDIS_POOL_TIMEOUT", 5))
+S3_MAX_WORKERS = int(os.environ.get("S3_MAX_WORKERS", 32))
+PRESIGN_EXPIRES = int(os.environ.get("PRESIGN_EXPIRES", 60 * 10))
+# 期限切れ直前のURLを返さないよう、残りがこの秒数を切ったら署名し直す
+PRESIGN_REFRESH_MARGIN = int(os.environ.get("PRESIGN_REFRESH_MARGIN", 60))
+PRESIGN_CACHE_SIZE = int(os.environ.get("PRESIGN_CACHE_SIZE", 10000))
+DIRECT_UPLOAD_PART_SIZE = max(int(os.environ.get("DIRECT_UPLOAD_PART_SIZE", 8 * 1024 * 1024)), S3_MIN_PART_SIZE)
+DIRECT_UPLOAD_MAX_SIZE = int(os.environ.get("DIRECT_UPLOAD_MAX_SIZE", 1024 * 1024 * 1024))
+# 未完了のダイレクトアップロードを再開できる期間（過ぎたらupload:{id}は消える）
+DIRECT_UPLOAD_TTL = int(os.environ.get("DIRECT_UPLOAD_TTL", 60 * 60 * 24))
+S3_MAX_PARTS = 10000
+# アップロード時のGLB検査の上限（超えたら worker に回さず 400 で返す）
+GLB_MAX_TRIANGLES = int(os.environ.get("GLB_MAX_TRIANGLES", 5_000_000))
+GLB_MAX_VERTICES = int(os.environ.get("GLB_MAX_VERTICES", 5_000_000))
+GLB_MAX_JSON_BYTES = int(os.environ.get("GLB_MAX_JSON_BYTES", 64 * 1024 * 1024))
+# ダイレクトアップロード完了時に、S3上の先頭から読むバイト数（JSONチャンクが収まらなければ追加で読む）
+GLB_PROBE_BYTES = 64 * 1024
+# 同一内容の重複判定で「アップロード中」として押さえておく秒数
+DEDUP_CLAIM_TTL = int(os.environ.get("DEDUP_CLAIM_TTL", 60 * 60))
+# ダイレクトアップロードの完了時に、S3上のオブジェクトを読み直して重複判定するか。
+# オブジェクト全体をhub経由で1回読むので、ダイレクトアップロードで省いたhubの帯域・CPUがまたかかる。既定は無効
+DIRECT_UPLOAD_DEDUP = os.environ.get("DIRECT_UPLOAD_DEDUP", "false").lower() in ("1", "true", "yes")
+# SSEの接続維持用コメントを送る間隔と、ロングポーリングの最大待ち秒数
+SSE_KEEPALIVE = float(os.environ.get("SSE_KEEPALIVE", 15))
+LONG_POLL_MAX_TIMEOUT = float(os.environ.get("LONG_POLL_MAX_TIMEOUT", 30))
+BATCH_STATUS_MAX_IDS = int(os.environ.get("BATCH_STATUS_MAX_IDS", 500))
+# 受付制御: 推定待ち時間が ADMISSION_MAX_WAIT 秒を超えたら off/reject(429)/degrade(軽量プロファイル)
+ADMISSION_POLICY = os.environ.get("ADMISSION_POLICY", "off")
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", 60 * 30))
+# workerの処理時間の実績がまだないときに使う1件あたりの秒数
+DEFAULT_JOB_SECONDS = float(os.environ.get("DEFAULT_JOB_SECONDS", 60))
+# workers:heartbeat の更新がこの秒数以内のworkerを稼働中とみなす
+WORKER_ALIVE_TTL = float(os.environ.get("WORKER_ALIVE_TTL", 30))
+# out/{scan_id}/ 配下は再処理(POST /scan/{id}/reprocess)で書き換わるので、ETagで再検証させる（変化がなければ304）
+ASSET_CACHE_CONTROL = os.environ.get("ASSET_CACHE_CONTROL", "public, no-cache")
+# レーン内の短いジョブ優先: 推定処理コスト(秒) = 三角形数/SJF_TRIANGLES_PER_SECOND + バイト数/SJF_BYTES_PER_SECOND
+# 大きいジョブの後回しは SJF_MAX_DELAY 秒まで（それより後に来たジョブには抜かれない）
+SJF_TRIANGLES_PER_SECOND = float(os.environ.get("SJF_TRIANGLES_PER_SECOND", 20000))
+SJF_BYTES_PER_SECOND = float(os.environ.get("SJF_BYTES_PER_SECOND", 2 * 1024 * 1024))
+SJF_MAX_DELAY = float(os.environ.get("SJF_MAX_DELAY", 600))
 
-r = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+# ---- メトリクス（GET /metrics でPrometheusテキスト形式を返す）
+
+HTTP_LATENCY = Histogram(
+    "hub_http_request_duration_seconds",
+    "Time until response headers are sent, per route",
+    ["method", "route"],
+)
+HTTP_RESPONSES = Counter("hub_http_responses_total", "Responses per route and status code", ["method", "route", "status"])
+REDIS_LATENCY = Histogram(
+    "hub_redis_command_duration_seconds",
+    "Redis command / pipeline round trip time (including pool wait)",
+    ["command"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+S3_LATENCY = Histogram(
+    "hub_s3_call_duration_seconds",
+    "boto3 call time (including wait for the S3 executor)",
+    ["operation"],
+)
+S3_ERRORS = Counter("hub_s3_errors_total", "boto3 calls that raised, per operation and error code", ["operation", "code"])
+QUEUE_LENGTH = Gauge("hub_queue_scans_length", "Number of queued scans per lane (queue:lane:*)", ["lane"])
+INDEX_SIZE = Gauge("hub_scans_index_size", "Number of scans in scans:index")
+RETRY_QUEUE_LENGTH = Gauge("hub_queue_scans_delayed", "Scans waiting for a retry in queue:scans:delayed")
+DEAD_LETTER_LENGTH = Gauge("hub_queue_scans_dead", "Scans that exhausted their attempts (queue:scans:dead)")
+
+class MetricsMiddleware:
+    """ルート（パステンプレート）単位のレイテンシとステータスコードを記録するASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        recorded = False
+
+        def record(status_code: int):
+            nonlocal recorded
+            recorded = True
+            # FastAPIはマッチしたルートを scope["route"] に入れる（/scan/{scan_id}/status の形でまとまる）
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            HTTP_LATENCY.labels(scope["method"], path).observe(time.perf_counter() - start)
+            HTTP_RESPONSES.labels(scope["method"], path, str(status_code)).inc()
+
+        async def send_with_metrics(message):
+            # SSEやダウンロードは本文の送信が長いので、ヘッダ送信時点までを計測する
+            if message["type"] == "http.response.start" and not recorded:
+                record(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            if not recorded:
+                record(500)
+
+class InstrumentedPipeline(aioredis.client.Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_LATENCY.labels("pipeline").observe(time.perf_counter() - start)
+
+class InstrumentedRedis(aioredis.Redis):
+    # 全コマンドが execute_command を通るので、ここで計測すれば呼び出し側は変えなくてよい
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_LATENCY.labels(str(args[0]).lower()).observe(time.perf_counter() - start)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+# 空きコネクションがなければ例外にせずREDIS_POOL_TIMEOUT秒まで待つ
+redis_pool = aioredis.BlockingConnectionPool.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+)
+r = InstrumentedRedis(connection_pool=redis_pool)
 
 def make_s3_client():
     kwargs: dict = {}
@@ -30,9 +175,24 @@ def make_s3_client():
         if not AWS_REGION:
             raise RuntimeError("AWS_REGION is required when S3_ENDPOINT is not set")
         kwargs["region_name"] = AWS_REGION
-    return boto3.client("s3", **kwargs)
+    # 専用スレッドプールと同じ数だけHTTPコネクションを持たせる
+    return boto3.client("s3", config=Config(max_pool_connections=S3_MAX_WORKERS), **kwargs)
 
 s3 = make_s3_client()
+# boto3は同期APIなので、イベントループを止めないよう専用の上限付きスレッドプールで実行する
+s3_executor = ThreadPoolExecutor(max_workers=S3_MAX_WORKERS, thread_name_prefix="s3")
+
+async def s3_call(fn, /, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    operation = getattr(fn, "__name__", "unknown")
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(s3_executor, functools.partial(fn, *args, **kwargs))
+    except ClientError as e:
+        S3_ERRORS.labels(operation, (e.response.get("Error") or {}).get("Code") or "unknown").inc()
+        raise
+    finally:
+        S3_LATENCY.labels(operation).observe(time.perf_counter() - start)
 
 app = FastAPI()
 
@@ -45,6 +205,26 @@ def key_out(scan_id: str) -> str:
 def key_out_blend(scan_id: str) -> str:
     return f"out/{scan_id}/avatar_blend.glb"
 
+SCAN_STATUSES = ("queued", "processing", "done", "failed")
+SCAN_FINAL_STATUSES = ("done", "failed")
+# workerとhubが状態遷移ごとにJSONをPUBLISHするチャンネル
+SCAN_EVENTS_CHANNEL = "scans:events"
+
+def key_status_index(status: str) -> str:
+    # scans:index と同じスコア(created_at)で status ごとに持つ索引。workerが遷移時に付け替える
+    return f"scans:status:{status}"
+
+# 優先度レーン。workerは重み付きでレーンを選び、レーン内はスコアの小さい順に取り出す
+SCAN_LANES = ("interactive", "bulk", "reprocess")
+# クライアントが指定できるレーン（reprocess は POST /scan/{id}/reprocess 専用）
+UPLOAD_LANES = ("interactive", "bulk")
+# ジョブ投入時にLPUSHし、待機中のworkerを起こす
+QUEUE_WAKEUP_KEY = "queue:scans:wakeup"
+QUEUE_WAKEUP_MAX = 10000
+
+def key_lane(lane: str) -> str:
+    return f"queue:lane:{lane}"
+
 def candidate_out_keys(scan_id: str, scan_meta: dict | None = None) -> list[str]:
     scan_meta = scan_meta or {}
     keys = []
@@ -106,9 +286,9 @@ def guess_filename_blend(scan_id: str, key: str, scan_meta: dict | None = None)
     ext = os.path.splitext(key)[1] or ".bin"
     return f"avatar_blend_{scan_id}{ext}"
 
-def head_object_exists(key: str) -> bool:
+async def head_object_exists(key: str) -> bool:
     try:
-        s3.head_object(Bucket=S3_BUCKET, Key=key)
+        await s3_call(s3.head_object, Bucket=S3_BUCKET, Key=key)
         return True
     except ClientError as e:
         code = (e.response.get("Error") or {}).get("Code")
@@ -130,6 +310,136 @@ def ensure_bucket():
 
 ensure_bucket()
 
+async def iter_s3_body(body):
+    # StreamingBody.read はブロッキングなのでチャンクごとにスレッドプールで読む
+    try:
+        while True:
+            chunk = await s3_call(body.read, DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        body.close()
+
+# (key, etag) -> (url, expires_at)。LRUでPRESIGN_CACHE_SIZE件まで保持する
+presign_cache: OrderedDict[tuple[str, str], tuple[str, float]] = OrderedDict()
+
+async def presign_get(key: str, etag: str = "") -> str:
+    now = time.time()
+    cache_key = (key, etag)  # オブジェクトが差し替わったら別エントリになる
+    hit = presign_cache.get(cache_key)
+    if hit and hit[1] - PRESIGN_REFRESH_MARGIN > now:
+        presign_cache.move_to_end(cache_key)
+        return hit[0]
+
+    # IAM Roleの認証情報更新でネットワークI/Oが発生しうるのでスレッドプールで実行
+    url = await s3_call(
+        s3.generate_presigned_url,
+        ClientMethod="get_object",
+        Params={"Bucket": S3_BUCKET, "Key": key},
+        ExpiresIn=PRESIGN_EXPIRES,
+    )
+    presign_cache[cache_key] = (url, now + PRESIGN_EXPIRES)
+    presign_cache.move_to_end(cache_key)
+    while len(presign_cache) > PRESIGN_CACHE_SIZE:
+        presign_cache.popitem(last=False)
+    return url
+
+async def resolve_asset_key(scan_meta: dict, prefix: str, candidates: list[str]) -> str | None:
+    """
+    成果物のS3キーを決める。workerが公開時に検証済みメタデータ({prefix}_key/_size/_etag)を
+    書いていればHEADせずにそれを使い、古いscanだけ候補キーをHEADで探す。
+    """
+    if scan_meta.get(f"{prefix}_key") and scan_meta.get(f"{prefix}_etag"):
+        return scan_meta[f"{prefix}_key"]
+    for key in candidates:
+        if await head_object_exists(key):
+            return key
+    return None
+
+# 一覧1ページ分を1往復で取る: ZREVRANGEBYSCORE + 各scanのHMGET(射影したフィールドだけ)
+# ※ scan:{id} をKEYS経由で渡せないのでRedis Cluster非対応（ElastiCacheは非クラスタ構成前提）
+LIST_SCANS_LUA = """
+local rows = redis.call('ZREVRANGEBYSCORE', KEYS[1], ARGV[1], '-inf', 'WITHSCORES', 'LIMIT', 0, tonumber(ARGV[2]))
+local out = {}
+for i = 1, #rows, 2 do
+    out[#out + 1] = rows[i]
+    out[#out + 1] = rows[i + 1]
+    out[#out + 1] = redis.call('HMGET', 'scan:' .. rows[i], unpack(ARGV, 3))
+end
+return out
+"""
+LIST_SCANS_FIELDS = ("status",)
+list_scans_script = r.register_script(LIST_SCANS_LUA)
+
+class ScanEvents:
+    """
+    hubプロセスごとにRedisのSUBSCRIBEを1本だけ持ち、届いたイベントを
+    scan_idごとに待っているクライアント(SSE/ロングポーリング)のキューへ配る。
+    """
+
+    def __init__(self):
+        self.listeners: dict[str, set[asyncio.Queue]] = {}
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def listen(self, scan_id: str) -> asyncio.Queue:
+        q: asyncio.Queue = asyncio.Queue(maxsize=100)
+        self.listeners.setdefault(scan_id, set()).add(q)
+        return q
+
+    def unlisten(self, scan_id: str, q: asyncio.Queue):
+        qs = self.listeners.get(scan_id)
+        if qs is None:
+            return
+        qs.discard(q)
+        if not qs:
+            del self.listeners[scan_id]
+
+    async def _run(self):
+        while True:
+            pubsub = r.pubsub()
+            try:
+                await pubsub.subscribe(SCAN_EVENTS_CHANNEL)
+                async for msg in pubsub.listen():
+                    if msg["type"] != "message":
+                        continue
+                    ev = json.loads(msg["data"])
+                    for q in self.listeners.get(ev.get("scan_id"), ()):
+                        try:
+                            q.put_nowait(ev)
+                        except asyncio.QueueFull:
+                            pass  # 読まれていないクライアントの分は捨てる（次のイベントかstatusで追いつく）
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("WARN: scan events subscription lost, retrying", e)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+scan_events = ScanEvents()
+
+@app.on_event("startup")
+async def startup():
+    scan_events.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await scan_events.stop()
+    await r.aclose()
+    s3_executor.shutdown(wait=False)
+
 #別のappからのリクエスト送信を許可
 app.add_middleware(
     CORSMiddleware,
@@ -138,139 +448,821 @@ app.add_middleware(
     allow_methods=["*"], #GET,POSTなど
     allow_headers=["*"], 
 )
+app.add_middleware(MetricsMiddleware)
+
+@app.get("/metrics")
+async def metrics():
+    # ゲージはスクレイプ時に1往復で取る
+    async with r.pipeline(transaction=False) as pipe:
+        for lane in SCAN_LANES:
+            pipe.zcard(key_lane(lane))
+        pipe.zcard("scans:index")
+        pipe.zcard("queue:scans:delayed")
+        pipe.llen("queue:scans:dead")
+        *lane_lengths, index_size, delayed, dead = await pipe.execute()
+    for lane, length in zip(SCAN_LANES, lane_lengths):
+        QUEUE_LENGTH.labels(lane).set(length)
+    INDEX_SIZE.set(index_size)
+    RETRY_QUEUE_LENGTH.set(delayed)
+    DEAD_LETTER_LENGTH.set(dead)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    # nearest-rank
+    idx = max(math.ceil(q * len(sorted_values)) - 1, 0)
+    return sorted_values[min(idx, len(sorted_values) - 1)]
+
+#工程ごとの所要時間（workerが stats:stage:{stage} に記録）の分布
+@app.get("/stats/stages")
+async def stage_stats(window: float = Query(3600, gt=0, le=30 * 24 * 3600)):
+    now = time.time()
+    stages = sorted(await r.smembers("stats:stages"))
+    async with r.pipeline(transaction=False) as pipe:
+        for stage in stages:
+            pipe.zrangebyscore(f"stats:stage:{stage}", now - window, "+inf")
+        samples = await pipe.execute()
+    out = {}
+    for stage, members in zip(stages, samples):
+        if not members:
+            continue
+        values = sorted(float(m.split(":", 1)[0]) for m in members)
+        out[stage] = {
+            "count": len(values),
+            "p50": percentile(values, 0.5),
+            "p95": percentile(values, 0.95),
+            "max": values[-1],
+        }
+    return {"window": window, "stages": out}
+
+def inspect_whole(inspector: GlbInspector, data: bytes) -> dict:
+    inspector.feed(data)
+    return inspector.finish()
+
+def new_glb_inspector() -> GlbInspector:
+    return GlbInspector(
+        max_json_bytes=GLB_MAX_JSON_BYTES,
+        max_triangles=GLB_MAX_TRIANGLES,
+        max_vertices=GLB_MAX_VERTICES,
+    )
+
+async def upload_stream_to_s3(upload: UploadFile, key: str, content_type: str, before_commit=None) -> dict:
+    """
+    UploadFileをUPLOAD_CHUNK_SIZEずつ読み、S3マルチパートアップロードへ流し込む。
+    1リクエストあたりのメモリ使用量はチャンクサイズで頭打ちになる。
+    途中で失敗した場合はマルチパートをabortして未完成パートを残さない。
+    読みながらSHA-256の計算とGLBの構造検査も行い、壊れていれば GlbError で中断する。
+    before_commit(sha256) がFalseを返したらS3には何も残さない。
+    """
+    sha = hashlib.sha256()
+    inspector = new_glb_inspector()
+    chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+    if not chunk:
+        raise HTTPException(400, "head is empty")
+
+    # 1チャンクに収まる小さいファイルはマルチパートにせず1回で送る
+    if len(chunk) < UPLOAD_CHUNK_SIZE:
+        glb = await asyncio.to_thread(inspect_whole, inspector, chunk)
+        sha.update(chunk)
+        digest = sha.hexdigest()
+        if before_commit and not await before_commit(digest):
+            return {"size": len(chunk), "sha256": digest, "glb": glb, "committed": False}
+        await s3_call(s3.put_object, Bucket=S3_BUCKET, Key=key, Body=chunk, ContentType=content_type)
+        return {"size": len(chunk), "sha256": digest, "glb": glb, "committed": True}
+
+    mpu = await s3_call(s3.create_multipart_upload, Bucket=S3_BUCKET, Key=key, ContentType=content_type)
+    upload_id = mpu["UploadId"]
+    parts = []
+    total = 0
+    try:
+        while chunk:
+            # ヘッダやJSONチャンクの異常はこの時点で分かるので、残りを送る前に打ち切る
+            # （JSONチャンクのパースは数十MBになりうるので、イベントループの外で行う）
+            await asyncio.to_thread(inspector.feed, chunk)
+            part_number = len(parts) + 1
+            # hashlibは大きなバッファでGILを離すので、ハッシュ計算はパート送信と並行して別スレッドで行う
+            resp, _ = await asyncio.gather(
+                s3_call(
+                    s3.upload_part,
+                    Bucket=S3_BUCKET,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=chunk,
+                ),
+                asyncio.to_thread(sha.update, chunk),
+            )
+            parts.append({"PartNumber": part_number, "ETag": resp["ETag"]})
+            total += len(chunk)
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+
+        glb = await asyncio.to_thread(inspector.finish)
+        digest = sha.hexdigest()
+        if before_commit and not await before_commit(digest):
+            await s3_call(s3.abort_multipart_upload, Bucket=S3_BUCKET, Key=key, UploadId=upload_id)
+            return {"size": total, "sha256": digest, "glb": glb, "committed": False}
+
+        await s3_call(
+            s3.complete_multipart_upload,
+            Bucket=S3_BUCKET,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except BaseException:
+        # クライアント切断(CancelledError)も含めて後始末する
+        try:
+            await s3_call(s3.abort_multipart_upload, Bucket=S3_BUCKET, Key=key, UploadId=upload_id)
+        except ClientError as e:
+            print("WARN: abort_multipart_upload failed", key, e)
+        raise
+    return {"size": total, "sha256": digest, "glb": glb, "committed": True}
+
+async def inspect_s3_glb(key: str, size: int) -> dict:
+    # S3上のオブジェクトを先頭(ヘッダ+JSONチャンク+BINチャンクのヘッダ)だけRange読みして検査する
+    inspector = new_glb_inspector()
+    offset = 0
+    want = min(size, GLB_PROBE_BYTES)
+    while offset < want:
+        obj = await s3_call(s3.get_object, Bucket=S3_BUCKET, Key=key, Range=f"bytes={offset}-{want - 1}")
+        data = await s3_call(obj["Body"].read)
+        await asyncio.to_thread(inspector.feed, data)
+        offset = want
+        if inspector.state == "json":
+            want = min(size, 20 + inspector.json_length + 8)
+        elif inspector.state == "json_text":
+            want = size
+        elif inspector.state == "chunk_header":
+            want = min(size, offset + 8)
+    return await asyncio.to_thread(inspector.finish, size)
+
+def glb_fields(glb: dict) -> dict:
+    # scan:{id} に glb_* として残す（スケジューリングやキャパシティ計画用）
+    return {f"glb_{k}": v for k, v in glb.items()}
+
+def key_sha256(digest: str, profile: str | None = None) -> str:
+    # 処理プロファイルが違えば成果物も違う（fastのscanを通常品質のアップロードに返さない）
+    return f"scans:sha256:{profile or 'standard'}:{digest}"
+
+def sha256_s3_object(key: str) -> str:
+    # s3_call経由でスレッドプールで実行する（読み込みとハッシュ計算でイベントループを止めない）
+    sha = hashlib.sha256()
+    body = s3.get_object(Bucket=S3_BUCKET, Key=key)["Body"]
+    try:
+        for chunk in iter(lambda: body.read(DOWNLOAD_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    finally:
+        body.close()
+    return sha.hexdigest()
+
+async def claim_content_hash(digest: str, scan_id: str, profile: str | None = None) -> str | None:
+    """
+    同じ内容(SHA-256)・同じプロファイルのscanがあればそのscan_idを返す（呼び出し側は新規scanを作らない）。
+    なければこのscan_idで内容ハッシュを押さえてNoneを返す。
+    押さえは登録(enqueue_scan)までDEDUP_CLAIM_TTLで期限切れになるので、失敗したアップロードは残らない。
+    """
+    key = key_sha256(digest, profile)
+    if await r.set(key, scan_id, nx=True, ex=DEDUP_CLAIM_TTL):
+        return None
+    existing = await r.get(key)
+    status = await r.hget(f"scan:{existing}", "status") if existing else None
+    if status in ("queued", "processing", "done"):
+        # 処理中のものも含めて既存ジョブに相乗りする
+        return existing
+    if status == "failed":
+        # 失敗したscanには寄せず、今回のアップロードを正とする
+        await r.set(key, scan_id, ex=DEDUP_CLAIM_TTL)
+    # status is None: 同じ内容が別リクエストでアップロード途中。待たずにこちらも通常どおり処理する
+    return None
+
+def queue_score(glb: dict, enqueued_at: float) -> float:
+    """
+    レーン内の並び順（小さいほど先）。投入時刻に推定処理コストを足すので、
+    小さいジョブは先に来た大きいジョブを追い越せるが、追い越せる幅は SJF_MAX_DELAY 秒まで。
+    """
+    cost = (
+        float(glb.get("triangles") or 0) / SJF_TRIANGLES_PER_SECOND
+        + float(glb.get("bytes") or 0) / SJF_BYTES_PER_SECOND
+    )
+    return enqueued_at + min(cost, SJF_MAX_DELAY)
+
+def push_job(pipe, scan_id: str, lane: str, score: float):
+    pipe.zadd(key_lane(lane), {scan_id: score})
+    pipe.lpush(QUEUE_WAKEUP_KEY, scan_id)
+    pipe.ltrim(QUEUE_WAKEUP_KEY, 0, QUEUE_WAKEUP_MAX - 1)
+
+async def enqueue_scan(
+    scan_id: str,
+    created_at: float,
+    sha256: str | None = None,
+    profile: str | None = None,
+    glb: dict | None = None,
+    lane: str = "interactive",
+):
+    # S3へのアップロードが完了してから登録する（実体のないscanをworkerに渡さない）
+    now = time.time()
+    score = queue_score(glb or {}, now)
+    scan = {
+        "status": "queued",
+        "created_at": created_at,
+        # /wait?since=<updated_at> の基準。queuedの間もクライアントが読めるよう登録時から入れる
+        "updated_at": now,
+        "queue_lane": lane,
+        "queue_score": score,
+        **glb_fields(glb or {}),
+    }
+    if sha256:
+        scan["sha256"] = sha256
+    if profile:
+        scan["profile"] = profile
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.hset(f"scan:{scan_id}", mapping=scan)
+        if sha256:
+            # 押さえていた内容ハッシュを確定させる（期限なし）
+            pipe.set(key_sha256(sha256, profile), scan_id)
+        pipe.zadd("scans:index", {scan_id: created_at})
+        pipe.zadd(key_status_index("queued"), {scan_id: created_at})
+        push_job(pipe, scan_id, lane, score)
+        pipe.publish(
+            SCAN_EVENTS_CHANNEL,
+            json.dumps({"scan_id": scan_id, "event": "status", "status": "queued", "updated_at": now}),
+        )
+        await pipe.execute()
+
+# ---- 待ち時間の推定と受付制御
+
+async def queue_stats() -> dict:
+    # キュー長・直近の処理時間(workerが stats:job_durations に記録)・稼働中worker数を1往復で取る
+    async with r.pipeline(transaction=False) as pipe:
+        for lane in SCAN_LANES:
+            pipe.zcard(key_lane(lane))
+        pipe.zcard("queue:scans:delayed")
+        pipe.lrange("stats:job_durations", 0, -1)
+        pipe.zcount("workers:heartbeat", time.time() - WORKER_ALIVE_TTL, "+inf")
+        *lane_lengths, delayed, durations, workers = await pipe.execute()
+    queue_length = sum(lane_lengths)
+    job_seconds = statistics.median(float(x) for x in durations) if durations else DEFAULT_JOB_SECONDS
+    # 再試行待ちのジョブもいずれworkerの手を塞ぐので待ち行列に数える
+    return {"queue_length": queue_length + delayed, "workers": workers, "job_seconds": job_seconds}
+
+def estimate_wait(jobs_ahead: int, stats: dict) -> float:
+    # 自分より前のジョブを稼働中worker数で割った「周回数」+ 自分の処理時間
+    workers = max(stats["workers"], 1)
+    return (jobs_ahead // workers + 1) * stats["job_seconds"]
+
+def eta_fields(wait_seconds: float, now: float) -> dict:
+    return {"eta_seconds": round(wait_seconds, 1), "estimated_done_at": round(now + wait_seconds, 1)}
+
+async def admit_scan() -> tuple[str | None, dict]:
+    """
+    受付制御。推定待ち時間が閾値を超えていれば ADMISSION_POLICY に従って
+    429 (Retry-After付き) を返すか、軽量プロファイル("fast")で受け付ける。
+    """
+    stats = await queue_stats()
+    now = time.time()
+    wait = estimate_wait(stats["queue_length"], stats)
+    profile = None
+    if wait > ADMISSION_MAX_WAIT:
+        if ADMISSION_POLICY == "reject":
+            retry_after = max(int(wait - ADMISSION_MAX_WAIT), 1)
+            raise HTTPException(
+                429,
+                {"status": "busy", **eta_fields(wait, now)},
+                headers={"Retry-After": str(retry_after)},
+            )
+        if ADMISSION_POLICY == "degrade":
+            profile = "fast"
+    return profile, eta_fields(wait, now)
+
+async def scan_eta(scan_id: str, d: dict) -> dict:
+    status = d.get("status")
+    if status not in ("queued", "processing"):
+        return {}
+    stats = await queue_stats()
+    now = time.time()
+    if status == "processing":
+        started_at = float(d.get("started_at") or now)
+        return eta_fields(max(started_at + stats["job_seconds"] - now, 0), now)
+    if not d.get("queue_score"):
+        return eta_fields(estimate_wait(stats["queue_length"], stats), now)
+    # レーンをまたいだ正確な順番はworkerの重み付き選択で決まるので、
+    # 「どのレーンでも自分よりスコアの小さいジョブ」を先に処理される件数とみなす
+    score = float(d["queue_score"])
+    async with r.pipeline(transaction=False) as pipe:
+        for lane in SCAN_LANES:
+            pipe.zcount(key_lane(lane), "-inf", f"({score}")
+        jobs_ahead = sum(await pipe.execute())
+    return eta_fields(estimate_wait(jobs_ahead, stats), now)
 
 #スキャンデータのアップロード
+def check_upload_lane(lane: str):
+    if lane not in UPLOAD_LANES:
+        raise HTTPException(400, f"lane must be one of {list(UPLOAD_LANES)}")
+
 @app.post("/scan")
-async def upload_scan(head: UploadFile = File(...)):
+async def upload_scan(head: UploadFile = File(...), lane: str = Query("interactive")):
     if not head.filename.lower().endswith((".glb", ".gltf")):
         raise HTTPException(400, "head must be .glb/.gltf")
+    check_upload_lane(lane)
 
+    # multipartの本文はハンドラの前に受信済みなので、ここで断って省けるのはS3への転送とキュー投入だけ。
+    # 混雑時に送信自体を省きたいクライアントは /scan/upload（バイトを送る前に判定する）を使う
+    profile, eta = await admit_scan()
     scan_id = str(uuid.uuid4())
     create_at = time.time() #時間によるソートを想定
-    r.hset(f"scan:{scan_id}", mapping={"status": "queued", "created_at": create_at})
-    r.zadd("scans:index", {scan_id:create_at})
-    data = await head.read()
+    duplicate_of = None
+
+    async def before_commit(digest: str) -> bool:
+        nonlocal duplicate_of
+        duplicate_of = await claim_content_hash(digest, scan_id, profile)
+        return duplicate_of is None
+
+    try:
+        uploaded = await upload_stream_to_s3(head, key_raw(scan_id), "model/gltf-binary", before_commit=before_commit)
+    except GlbError as e:
+        raise HTTPException(400, f"invalid head: {e}")
+    if duplicate_of:
+        # 同じ内容のscanが既にある: raw/ も worker 処理も増やさず既存のscan_idを返す
+        return {"scan_id": duplicate_of, "duplicate": True}
+
+    await enqueue_scan(
+        scan_id, create_at, sha256=uploaded["sha256"], profile=profile, glb=uploaded["glb"], lane=lane
+    )
+
+    return {"scan_id": scan_id, "profile": profile or "standard", "glb": uploaded["glb"], **eta}
+
+# ---- ダイレクトアップロード（クライアント → S3 を署名付きURLで直接。hubはバイトを中継しない）
+
+class DirectUploadInit(BaseModel):
+    filename: str
+    size: int = Field(..., gt=0)
+    lane: str = "interactive"
+
+def key_upload(scan_id: str) -> str:
+    return f"upload:{scan_id}"
+
+async def presign_upload_part(key: str, upload_id: str, part_number: int) -> str:
+    return await s3_call(
+        s3.generate_presigned_url,
+        ClientMethod="upload_part",
+        Params={"Bucket": S3_BUCKET, "Key": key, "UploadId": upload_id, "PartNumber": part_number},
+        ExpiresIn=DIRECT_UPLOAD_TTL,
+    )
+
+async def list_uploaded_parts(key: str, upload_id: str) -> list[dict]:
+    parts = []
+    marker = 0
+    while True:
+        try:
+            resp = await s3_call(
+                s3.list_parts,
+                Bucket=S3_BUCKET,
+                Key=key,
+                UploadId=upload_id,
+                PartNumberMarker=marker,
+            )
+        except ClientError as e:
+            code = (e.response.get("Error") or {}).get("Code")
+            if code in ("404", "NoSuchUpload"):
+                raise HTTPException(410, "upload expired or aborted")
+            raise
+        parts.extend(resp.get("Parts", []))
+        if not resp.get("IsTruncated"):
+            return parts
+        marker = resp["NextPartNumberMarker"]
+
+async def get_pending_upload(scan_id: str) -> dict:
+    u = await r.hgetall(key_upload(scan_id))
+    if not u:
+        raise HTTPException(404, "upload not found")
+    return u
+
+async def describe_upload(scan_id: str, u: dict) -> dict:
+    # 送信済みパートを返し、未送信パートだけ署名付きURLを発行する（途中から再開できる）
+    sent = await list_uploaded_parts(u["key"], u["upload_id"])
+    sent_numbers = {p["PartNumber"] for p in sent}
+    missing = [n for n in range(1, int(u["parts"]) + 1) if n not in sent_numbers]
+    urls = await asyncio.gather(*(presign_upload_part(u["key"], u["upload_id"], n) for n in missing))
+    return {
+        "scan_id": scan_id,
+        "upload_id": u["upload_id"],
+        "size": int(u["size"]),
+        "part_size": int(u["part_size"]),
+        "uploaded_parts": [
+            {"part_number": p["PartNumber"], "etag": p["ETag"], "size": p["Size"]} for p in sent
+        ],
+        "parts": [{"part_number": n, "url": url} for n, url in zip(missing, urls)],
+        "expires_in": DIRECT_UPLOAD_TTL,
+    }
+
+@app.post("/scan/upload")
+async def start_direct_upload(body: DirectUploadInit):
+    if not body.filename.lower().endswith((".glb", ".gltf")):
+        raise HTTPException(400, "head must be .glb/.gltf")
+    if body.size > DIRECT_UPLOAD_MAX_SIZE:
+        raise HTTPException(413, f"head must be <= {DIRECT_UPLOAD_MAX_SIZE} bytes")
+    check_upload_lane(body.lane)
+    profile, _ = await admit_scan()
+
+    part_size = DIRECT_UPLOAD_PART_SIZE
+    n_parts = -(-body.size // part_size)
+    if n_parts > S3_MAX_PARTS:
+        part_size = -(-body.size // S3_MAX_PARTS)
+        n_parts = -(-body.size // part_size)
+
+    scan_id = str(uuid.uuid4())
+    key = key_raw(scan_id)
+    mpu = await s3_call(s3.create_multipart_upload, Bucket=S3_BUCKET, Key=key, ContentType="model/gltf-binary")
+    u = {
+        "upload_id": mpu["UploadId"],
+        "key": key,
+        "size": body.size,
+        "part_size": part_size,
+        "parts": n_parts,
+        "created_at": time.time(),
+        "lane": body.lane,
+    }
+    if profile:
+        u["profile"] = profile
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.hset(key_upload(scan_id), mapping=u)
+        pipe.expire(key_upload(scan_id), DIRECT_UPLOAD_TTL)
+        await pipe.execute()
 
-    s3.put_object(Bucket=S3_BUCKET, Key=key_raw(scan_id), Body=data, ContentType="model/gltf-binary")
+    return await describe_upload(scan_id, {k: str(v) for k, v in u.items()})
 
-    # キュー投入（Celeryが拾う）
-    r.lpush("queue:scans", scan_id)
+#途中まで送ったアップロードの再開用
+@app.get("/scan/{scan_id}/upload")
+async def resume_direct_upload(scan_id: str):
+    u = await get_pending_upload(scan_id)
+    return await describe_upload(scan_id, u)
 
-    return {"scan_id": scan_id}
+@app.post("/scan/{scan_id}/complete")
+async def complete_direct_upload(scan_id: str):
+    u = await get_pending_upload(scan_id)
+    key, upload_id = u["key"], u["upload_id"]
+    size, n_parts = int(u["size"]), int(u["parts"])
+
+    # クライアント申告のETagは信用せず、S3側に届いているパートで組み立てる
+    sent = await list_uploaded_parts(key, upload_id)
+    sent_numbers = {p["PartNumber"] for p in sent}
+    missing = [n for n in range(1, n_parts + 1) if n not in sent_numbers]
+    if missing:
+        return JSONResponse({"status": "incomplete", "missing_parts": missing}, status_code=409)
+    parts = [p for p in sent if p["PartNumber"] <= n_parts]
+    if sum(p["Size"] for p in parts) != size:
+        return JSONResponse({"status": "size_mismatch", "expected": size}, status_code=409)
+
+    await s3_call(
+        s3.complete_multipart_upload,
+        Bucket=S3_BUCKET,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={"Parts": [{"PartNumber": p["PartNumber"], "ETag": p["ETag"]} for p in parts]},
+    )
+    head = await s3_call(s3.head_object, Bucket=S3_BUCKET, Key=key)
+    if head["ContentLength"] != size:
+        await s3_call(s3.delete_object, Bucket=S3_BUCKET, Key=key)
+        raise HTTPException(409, "uploaded object size mismatch")
+    try:
+        glb = await inspect_s3_glb(key, size)
+    except GlbError as e:
+        # 壊れた入力はworkerに回さず、raw/ も残さない
+        await s3_call(s3.delete_object, Bucket=S3_BUCKET, Key=key)
+        await r.delete(key_upload(scan_id))
+        raise HTTPException(400, f"invalid head: {e}")
+
+    # マルチパートのETagは内容のハッシュではないので、組み立て後のオブジェクトを読んでSHA-256を取る
+    digest = None
+    if DIRECT_UPLOAD_DEDUP:
+        digest = await s3_call(sha256_s3_object, key)
+        duplicate_of = await claim_content_hash(digest, scan_id, u.get("profile"))
+        if duplicate_of:
+            await s3_call(s3.delete_object, Bucket=S3_BUCKET, Key=key)
+            await r.delete(key_upload(scan_id))
+            return {"scan_id": duplicate_of, "duplicate": True}
+
+    await r.delete(key_upload(scan_id))
+    await enqueue_scan(
+        scan_id,
+        float(u["created_at"]),
+        sha256=digest,
+        profile=u.get("profile"),
+        glb=glb,
+        lane=u.get("lane", "interactive"),
+    )
+
+    stats = await queue_stats()
+    return {
+        "scan_id": scan_id,
+        "profile": u.get("profile", "standard"),
+        "glb": glb,
+        **eta_fields(estimate_wait(max(stats["queue_length"] - 1, 0), stats), time.time()),
+    }
+
+@app.delete("/scan/{scan_id}/upload")
+async def abort_direct_upload(scan_id: str):
+    u = await get_pending_upload(scan_id)
+    try:
+        await s3_call(s3.abort_multipart_upload, Bucket=S3_BUCKET, Key=u["key"], UploadId=u["upload_id"])
+    except ClientError as e:
+        code = (e.response.get("Error") or {}).get("Code")
+        if code not in ("404", "NoSuchUpload"):
+            raise
+    await r.delete(key_upload(scan_id))
+    return {"scan_id": scan_id, "status": "aborted"}
 
 #状態の出力
+#完了・失敗したscanをアップロード済みの頭部から作り直す（テンプレート更新時など）
+@app.post("/scan/{scan_id}/reprocess")
+async def reprocess_scan(scan_id: str):
+    d = await r.hgetall(f"scan:{scan_id}")
+    if not d:
+        raise HTTPException(404, "scan_id not found")
+    if d.get("status") not in SCAN_FINAL_STATUSES:
+        raise HTTPException(409, f"scan is {d.get('status')}")
+
+    glb = {k[len("glb_"):]: v for k, v in d.items() if k.startswith("glb_")}
+    now = time.time()
+    score = queue_score(glb, now)
+    # 前回の done/failed より新しい updated_at にする（since=前回の値で待っているクライアントを起こす）
+    now = max(now, float(d.get("updated_at") or 0) + 0.001)
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.hset(
+            f"scan:{scan_id}",
+            mapping={"status": "queued", "updated_at": now, "queue_lane": "reprocess", "queue_score": score, "attempts": 0},
+        )
+        pipe.hdel(f"scan:{scan_id}", "error", "retry_at")
+        for s in SCAN_STATUSES:
+            if s != "queued":
+                pipe.zrem(key_status_index(s), scan_id)
+        pipe.zadd(key_status_index("queued"), {scan_id: float(d.get("created_at") or now)})
+        push_job(pipe, scan_id, "reprocess", score)
+        pipe.publish(
+            SCAN_EVENTS_CHANNEL,
+            json.dumps({"scan_id": scan_id, "event": "status", "status": "queued", "updated_at": now}),
+        )
+        await pipe.execute()
+    return {"scan_id": scan_id, "status": "queued", "lane": "reprocess"}
+
 @app.get("/scan/{scan_id}/status")
-def status(scan_id: str):
-    d = r.hgetall(f"scan:{scan_id}")
+async def status(scan_id: str):
+    d = await r.hgetall(f"scan:{scan_id}")
     if not d:
         raise HTTPException(404, "scan_id not found")
-    return d
+    return {**d, **await scan_eta(scan_id, d)}
+
+def sse_message(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+#状態の変化をServer-Sent Eventsで配信（ポーリングの代わり）
+@app.get("/scan/{scan_id}/events")
+async def events(scan_id: str):
+    # 取りこぼし防止のため、現状を読む前に待ち受けを登録する
+    q = scan_events.listen(scan_id)
+    d = await r.hgetall(f"scan:{scan_id}")
+    if not d:
+        scan_events.unlisten(scan_id, q)
+        raise HTTPException(404, "scan_id not found")
+
+    async def stream():
+        try:
+            yield sse_message("snapshot", {"scan_id": scan_id, **d})
+            if d.get("status") in SCAN_FINAL_STATUSES:
+                return
+            while True:
+                try:
+                    ev = await asyncio.wait_for(q.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse_message(ev.get("event", "status"), ev)
+                if ev.get("event") == "status" and ev.get("status") in SCAN_FINAL_STATUSES:
+                    return
+        finally:
+            scan_events.unlisten(scan_id, q)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+#ロングポーリング: updated_at が since より新しくなるか timeout 秒経つまで待ってから状態を返す
+@app.get("/scan/{scan_id}/wait")
+async def wait_status(
+    scan_id: str,
+    since: float = Query(0),
+    timeout: float = Query(25, gt=0),
+):
+    q = scan_events.listen(scan_id)
+    try:
+        d = await r.hgetall(f"scan:{scan_id}")
+        if not d:
+            raise HTTPException(404, "scan_id not found")
+        if float(d.get("updated_at") or d.get("created_at") or 0) > since or d.get("status") in SCAN_FINAL_STATUSES:
+            return d
+        try:
+            await asyncio.wait_for(q.get(), min(timeout, LONG_POLL_MAX_TIMEOUT))
+        except asyncio.TimeoutError:
+            return d
+        return await r.hgetall(f"scan:{scan_id}")
+    finally:
+        scan_events.unlisten(scan_id, q)
 
 #一覧の出力スキャンidをリストで返す機能の作成
 @app.get("/scans")
-def list_scans(
+async def list_scans(
     limit: int = Query(100, ge=1, le=1000),
     cursor: float | None = Query(None), 
+    status: str | None = Query(None),
 ):
-    max_score = cursor if cursor is not None else "+inf"
-    
-    scan_ids = r.zrevrangebyscore("scans:index", max=max_score, min ="-inf", start = 0, num=limit,withscores=True) 
+    if status is not None and status not in SCAN_STATUSES:
+        raise HTTPException(400, f"status must be one of {list(SCAN_STATUSES)}")
+    index_key = key_status_index(status) if status else "scans:index"
+    max_score = repr(cursor) if cursor is not None else "+inf"
+
+    rows = await list_scans_script(keys=[index_key], args=[max_score, limit, *LIST_SCANS_FIELDS])
     items = []
     next_cursor = None
-    
-    for scan_id, score in scan_ids:
-        d = r.hgetall(f"scan:{scan_id}")
-        items.append({"scan_id":scan_id, "status": d.get("status"), "created_at":float(score)})
+
+    for i in range(0, len(rows), 3):
+        scan_id, score, values = rows[i], float(rows[i + 1]), rows[i + 2]
+        d = dict(zip(LIST_SCANS_FIELDS, values))
+        items.append({"scan_id":scan_id, "status": d.get("status"), "created_at":score})
         next_cursor = score
-    
+
     return {"items": items, "next_cursor": next_cursor if len(items)==limit else None}
 
+class BatchStatusRequest(BaseModel):
+    scan_ids: list[str] = Field(..., min_length=1)
+
+BATCH_STATUS_FIELDS = ("status", "updated_at", "asset_key", "asset_blend_key")
+
+def scan_summary(d: dict) -> dict:
+    # 一括ステータス用の軽い表現。asset*_ready は /asset がURLを返せる状態かどうか
+    done = d.get("status") == "done"
+    return {
+        "status": d.get("status"),
+        "updated_at": float(d["updated_at"]) if d.get("updated_at") else None,
+        "attempts": int(d.get("attempts") or 0),
+        "asset_ready": done and bool(d.get("asset_key")),
+        "asset_blend_ready": done and bool(d.get("asset_blend_key")),
+    }
+
+#複数scanのステータスを1往復で取得（ロビー画面などで使う）
+@app.post("/scans/status")
+async def batch_status(body: BatchStatusRequest):
+    scan_ids = list(dict.fromkeys(body.scan_ids))
+    if len(scan_ids) > BATCH_STATUS_MAX_IDS:
+        raise HTTPException(400, f"at most {BATCH_STATUS_MAX_IDS} scan_ids per request")
+
+    async with r.pipeline(transaction=False) as pipe:
+        for scan_id in scan_ids:
+            pipe.hmget(f"scan:{scan_id}", BATCH_STATUS_FIELDS)
+        rows = await pipe.execute()
+
+    scans = {}
+    for scan_id, values in zip(scan_ids, rows):
+        d = {k: v for k, v in zip(BATCH_STATUS_FIELDS, values) if v is not None}
+        # 存在しないIDは404にせず、結果の中で not_found として返す
+        scans[scan_id] = scan_summary(d) if d.get("status") else {"status": "not_found"}
+    return {"scans": scans}
+
 #scan一覧を取得
 @app.get("/scan/{scan_id}/asset")
-def asset(scan_id: str):
-    d = r.hgetall(f"scan:{scan_id}")
+async def asset(scan_id: str):
+    d = await r.hgetall(f"scan:{scan_id}")
     if not d:
         raise HTTPException(404, "scan_id not found")
     if d.get("status") != "done":
         return JSONResponse({"status": d.get("status", "unknown")}, status_code=409)
 
-    for key in candidate_out_keys(scan_id, d):
-        if head_object_exists(key):
-            url = s3.generate_presigned_url(
-                ClientMethod="get_object",
-                Params={"Bucket": S3_BUCKET, "Key": key},
-                ExpiresIn=60 * 10,
-            )
-            return {"download_url": url, "key": key}
+    key = await resolve_asset_key(d, "asset", candidate_out_keys(scan_id, d))
+    if key:
+        url = await presign_get(key, d.get("asset_etag", ""))
+        return {"download_url": url, "key": key}
 
     # doneなのに実体がない: hub側は落とさずクライアントに伝える
     return JSONResponse({"status": "missing_asset"}, status_code=409)
 
 @app.get("/scan/{scan_id}/asset/blend")
-def asset_blend(scan_id: str):
-    d = r.hgetall(f"scan:{scan_id}")
+async def asset_blend(scan_id: str):
+    d = await r.hgetall(f"scan:{scan_id}")
     if not d:
         raise HTTPException(404, "scan_id not found")
     if d.get("status") != "done":
         return JSONResponse({"status": d.get("status", "unknown")}, status_code=409)
 
-    for key in candidate_blend_out_keys(scan_id, d):
-        if head_object_exists(key):
-            url = s3.generate_presigned_url(
-                ClientMethod="get_object",
-                Params={"Bucket": S3_BUCKET, "Key": key},
-                ExpiresIn=60 * 10,
-            )
-            return {"download_url": url, "key": key}
+    key = await resolve_asset_key(d, "asset_blend", candidate_blend_out_keys(scan_id, d))
+    if key:
+        url = await presign_get(key, d.get("asset_blend_etag", ""))
+        return {"download_url": url, "key": key}
 
     return JSONResponse({"status": "missing_asset"}, status_code=409)
 
-@app.get("/scan/{scan_id}/download")
-def download(scan_id: str):
-    d = r.hgetall(f"scan:{scan_id}")
-    if not d or d.get("status") != "done":
-        raise HTTPException(404, "not ready")
+def etag_matches(header: str | None, etag: str) -> bool:
+    # If-None-Match / If-Range の比較（弱いETag "W/" は無視して比べる）
+    if not header or not etag:
+        return False
+    if header.strip() == "*":
+        return True
+    strip = lambda t: t.strip().removeprefix("W/")
+    return strip(etag) in {strip(t) for t in header.split(",")}
+
+async def stream_asset(
+    request: Request,
+    scan_meta: dict,
+    prefix: str,
+    candidates: list[str],
+    content_type_of,
+    filename_of,
+):
+    """
+    成果物をS3からストリーミングで返す。Range(206/416)とIf-None-Match(304)に対応し、
+    workerが記録したETagがあれば304はS3に問い合わせずに返す。
+    """
+    range_header = request.headers.get("range")
+    if_none_match = request.headers.get("if-none-match")
+    if_range = request.headers.get("if-range")
+    known_etag = scan_meta.get(f"{prefix}_etag", "")
+    cache_headers = {"Cache-Control": ASSET_CACHE_CONTROL, "Accept-Ranges": "bytes"}
 
-    last_err: Exception | None = None
-    for key in candidate_out_keys(scan_id, d):
+    if known_etag and etag_matches(if_none_match, known_etag):
+        return Response(status_code=304, headers={**cache_headers, "ETag": known_etag})
+    # If-Range が一致しない（または照合できない）場合はRangeを無視して全体を返す
+    if range_header and if_range and not etag_matches(if_range, known_etag):
+        range_header = None
+
+    for key in candidates:
+        params = {"Bucket": S3_BUCKET, "Key": key}
+        if range_header:
+            params["Range"] = range_header
+        if if_none_match:
+            params["IfNoneMatch"] = if_none_match
         try:
-            obj = s3.get_object(Bucket=S3_BUCKET, Key=key)
-            content_type = guess_content_type(key, d)
-            filename = guess_filename(scan_id, key, d)
-            return StreamingResponse(
-                obj["Body"],
-                media_type=content_type,
-                headers={"Content-Disposition": f'attachment; filename="{filename}"'},
-            )
+            obj = await s3_call(s3.get_object, **params)
         except ClientError as e:
             code = (e.response.get("Error") or {}).get("Code")
+            http_status = (e.response.get("ResponseMetadata") or {}).get("HTTPStatusCode")
             if code in ("404", "NoSuchKey", "NotFound"):
-                last_err = e
                 continue
+            if code in ("304", "NotModified") or http_status == 304:
+                headers = {**cache_headers, "ETag": known_etag} if known_etag else cache_headers
+                return Response(status_code=304, headers=headers)
+            if code == "InvalidRange" or http_status == 416:
+                size = scan_meta.get(f"{prefix}_size")
+                headers = {"Content-Range": f"bytes */{size}"} if size else {}
+                return Response(status_code=416, headers=headers)
             raise
 
+        headers = {
+            **cache_headers,
+            "Content-Disposition": f'attachment; filename="{filename_of(key)}"',
+            "Content-Length": str(obj["ContentLength"]),
+            "ETag": obj["ETag"],
+        }
+        if obj.get("LastModified"):
+            # botocoreは dateutil の tzutc を付けて返すので、usegmt が受け付ける timezone.utc に直す
+            headers["Last-Modified"] = format_datetime(obj["LastModified"].astimezone(timezone.utc), usegmt=True)
+        status_code = 200
+        if obj.get("ContentRange"):
+            headers["Content-Range"] = obj["ContentRange"]
+            status_code = 206
+        return StreamingResponse(
+            iter_s3_body(obj["Body"]),
+            status_code=status_code,
+            media_type=content_type_of(key),
+            headers=headers,
+        )
+
     return JSONResponse({"status": "missing_asset"}, status_code=409)
 
-@app.get("/scan/{scan_id}/download/blend")
-def download_blend(scan_id: str):
-    d = r.hgetall(f"scan:{scan_id}")
+@app.get("/scan/{scan_id}/download")
+async def download(scan_id: str, request: Request):
+    d = await r.hgetall(f"scan:{scan_id}")
     if not d or d.get("status") != "done":
         raise HTTPException(404, "not ready")
 
-    for key in candidate_blend_out_keys(scan_id, d):
-        try:
-            obj = s3.get_object(Bucket=S3_BUCKET, Key=key)
-            content_type = guess_content_type_blend(key, d)
-            filename = guess_filename_blend(scan_id, key, d)
-            return StreamingResponse(
-                obj["Body"],
-                media_type=content_type,
-                headers={"Content-Disposition": f'attachment; filename="{filename}"'},
-            )
-        except ClientError as e:
-            code = (e.response.get("Error") or {}).get("Code")
-            if code in ("404", "NoSuchKey", "NotFound"):
-                continue
-            raise
+    return await stream_asset(
+        request,
+        d,
+        "asset",
+        candidate_out_keys(scan_id, d),
+        content_type_of=lambda key: guess_content_type(key, d),
+        filename_of=lambda key: guess_filename(scan_id, key, d),
+    )
 
-    return JSONResponse({"status": "missing_asset"}, status_code=409)
+@app.get("/scan/{scan_id}/download/blend")
+async def download_blend(scan_id: str, request: Request):
+    d = await r.hgetall(f"scan:{scan_id}")
+    if not d or d.get("status") != "done":
+        raise HTTPException(404, "not ready")
+
+    return await stream_asset(
+        request,
+        d,
+        "asset_blend",
+        candidate_blend_out_keys(scan_id, d),
+        content_type_of=lambda key: guess_content_type_blend(key, d),
+        filename_of=lambda key: guess_filename_blend(scan_id, key, d),
+    )
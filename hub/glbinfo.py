@@ -0,0 +1,283 @@
+"""
+GLB/glTF の軽量インスペクタ。
+
+アップロードをチャンク単位で feed() しながら、12バイトのヘッダとJSONチャンクだけを読み、
+チャンク長・参照の整合性を検査してメッシュ数・頂点数・テクスチャ量などを集計する。
+バイナリチャンク(BIN)の中身はデコードせず読み飛ばすので、メモリはJSONチャンク分しか使わない。
+"""
+import json
+import struct
+
+GLB_MAGIC = b"glTF"
+CHUNK_JSON = 0x4E4F534A
+CHUNK_BIN = 0x004E4942
+
+# primitive.mode -> 三角形数の数え方
+MODE_TRIANGLES = 4
+MODE_TRIANGLE_STRIP = 5
+MODE_TRIANGLE_FAN = 6
+
+
+class GlbError(ValueError):
+    pass
+
+
+class GlbInspector:
+    def __init__(
+        self,
+        max_json_bytes: int = 64 * 1024 * 1024,
+        max_triangles: int | None = None,
+        max_vertices: int | None = None,
+    ):
+        self.max_json_bytes = max_json_bytes
+        self.max_triangles = max_triangles
+        self.max_vertices = max_vertices
+        self.buf = bytearray()
+        self.state = "header"  # header | chunk_header | json | skip | json_text | done
+        self.need = 12
+        self.skip_left = 0
+        self.offset = 0  # 消費済みバイト数（bufに溜めている途中の分は含まない）
+        self.fed = 0
+        self.length: int | None = None
+        self.doc: dict | None = None
+        self.json_length = 0
+        self.bin_length: int | None = None
+
+    def feed(self, data: bytes):
+        self.fed += len(data)
+        if self.length is not None and self.fed > self.length:
+            raise GlbError(f"data continues past the declared GLB length ({self.length} bytes)")
+        mv = memoryview(data)
+        while mv:
+            if self.state == "skip":
+                n = min(self.skip_left, len(mv))
+                self.skip_left -= n
+                self.offset += n
+                mv = mv[n:]
+                if self.skip_left == 0:
+                    self._expect_chunk_header()
+                continue
+            if self.state == "json_text":
+                self.buf += mv
+                if len(self.buf) > self.max_json_bytes:
+                    raise GlbError(f"glTF JSON exceeds {self.max_json_bytes} bytes")
+                return
+            if self.state == "done":
+                raise GlbError("data after the last GLB chunk")
+            n = min(self.need - len(self.buf), len(mv))
+            self.buf += mv[:n]
+            mv = mv[n:]
+            if len(self.buf) < self.need:
+                return
+            chunk = bytes(self.buf)
+            self.buf.clear()
+            self._consume(chunk)
+
+    def _expect_chunk_header(self):
+        if self.offset == self.length:
+            self.state = "done"
+        else:
+            self.state = "chunk_header"
+            self.need = 8
+
+    def _consume(self, data: bytes):
+        start = self.offset
+        self.offset += len(data)
+        if self.state == "header":
+            if data[:4] != GLB_MAGIC:
+                if data.lstrip()[:1] == b"{":
+                    # .gltf (JSON) がそのまま送られてきた
+                    self.state = "json_text"
+                    self.buf += data
+                    return
+                raise GlbError("not a GLB file (bad magic)")
+            _, version, length = struct.unpack("<4sII", data)
+            if version != 2:
+                raise GlbError(f"unsupported GLB version {version}")
+            if length < 20:
+                raise GlbError(f"GLB length {length} is too small")
+            if self.fed > length:
+                raise GlbError(f"data continues past the declared GLB length ({length} bytes)")
+            self.length = length
+            self._expect_chunk_header()
+        elif self.state == "chunk_header":
+            chunk_length, chunk_type = struct.unpack("<II", data)
+            if start + 8 + chunk_length > self.length:
+                raise GlbError(f"chunk at offset {start} ({chunk_length} bytes) exceeds the GLB length")
+            if self.doc is None:
+                if chunk_type != CHUNK_JSON:
+                    raise GlbError("first GLB chunk is not JSON")
+                if chunk_length > self.max_json_bytes:
+                    raise GlbError(f"GLB JSON chunk exceeds {self.max_json_bytes} bytes")
+                self.json_length = chunk_length
+                self.state = "json"
+                self.need = chunk_length
+                if chunk_length == 0:
+                    raise GlbError("GLB JSON chunk is empty")
+                return
+            if chunk_type == CHUNK_BIN:
+                if self.bin_length is not None:
+                    raise GlbError("GLB has more than one BIN chunk")
+                self.bin_length = chunk_length
+            self.skip_left = chunk_length
+            self.state = "skip"
+            if chunk_length == 0:
+                self._expect_chunk_header()
+        elif self.state == "json":
+            self.doc = parse_json(data)
+            # 頂点数・三角形数はJSONだけで分かるので、BINを受け取る前に上限を判定する
+            self.check_limits(count_geometry(self.doc))
+            self._expect_chunk_header()
+
+    def check_limits(self, geometry: dict):
+        if self.max_triangles is not None and geometry["triangles"] > self.max_triangles:
+            raise GlbError(f"too many triangles: {geometry['triangles']} > {self.max_triangles}")
+        if self.max_vertices is not None and geometry["vertices"] > self.max_vertices:
+            raise GlbError(f"too many vertices: {geometry['vertices']} > {self.max_vertices}")
+
+    def finish(self, total_size: int | None = None) -> dict:
+        """
+        検査を終えて統計を返す。total_size を渡すと、先頭部分(ヘッダ+JSON+次のチャンクヘッダ)
+        だけを feed した場合でも残りはBINチャンクとして長さだけ照合する（S3上の実体の検査用）。
+        """
+        if self.state == "json_text" or (self.state == "header" and self.buf.lstrip()[:1] == b"{"):
+            self.doc = parse_json(bytes(self.buf))
+            self.json_length = len(self.buf)
+            self.check_limits(count_geometry(self.doc))
+            return analyze(self.doc, bin_length=None, total_bytes=total_size or self.fed, json_bytes=self.json_length)
+
+        total = self.fed if total_size is None else total_size
+        if self.length is None:
+            raise GlbError("truncated GLB header")
+        if total != self.length:
+            raise GlbError(f"GLB length mismatch: header says {self.length} bytes, got {total}")
+        if self.doc is None:
+            raise GlbError("truncated GLB JSON chunk")
+        if total_size is None:
+            if self.state != "done":
+                raise GlbError("truncated GLB chunk")
+        elif self.state == "skip":
+            if self.offset + self.skip_left > self.length:
+                raise GlbError("truncated GLB chunk")
+        elif self.state != "done" and self.buf:
+            raise GlbError("truncated GLB chunk header")
+        return analyze(self.doc, bin_length=self.bin_length, total_bytes=total, json_bytes=self.json_length)
+
+
+def parse_json(data: bytes) -> dict:
+    try:
+        doc = json.loads(data.decode("utf-8").rstrip(" \x00"))
+    except (UnicodeDecodeError, ValueError, RecursionError) as e:
+        raise GlbError(f"invalid glTF JSON: {e}") from e
+    if not isinstance(doc, dict):
+        raise GlbError("glTF JSON root is not an object")
+    return doc
+
+
+# JSONとしては正しくても形が違う（"meshes": [1] など）入力は、AttributeError等ではなく GlbError にする
+def items(obj: dict, name: str, what: str | None = None) -> list[dict]:
+    value = obj.get(name)
+    if value is None:
+        return []
+    what = what or name
+    if not isinstance(value, list):
+        raise GlbError(f"{what} must be an array")
+    for i, item in enumerate(value):
+        if not isinstance(item, dict):
+            raise GlbError(f"{what}[{i}] must be an object")
+    return value
+
+
+def as_int(value, what: str) -> int:
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise GlbError(f"{what} must be a non-negative integer")
+    return value
+
+
+def ref(array: list, idx, what: str) -> dict:
+    if not isinstance(idx, int) or isinstance(idx, bool) or not 0 <= idx < len(array):
+        raise GlbError(f"{what} index {idx!r} is out of range")
+    return array[idx]
+
+
+def count_geometry(doc: dict) -> dict:
+    accessors = items(doc, "accessors")
+    primitives = vertices = indices = triangles = 0
+    for mi, mesh in enumerate(items(doc, "meshes")):
+        for prim in items(mesh, "primitives", f"meshes[{mi}].primitives"):
+            primitives += 1
+            attrs = prim.get("attributes")
+            if not isinstance(attrs, dict) or "POSITION" not in attrs:
+                raise GlbError("mesh primitive without POSITION")
+            n_verts = as_int(ref(accessors, attrs["POSITION"], "POSITION accessor").get("count", 0), "accessor count")
+            vertices += n_verts
+            n = n_verts
+            if "indices" in prim:
+                n = as_int(ref(accessors, prim["indices"], "indices accessor").get("count", 0), "accessor count")
+                indices += n
+            mode = as_int(prim.get("mode", MODE_TRIANGLES), "primitive mode")
+            if mode == MODE_TRIANGLES:
+                triangles += n // 3
+            elif mode in (MODE_TRIANGLE_STRIP, MODE_TRIANGLE_FAN):
+                triangles += max(n - 2, 0)
+    return {"primitives": primitives, "vertices": vertices, "indices": indices, "triangles": triangles}
+
+
+def analyze(doc: dict, bin_length: int | None, total_bytes: int, json_bytes: int = 0) -> dict:
+    """glTF JSON から統計を集計する。インデックス参照と範囲が壊れていれば GlbError"""
+    asset = doc.get("asset")
+    if not isinstance(asset, dict) or not str(asset.get("version", "")).startswith("2"):
+        raise GlbError("glTF asset.version must be 2.x")
+
+    buffers = items(doc, "buffers")
+    buffer_views = items(doc, "bufferViews")
+    accessors = items(doc, "accessors")
+
+    for i, b in enumerate(buffers):
+        length = as_int(b.get("byteLength", 0), f"buffer {i} byteLength")
+        if "uri" not in b:
+            # GLB埋め込みバッファ(BINチャンク)は buffers[0] だけ
+            if i != 0 or bin_length is None:
+                raise GlbError(f"buffer {i} has no uri and no BIN chunk")
+            if length > bin_length:
+                raise GlbError(f"buffer {i} byteLength exceeds the BIN chunk")
+
+    for i, bv in enumerate(buffer_views):
+        b = ref(buffers, bv.get("buffer"), f"bufferView {i} buffer")
+        end = as_int(bv.get("byteOffset", 0), f"bufferView {i} byteOffset") + as_int(
+            bv.get("byteLength", 0), f"bufferView {i} byteLength"
+        )
+        if end > b.get("byteLength", 0):
+            raise GlbError(f"bufferView {i} exceeds its buffer")
+
+    for i, acc in enumerate(accessors):
+        if "bufferView" in acc:
+            ref(buffer_views, acc["bufferView"], f"accessor {i} bufferView")
+
+    meshes = items(doc, "meshes")
+    geometry = count_geometry(doc)
+
+    images = items(doc, "images")
+    image_bytes = 0
+    external_images = 0
+    for i, img in enumerate(images):
+        uri = img.get("uri")
+        if "bufferView" in img:
+            image_bytes += ref(buffer_views, img["bufferView"], f"image {i} bufferView").get("byteLength", 0)
+        elif isinstance(uri, str) and uri.startswith("data:"):
+            image_bytes += len(uri) * 3 // 4
+        else:
+            external_images += 1
+
+    return {
+        "bytes": total_bytes,
+        "json_bytes": json_bytes,
+        "bin_bytes": bin_length or 0,
+        "meshes": len(meshes),
+        **geometry,
+        "materials": len(items(doc, "materials")),
+        "textures": len(items(doc, "textures")),
+        "images": len(images),
+        "image_bytes": image_bytes,
+        "external_images": external_images,
+    }
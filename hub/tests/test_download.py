@@ -0,0 +1,70 @@
+"""
+/scan/{id}/download の 200/206 と Last-Modified。
+S3は moto（botocoreの実クライアント。LastModified は dateutil の tzutc 付きで返る）、Redisは hgetall だけの代用品。
+"""
+import importlib
+import os
+
+import pytest
+
+pytest.importorskip("fastapi")
+moto = pytest.importorskip("moto")
+from fastapi.testclient import TestClient
+
+BUCKET = "test-bucket"
+BODY = bytes(range(256)) * 1024
+
+class FakeRedis:
+    def __init__(self, hashes: dict):
+        self.hashes = hashes
+
+    async def hgetall(self, key: str) -> dict:
+        return dict(self.hashes.get(key, {}))
+
+@pytest.fixture
+def hub(monkeypatch):
+    monkeypatch.setenv("REDIS_URL", "redis://localhost:6379/0")
+    monkeypatch.setenv("S3_BUCKET", BUCKET)
+    monkeypatch.setenv("AWS_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.delenv("S3_ENDPOINT", raising=False)
+    with moto.mock_aws():
+        import boto3
+
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket=BUCKET)
+        import app
+
+        app = importlib.reload(app)
+        put = app.s3.put_object(Bucket=BUCKET, Key="out/s1/avatar.glb", Body=BODY)
+        monkeypatch.setattr(app, "r", FakeRedis({
+            "scan:s1": {
+                "status": "done",
+                "asset_key": "out/s1/avatar.glb",
+                "asset_etag": put["ETag"],
+                "asset_size": str(len(BODY)),
+            },
+        }))
+        # startup（pub/sub購読）は走らせない
+        yield app, TestClient(app.app)
+
+def test_download_full(hub):
+    _, client = hub
+    resp = client.get("/scan/s1/download")
+    assert resp.status_code == 200
+    assert resp.content == BODY
+    assert resp.headers["last-modified"].endswith(" GMT")
+
+def test_download_range(hub):
+    _, client = hub
+    resp = client.get("/scan/s1/download", headers={"Range": "bytes=0-99"})
+    assert resp.status_code == 206
+    assert resp.content == BODY[:100]
+    assert resp.headers["content-range"] == f"bytes 0-99/{len(BODY)}"
+    assert resp.headers["last-modified"].endswith(" GMT")
+
+def test_download_not_modified(hub):
+    _, client = hub
+    etag = client.get("/scan/s1/download").headers["etag"]
+    resp = client.get("/scan/s1/download", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
@@ -0,0 +1,91 @@
+import json
+import struct
+
+import pytest
+
+from glbinfo import GlbError, GlbInspector
+
+def make_glb(doc: dict, bin_chunk: bytes = b"") -> bytes:
+    json_chunk = json.dumps(doc).encode()
+    json_chunk += b" " * (-len(json_chunk) % 4)
+    bin_chunk += b"\x00" * (-len(bin_chunk) % 4)
+    total = 12 + 8 + len(json_chunk) + (8 + len(bin_chunk) if bin_chunk else 0)
+    out = struct.pack("<4sII", b"glTF", 2, total) + struct.pack("<II", len(json_chunk), 0x4E4F534A) + json_chunk
+    if bin_chunk:
+        out += struct.pack("<II", len(bin_chunk), 0x004E4942) + bin_chunk
+    return out
+
+def triangle_doc() -> dict:
+    return {
+        "asset": {"version": "2.0"},
+        "buffers": [{"byteLength": 36}],
+        "bufferViews": [{"buffer": 0, "byteOffset": 0, "byteLength": 36}],
+        "accessors": [{"bufferView": 0, "componentType": 5126, "count": 3, "type": "VEC3"}],
+        "meshes": [{"primitives": [{"attributes": {"POSITION": 0}}]}],
+    }
+
+def inspect(data: bytes, chunk: int | None = None) -> dict:
+    inspector = GlbInspector()
+    step = chunk or len(data)
+    for i in range(0, len(data), step):
+        inspector.feed(data[i:i + step])
+    return inspector.finish()
+
+def test_valid_glb():
+    stats = inspect(make_glb(triangle_doc(), b"\x00" * 36))
+    assert stats["meshes"] == 1
+    assert stats["vertices"] == 3
+    assert stats["triangles"] == 1
+
+def test_valid_glb_fed_in_small_chunks():
+    assert inspect(make_glb(triangle_doc(), b"\x00" * 36), chunk=5)["triangles"] == 1
+
+def patched(**changes) -> dict:
+    doc = triangle_doc()
+    doc.update(changes)
+    return doc
+
+@pytest.mark.parametrize("doc", [
+    patched(meshes=[1]),
+    patched(meshes={}),
+    patched(meshes=[{"primitives": {}}]),
+    patched(meshes=[{"primitives": [1]}]),
+    patched(meshes=[{"primitives": [{"attributes": []}]}]),
+    patched(meshes=[{"primitives": [{"attributes": {"POSITION": "0"}}]}]),
+    patched(meshes=[{"primitives": [{"attributes": {"POSITION": True}}]}]),
+    patched(meshes=[{"primitives": [{"attributes": {"POSITION": 0}, "mode": "x"}]}]),
+    patched(accessors=["x"]),
+    patched(accessors=[{"bufferView": 0, "count": "3"}]),
+    patched(accessors=[{"bufferView": 0, "count": -1}]),
+    patched(buffers=[1]),
+    patched(buffers=[{"byteLength": "36"}]),
+    patched(bufferViews=[{"buffer": 0, "byteOffset": None, "byteLength": 36}]),
+    patched(bufferViews="x"),
+    patched(images=[1]),
+    patched(materials=[1]),
+    patched(textures={"a": 1}),
+    patched(asset=[]),
+])
+def test_malformed_shapes_raise_glb_error(doc):
+    with pytest.raises(GlbError):
+        inspect(make_glb(doc, b"\x00" * 36))
+
+def test_deeply_nested_json_raises_glb_error():
+    doc = b'{"asset": {"version": "2.0"}, "extras": ' + b"[" * 100000 + b"]" * 100000 + b"}"
+    inspector = GlbInspector()
+    inspector.feed(doc)
+    with pytest.raises(GlbError):
+        inspector.finish()
+
+def test_gltf_json_with_wrong_shapes():
+    inspector = GlbInspector()
+    inspector.feed(json.dumps(patched(meshes=[{"primitives": {}}])).encode())
+    with pytest.raises(GlbError):
+        inspector.finish()
+
+def test_truncated_glb():
+    data = make_glb(triangle_doc(), b"\x00" * 36)
+    inspector = GlbInspector()
+    inspector.feed(data[:-4])
+    with pytest.raises(GlbError):
+        inspector.finish()
@@ -1,13 +1,36 @@
 # attach_head.py
 import argparse
+import hashlib
 import json
 import os
+import resource
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+import time
+import traceback
+from contextlib import contextmanager
 import bpy
-from mathutils import Vector, Euler
+import numpy as np
+from mathutils import Matrix, Vector, Euler
 
 import sys
 print("RAW ARGV:", sys.argv)
 
+# シーンのダンプなどの詳細ログ（ATTACH_HEAD_VERBOSE=1 のときだけ出す）
+VERBOSE = os.environ.get("ATTACH_HEAD_VERBOSE", "false").lower() in ("1", "true", "yes")
+
+def debug(*args):
+    if VERBOSE:
+        print(*args)
+
+# 頂点単位の処理(変換の焼き込み・ウェイト付け・親子付け)を foreach_get/foreach_set + NumPy で行うか。
+# false なら従来どおり bpy.ops の演算子を使う（結果は同じ。比較用）。ジョブの bulk_ops で上書きできる
+BULK_OPS_DEFAULT = os.environ.get("ATTACH_HEAD_BULK_OPS", "true").lower() in ("1", "true", "yes")
+BULK_OPS = BULK_OPS_DEFAULT
+
 def reset_scene():
     bpy.ops.wm.read_factory_settings(use_empty=True)
 
@@ -65,6 +88,64 @@ def apply_decimate(obj, ratio: float):
     bpy.context.view_layer.objects.active = obj
     bpy.ops.object.modifier_apply(modifier=mod.name)
 
+def material_images(obj) -> set:
+    # オブジェクトのマテリアルのノードが参照している画像
+    images = set()
+    for slot in obj.material_slots:
+        mat = slot.material
+        if mat and mat.use_nodes and mat.node_tree:
+            images.update(n.image for n in mat.node_tree.nodes if n.type == 'TEX_IMAGE' and n.image)
+    return images
+
+def image_bytes(img) -> int:
+    return img.packed_file.size if img.packed_file else 0
+
+def process_textures(head_obj, imported_images: set, max_size: int, drop_unused: bool) -> dict:
+    """
+    頭部と一緒に読み込んだテクスチャを縮小する（長辺 max_size。0なら縮小しない）。
+    縮小した画像は元の形式のままパックし直すので、一時.blend経由で2つ目以降のテンプレートにも同じ画像が付く。
+    再エンコード（JPEG/WebP・品質）は書き出し時に export_gltf で行う
+    """
+    used = material_images(head_obj)
+    stats = {"texture_images": 0, "texture_bytes": 0, "texture_max_dim": 0, "textures_resized": 0, "textures_dropped": 0}
+    for img in list(imported_images):
+        if img not in used:
+            if drop_unused:
+                print(f"Removing unused image: {img.name}")
+                bpy.data.images.remove(img)
+                stats["textures_dropped"] += 1
+            continue
+        w, h = img.size
+        stats["texture_images"] += 1
+        stats["texture_bytes"] += image_bytes(img)
+        stats["texture_max_dim"] = max(stats["texture_max_dim"], w, h)
+        if max_size and max(w, h) > max_size:
+            scale = max_size / max(w, h)
+            new_w, new_h = max(int(round(w * scale)), 1), max(int(round(h * scale)), 1)
+            file_format = img.file_format
+            img.scale(new_w, new_h)
+            img.file_format = file_format
+            img.pack()
+            print(f"Resized texture {img.name}: {w}x{h} -> {new_w}x{new_h}")
+            stats["textures_resized"] += 1
+    # 処理後（縮小・パックし直した後）の頭部テクスチャのバイト数
+    stats["texture_bytes_processed"] = sum(image_bytes(img) for img in material_images(head_obj))
+    return stats
+
+def glb_image_bytes(path: str) -> int | None:
+    # 書き出したGLBのJSONチャンクから、埋め込み画像のバイト数を合計する
+    try:
+        with open(path, "rb") as f:
+            magic, _, _ = struct.unpack("<4sII", f.read(12))
+            if magic != b"glTF":
+                return None
+            length, _ = struct.unpack("<II", f.read(8))
+            doc = json.loads(f.read(length))
+    except (OSError, ValueError, struct.error):
+        return None
+    views = doc.get("bufferViews") or []
+    return sum(views[img["bufferView"]].get("byteLength", 0) for img in doc.get("images") or [] if "bufferView" in img)
+
 def load_calib(path: str | None):
     if not path:
         return None
@@ -85,6 +166,91 @@ def apply_transform(obj, calib: dict | None):
         tx, ty, tz = calib["translation"]
         obj.location = Vector((tx, ty, tz))
 
+def select_only(obj):
+    bpy.ops.object.select_all(action='DESELECT')
+    obj.select_set(True)
+    bpy.context.view_layer.objects.active = obj
+
+def transform_coords(elements, matrix: np.ndarray):
+    # vertices / shape key の co をまとめて読み、4x4行列を掛けて書き戻す
+    n = len(elements)
+    co = np.empty(n * 3, dtype=np.float32)
+    elements.foreach_get("co", co)
+    co = co.reshape(n, 3).astype(np.float64) @ matrix[:3, :3].T + matrix[:3, 3]
+    elements.foreach_set("co", co.astype(np.float32).ravel())
+
+def read_corner_normals(mesh) -> np.ndarray:
+    # 面の角(ループ)ごとの法線。Blender 4.1 からは corner_normals、それより前は calc_normals_split してから loops で読む
+    n = len(mesh.loops)
+    normals = np.empty(n * 3, dtype=np.float32)
+    if hasattr(mesh, "corner_normals"):
+        mesh.corner_normals.foreach_get("vector", normals)
+    else:
+        mesh.calc_normals_split()
+        mesh.loops.foreach_get("normal", normals)
+    return normals.reshape(n, 3)
+
+def bake_mesh_transform(obj, location: bool = True, rotation: bool = True, scale: bool = True):
+    """
+    transform_apply 相当（メッシュ）。オブジェクトの変換のうち指定した成分を頂点座標へ焼き込み、
+    オブジェクト側はその成分を単位に戻す。
+    カスタム法線（glTFから読んだ頭部はほぼ必ず持つ）は、変換の逆転置行列を掛けて設定し直す。
+    """
+    if not BULK_OPS:
+        select_only(obj)
+        bpy.ops.object.transform_apply(location=location, rotation=rotation, scale=scale)
+        return
+
+    loc, rot, sca = obj.matrix_basis.decompose()
+    applied = Matrix.LocRotScale(loc if location else None, rot if rotation else None, sca if scale else None)
+    kept = Matrix.LocRotScale(None if location else loc, None if rotation else rot, None if scale else sca)
+    mesh = obj.data
+    if applied.determinant() <= 0:
+        # 面の反転が要る場合は、演算子と同じBlender側の処理に任せる
+        mesh.transform(applied, shape_keys=True)
+        obj.matrix_basis = kept
+        return
+
+    m = np.array(applied, dtype=np.float64)
+    # カスタム法線は頂点を動かす前に読む（動かした後は新しい形状を基準に解釈されてしまう）
+    normals = read_corner_normals(mesh).astype(np.float64) if mesh.has_custom_normals else None
+    transform_coords(mesh.vertices, m)
+    if mesh.shape_keys:
+        for kb in mesh.shape_keys.key_blocks:
+            transform_coords(kb.data, m)
+    mesh.update()
+    if normals is not None:
+        normals = normals @ np.linalg.inv(m[:3, :3])
+        length = np.linalg.norm(normals, axis=1, keepdims=True)
+        normals /= np.where(length > 0, length, 1)
+        mesh.normals_split_custom_set(normals.astype(np.float32))
+    obj.matrix_basis = kept
+
+def bake_armature_scale(arm_obj):
+    # transform_apply(scale=True) 相当（アーマチュア）。ボーンのレスト位置へスケールを焼き込む
+    if not BULK_OPS:
+        select_only(arm_obj)
+        bpy.ops.object.transform_apply(location=False, rotation=False, scale=True)
+        return
+    loc, rot, sca = arm_obj.matrix_basis.decompose()
+    arm_obj.data.transform(Matrix.LocRotScale(None, None, sca))
+    arm_obj.matrix_basis = Matrix.LocRotScale(loc, rot, None)
+
+def parent_keep_transform(child, parent):
+    # parent_set(type='OBJECT', keep_transform=True) 相当
+    if not BULK_OPS:
+        bpy.ops.object.select_all(action='DESELECT')
+        child.select_set(True)
+        parent.select_set(True)
+        bpy.context.view_layer.objects.active = parent
+        bpy.ops.object.parent_set(type='OBJECT', keep_transform=True)
+        return
+    world = child.matrix_world.copy()
+    child.parent = parent
+    child.parent_type = 'OBJECT'
+    child.matrix_parent_inverse = parent.matrix_world.inverted()
+    child.matrix_world = world
+
 def parent_to_head_bone(head_obj, armature_obj, head_bone_name: str):
     if head_bone_name not in armature_obj.data.bones:
         raise RuntimeError(f"Head bone '{head_bone_name}' not found. Bones: {[b.name for b in armature_obj.data.bones][:10]}...")
@@ -131,16 +297,13 @@ def rigid_skin_to_bone(head_obj, armature_obj, bone_name: str):
     vg = head_obj.vertex_groups.get(bone_name)
     if vg is None:
         vg = head_obj.vertex_groups.new(name=bone_name)
-    all_verts = list(range(len(head_obj.data.vertices)))
-    if all_verts:
-        vg.add(all_verts, 1.0, 'REPLACE')
+    # ウェイトには foreach 系のAPIがないので、全頂点を1回の add で渡す（range ならリストを作らない）
+    n_verts = len(head_obj.data.vertices)
+    if n_verts:
+        vg.add(range(n_verts), 1.0, 'REPLACE')
 
     # オブジェクト親はArmatureに（keep_transformで見た目維持）
-    bpy.ops.object.select_all(action='DESELECT')
-    head_obj.select_set(True)
-    armature_obj.select_set(True)
-    bpy.context.view_layer.objects.active = armature_obj
-    bpy.ops.object.parent_set(type='OBJECT', keep_transform=True)
+    parent_keep_transform(head_obj, armature_obj)
 
 def resolve_bone_name(armature_obj, requested: str) -> str:
     requested = (requested or "").strip()
@@ -184,10 +347,10 @@ def delete_template_head_mesh(armature_obj, head_bone_name: str):
       もしくは 'head' を含むメッシュ名を削除。
     - Icosphere(デバッグ用の球)も削除
     """
-    print("DEBUG: delete_template_head_mesh - All MESH objects in scene:")
+    debug("DEBUG: delete_template_head_mesh - All MESH objects in scene:")
     for obj in bpy.data.objects:
         if obj.type == "MESH":
-            print(f"  - {obj.name} (lower: {obj.name.lower()})")
+            debug(f"  - {obj.name} (lower: {obj.name.lower()})")
 
     candidates = []
     for obj in bpy.data.objects:
@@ -196,9 +359,9 @@ def delete_template_head_mesh(armature_obj, head_bone_name: str):
             # "body" まで消すとテンプレ全体が消えることがあるので除外する
             if "head" in n or "face" in n or "hair" in n or "eye" in n or "skull" in n or "beard" in n or "ico" in n or "sphere" in n or "body" in n:
                 candidates.append(obj)
-                print(f"DEBUG: Matched deletion candidate: {obj.name}")
+                debug(f"DEBUG: Matched deletion candidate: {obj.name}")
 
-    print(f"DEBUG: Total deletion candidates: {len(candidates)}")
+    debug(f"DEBUG: Total deletion candidates: {len(candidates)}")
     # 候補がなければ何もしない（Unity側で頭を隠してもいい）
     for obj in candidates:
         print(f"Deleting template mesh: {obj.name}")
@@ -221,7 +384,20 @@ def export_fbx(path: str):
     )
 
 
-def export_gltf(path: str, selected_only: bool = False):
+# 圧縮設定(compression["draco"]) -> Blender glTFエクスポータの引数
+DRACO_EXPORT_ARGS = {
+    "level": "export_draco_mesh_compression_level",
+    "position_bits": "export_draco_position_quantization",
+    "normal_bits": "export_draco_normal_quantization",
+    "texcoord_bits": "export_draco_texcoord_quantization",
+    "color_bits": "export_draco_color_quantization",
+    "generic_bits": "export_draco_generic_quantization",  # ジョイント・ウェイトなど
+}
+
+def export_gltf(
+    path: str, selected_only: bool = False, compression: dict | None = None, textures: dict | None = None
+) -> str:
+    """GLB/glTFを書き出し、実際に掛かった圧縮("draco" / "none")を返す"""
     # GLBエクスポート時はメッシュとアーマチュアのみエクスポート
     # カメラ、ライト、Emptyオブジェクトなどを除外
     kwargs = dict(
@@ -239,22 +415,73 @@ def export_gltf(path: str, selected_only: bool = False):
         export_all_influences=True,
         export_morph=True,
     )
+    # テクスチャの形式(auto: 元の形式 / jpeg / webp)と品質。alphaが必要な画像はjpeg指定でもPNGになる
+    textures = textures or {}
+    if textures.get("format") and textures["format"] != "auto":
+        kwargs["export_image_format"] = textures["format"].upper()
+    if textures.get("quality"):
+        kwargs["export_image_quality"] = int(textures["quality"])
+    draco = (compression or {}).get("codec") == "draco"
+    if draco:
+        kwargs["export_draco_mesh_compression_enable"] = True
+        kwargs.update({arg: compression[k] for k, arg in DRACO_EXPORT_ARGS.items() if k in compression})
 
     # Blenderのバージョン差で未対応の引数があるので、対応分だけ渡す
     try:
         props = bpy.ops.export_scene.gltf.get_rna_type().properties
-        supported = {p.identifier for p in props}
-        filtered = {k: v for k, v in kwargs.items() if k in supported}
-        dropped = sorted(set(kwargs.keys()) - set(filtered.keys()))
-        if dropped:
-            print(f"NOTE: Dropped unsupported glTF export args: {dropped}")
-        bpy.ops.export_scene.gltf(**filtered)
     except Exception:
         # get_rna_type() が取れない環境向けフォールバック
         bpy.ops.export_scene.gltf(**kwargs)
-
-
-def export_gltf_normalized(path: str, armature_obj, mesh_objs: list, export_selected_only: bool = True):
+        return "draco" if draco else "none"
+    supported = {p.identifier for p in props}
+    filtered = {k: v for k, v in kwargs.items() if k in supported}
+    dropped = sorted(set(kwargs.keys()) - set(filtered.keys()))
+    if dropped:
+        print(f"NOTE: Dropped unsupported glTF export args: {dropped}")
+    # WebP非対応のビルドなど、選べない画像形式なら元の形式(auto)で書き出す
+    image_format = filtered.get("export_image_format")
+    if image_format and image_format not in {item.identifier for item in props["export_image_format"].enum_items}:
+        print(f"NOTE: glTF exporter does not support image format {image_format}; keeping source formats")
+        del filtered["export_image_format"]
+    # Draco非対応のビルドなら非圧縮で書き出す（記録される圧縮も "none" になる）
+    draco = draco and "export_draco_mesh_compression_enable" in filtered
+    bpy.ops.export_scene.gltf(**filtered)
+    return "draco" if draco else "none"
+
+def meshopt_compress(path: str, compression: dict) -> bool:
+    """
+    gltfpack で EXT_meshopt_compression + KHR_mesh_quantization を掛けて path を置き換える。
+    Blenderのエクスポータはmeshoptに対応していないので外部コマンドを使う。gltfpackがなければ非圧縮のまま False
+    """
+    gltfpack = compression.get("gltfpack") or "gltfpack"
+    if not shutil.which(gltfpack):
+        print(f"WARN: {gltfpack} not found; writing {path} without meshopt compression")
+        return False
+    tmp = path + ".meshopt.glb"
+    # -kn/-km/-ke: ノード・マテリアル・extrasを残す（テンプレートの構造をクライアントが参照する）
+    cmd = [gltfpack, "-i", path, "-o", tmp, "-c", "-kn", "-km", "-ke"]
+    for flag, k in (("-vp", "position_bits"), ("-vn", "normal_bits"), ("-vt", "texcoord_bits")):
+        if k in compression:
+            cmd += [flag, str(compression[k])]
+    try:
+        subprocess.run(cmd, check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        print(f"WARN: gltfpack failed; writing {path} without meshopt compression: {e.stderr.strip()}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    os.replace(tmp, path)
+    return True
+
+
+def export_gltf_normalized(
+    path: str,
+    armature_obj,
+    mesh_objs: list,
+    export_selected_only: bool = True,
+    compression: dict | None = None,
+    textures: dict | None = None,
+) -> str:
     """
     FBX由来のArmature scale=0.01 を含んだままglTFに出すと、ビューア側でスキンが崩れることがある。
     ここでは一時複製を作り、スケールだけ焼き込んで (scale=1) から選択エクスポートする。
@@ -277,13 +504,13 @@ def export_gltf_normalized(path: str, armature_obj, mesh_objs: list, export_sele
         arm_copy.data.pose_position = 'REST'
         # リグの操作用カスタムシェイプ（例: Icosphere）がglTFに混入しがちなので無効化
         try:
-            print("DEBUG: Removing custom shapes from pose bones:")
+            debug("DEBUG: Removing custom shapes from pose bones:")
             for pb in arm_copy.pose.bones:
                 if pb.custom_shape:
-                    print(f"  - Bone '{pb.name}' had custom_shape: {pb.custom_shape.name}")
+                    debug(f"  - Bone '{pb.name}' had custom_shape: {pb.custom_shape.name}")
                     pb.custom_shape = None
         except Exception as e:
-            print(f"DEBUG: Error removing custom shapes: {e}")
+            debug(f"DEBUG: Error removing custom shapes: {e}")
 
     mesh_copies = []
     for m in mesh_objs:
@@ -300,15 +527,10 @@ def export_gltf_normalized(path: str, armature_obj, mesh_objs: list, export_sele
         mesh_copies.append(mc)
 
     # スケールだけ焼き込む（location/rotationは維持）
-    def apply_scale(obj):
-        bpy.ops.object.select_all(action='DESELECT')
-        obj.select_set(True)
-        bpy.context.view_layer.objects.active = obj
-        bpy.ops.object.transform_apply(location=False, rotation=False, scale=True)
-
-    apply_scale(arm_copy)
+    if arm_copy.type == "ARMATURE":
+        bake_armature_scale(arm_copy)
     for mc in mesh_copies:
-        apply_scale(mc)
+        bake_mesh_transform(mc, location=False, rotation=False, scale=True)
 
     # glTFエクスポータは「Armatureがスキンメッシュの親」であることを期待する
     for mc in mesh_copies:
@@ -326,22 +548,23 @@ def export_gltf_normalized(path: str, armature_obj, mesh_objs: list, export_sele
     bpy.context.view_layer.objects.active = arm_copy
 
     # デバッグ: エクスポート対象を確認
-    print("DEBUG: Objects selected for GLB export:")
+    debug("DEBUG: Objects selected for GLB export:")
     for obj in bpy.context.selected_objects:
-        print(f"  - {obj.name} (type: {obj.type})")
+        debug(f"  - {obj.name} (type: {obj.type})")
 
     # デバッグ: TMP_GLB_EXPORTコレクション内の全オブジェクトを確認
-    print("DEBUG: All objects in TMP_GLB_EXPORT collection:")
+    debug("DEBUG: All objects in TMP_GLB_EXPORT collection:")
     for obj in tmp_col.objects:
-        print(f"  - {obj.name} (type: {obj.type})")
+        debug(f"  - {obj.name} (type: {obj.type})")
 
-    export_gltf(path, selected_only=export_selected_only)
+    codec = export_gltf(path, selected_only=export_selected_only, compression=compression, textures=textures)
 
     # 後片付け
     for obj in mesh_copies:
         bpy.data.objects.remove(obj, do_unlink=True)
     bpy.data.objects.remove(arm_copy, do_unlink=True)
     bpy.data.collections.remove(tmp_col)
+    return codec
 
 
 
@@ -354,48 +577,374 @@ def parse_after_double_dash(parser: argparse.ArgumentParser):
         script_argv = sys.argv[1:]
     return parser.parse_args(script_argv)
 
+def snapshot_template(path: str, snapshot_dir: str) -> str:
+    # テンプレートFBXを1度だけ読み込み、その状態を.blendとして保存しておく
+    reset_scene()
+    import_fbx(path)
+    snapshot = os.path.join(snapshot_dir, f"template_{len(os.listdir(snapshot_dir))}.blend")
+    bpy.ops.wm.save_as_mainfile(filepath=snapshot, copy=True)
+    print(f"Preloaded template: {path} -> {snapshot}")
+    return snapshot
+
+def load_template(path: str, snapshots: dict | None = None):
+    snapshot = (snapshots or {}).get(path)
+    if snapshot:
+        # 常駐モード: FBXを読み直さず、読み込み済みテンプレートのスナップショットへ戻す
+        bpy.ops.wm.open_mainfile(filepath=snapshot)
+    else:
+        reset_scene()
+        import_fbx(path)
+
+# テンプレートのコンパイル結果(.blend + manifest)の形式。中身を変えたら上げる
+COMPILE_VERSION = 1
+_template_keys: dict = {}
+
+def template_key(path: str, head_bone: str) -> str:
+    # テンプレートFBXの内容・頭ボーン指定・形式・Blenderのバージョンから作るキー（ファイルの更新時刻でキャッシュ）
+    st = os.stat(path)
+    cache_key = (path, st.st_mtime_ns, st.st_size, head_bone)
+    if cache_key not in _template_keys:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        h.update(f"\0{head_bone}\0{COMPILE_VERSION}\0{bpy.app.version_string}".encode())
+        _template_keys[cache_key] = h.hexdigest()
+    return _template_keys[cache_key]
+
+def compiled_paths(path: str, head_bone: str, compiled_dir: str) -> tuple[str, str]:
+    base = os.path.join(compiled_dir, template_key(path, head_bone))
+    return base + ".blend", base + ".json"
+
+def find_compiled(path: str, head_bone: str, compiled_dir: str | None) -> dict | None:
+    """コンパイル済みテンプレートがあれば manifest（"blend" にファイルパス）を返す"""
+    if not compiled_dir:
+        return None
+    blend, manifest_path = compiled_paths(path, head_bone, compiled_dir)
+    # manifestは.blendの後に書くので、manifestがあれば.blendは揃っている
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    manifest["blend"] = blend
+    return manifest
+
+def skinned_meshes(arm) -> list:
+    # glTFに書き出すメッシュ = Armatureの子か、Armatureモディファイアでこのアーマチュアを参照しているもの
+    mesh_objs = []
+    for o in bpy.data.objects:
+        if o.type != "MESH":
+            continue
+        if o.parent == arm:
+            mesh_objs.append(o)
+            continue
+        for mod in o.modifiers:
+            if mod.type == "ARMATURE" and mod.object == arm:
+                mesh_objs.append(o)
+                break
+    return mesh_objs
+
+def compile_template(path: str, head_bone: str, compiled_dir: str) -> str:
+    """
+    テンプレートFBXを、頭メッシュ削除済みの.blendと manifest(JSON) に変換する。
+    ジョブはこれを開くだけで、FBXの読み込み・頭ボーンの解決・頭メッシュの削除を省ける。
+    """
+    blend, manifest_path = compiled_paths(path, head_bone, compiled_dir)
+    if os.path.exists(manifest_path):
+        print(f"Template already compiled: {path} -> {blend}")
+        return blend
+
+    reset_scene()
+    import_fbx(path)
+    arm = find_armature()
+    bone = resolve_bone_name(arm, head_bone)
+    before = {o.name for o in bpy.data.objects if o.type == "MESH"}
+    delete_template_head_mesh(arm, bone)
+    after = {o.name for o in bpy.data.objects if o.type == "MESH"}
+
+    manifest = {
+        "version": COMPILE_VERSION,
+        "source": os.path.abspath(path),
+        "blender": bpy.app.version_string,
+        "requested_head_bone": head_bone,
+        "head_bone": bone,
+        "armature": arm.name,
+        "armature_scale": list(arm.scale),
+        "armature_matrix_world": [list(row) for row in arm.matrix_world],
+        "bones": {
+            b.name: {
+                "parent": b.parent.name if b.parent else None,
+                "head_local": list(b.head_local),
+                "tail_local": list(b.tail_local),
+                "matrix_local": [list(row) for row in b.matrix_local],
+            }
+            for b in arm.data.bones
+        },
+        "deleted_meshes": sorted(before - after),
+        "export_meshes": [o.name for o in skinned_meshes(arm)],
+    }
+
+    os.makedirs(compiled_dir, exist_ok=True)
+    tmp_blend = blend[: -len(".blend")] + ".tmp.blend"
+    bpy.ops.wm.save_as_mainfile(filepath=tmp_blend, copy=True)
+    os.replace(tmp_blend, blend)
+    tmp_manifest = manifest_path + ".tmp"
+    with open(tmp_manifest, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_manifest, manifest_path)
+    print(f"Compiled template: {path} -> {blend} (head bone {bone}, removed {manifest['deleted_meshes']})")
+    return blend
+
+def current_rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+def reset_peak_rss():
+    # 常駐モードでもジョブごとのピークを取れるよう、VmHWM を今のRSSへ戻す（Linux 4.0+）
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb() -> float:
+    # reset_peak_rss 以降(CLIモードならプロセス起動以降)のこのプロセスの最大RSS
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def serve(sock_path: str, preload: list, max_jobs: int, max_rss_mb: float, compiled_dir: str | None = None, head_bone: str = ""):
+    """
+    常駐モード。Unixソケットで1行1ジョブ(JSON)を受け取り、結果を1行(JSON)で返す。
+    テンプレートは起動時に読み込んでスナップショットにしておき、ジョブごとにそこへ戻す。
+    max_jobs件処理するか、RSSが max_rss_mb を超えたら "recycle": true を返して終了する
+    （呼び出し側は次のジョブで新しいプロセスを起動する）。
+    """
+    snapshot_dir = tempfile.mkdtemp(prefix="attach_head_")
+    # コンパイル済みのテンプレートはその.blendを開けばよいので、スナップショットは作らない
+    snapshots = {
+        path: snapshot_template(path, snapshot_dir)
+        for path in preload
+        if not find_compiled(path, head_bone, compiled_dir)
+    }
+
+    if os.path.exists(sock_path):
+        os.unlink(sock_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sock_path)
+    server.listen(1)
+    print(f"SERVING on {sock_path}", flush=True)
+
+    jobs = 0
+    while True:
+        conn, _ = server.accept()
+        with conn, conn.makefile("rb") as rfile:
+            for line in rfile:
+                job = json.loads(line)
+
+                def on_event(event: dict):
+                    # 書き出し済みの成果物や工程の所要時間を、ジョブの完了を待たずに知らせる
+                    # （呼び出し側は成果物のアップロードをBlenderの次の処理と並行して進める）
+                    conn.sendall((json.dumps(event) + "\n").encode())
+
+                try:
+                    run_job(job, snapshots, on_event=on_event)
+                    resp = {"ok": True}
+                except Exception as e:
+                    resp = {"ok": False, "error": str(e), "traceback": traceback.format_exc(limit=10)}
+                jobs += 1
+                rss = current_rss_mb()
+                recycle = jobs >= max_jobs or rss > max_rss_mb
+                resp.update({"jobs": jobs, "rss_mb": round(rss, 1), "recycle": recycle})
+                conn.sendall((json.dumps(resp) + "\n").encode())
+                if recycle:
+                    print(f"Recycling blender server after {jobs} jobs (rss={rss:.0f}MB)", flush=True)
+                    server.close()
+                    os.unlink(sock_path)
+                    return
+
+# CLIモードで、イベント(書き出し済みの成果物・工程ごとの所要時間など)を標準出力で知らせる行の接頭辞
+EVENT_MARKER = "@@EVENT "
+
+@contextmanager
+def timed(on_event, stage: str, out: str | None = None):
+    # 工程の所要時間を {"event": "timing"} で知らせる。out はテンプレートごとの工程で、どの成果物向けかを示す
+    t0 = time.perf_counter()
+    yield
+    if on_event:
+        on_event({"event": "timing", "stage": stage, "seconds": round(time.perf_counter() - t0, 4), "out": out})
+
 def main():
     ap = argparse.ArgumentParser(prog="attach_head.py")
 
-    ap.add_argument("--template", required=True)
-    ap.add_argument("--head", required=True)
-    ap.add_argument("--out", required=True)
+    ap.add_argument("--template")
+    ap.add_argument("--head")
+    ap.add_argument("--out")
+    # 同じ頭部を複数テンプレートに付ける場合は --target TEMPLATE OUT を繰り返す
+    ap.add_argument("--target", action="append", nargs=2, metavar=("TEMPLATE", "OUT"), default=[])
+    # 成果物ごとの圧縮設定（例: --compression OUT '{"codec": "draco", "level": 6}'）
+    ap.add_argument("--compression", action="append", nargs=2, metavar=("OUT", "JSON"), default=[])
     ap.add_argument("--head_bone", default="mixamorig7:Head")
     ap.add_argument("--calib", default=None)
     ap.add_argument("--delete_template_head", default="false")
     ap.add_argument("--decimate_ratio", type=float, default=1.0)
+    # 常駐モード
+    ap.add_argument("--serve", default=None, help="Unix socket path to accept jobs on")
+    ap.add_argument("--preload", action="append", default=[], help="template FBX to load once at startup")
+    ap.add_argument("--max_jobs", type=int, default=50)
+    ap.add_argument("--max_rss_mb", type=float, default=4096)
+    # テンプレートのコンパイル（--compile TEMPLATE を繰り返す）。結果は --compiled_dir に置き、ジョブもそこから探す
+    ap.add_argument("--compile", action="append", default=[], metavar="TEMPLATE")
+    ap.add_argument("--compiled_dir", default=None)
+    ap.add_argument("--bulk_ops", default=None, help="true: NumPy/foreach path, false: bpy.ops path")
+    # テクスチャ: 長辺の上限(0=縮小しない)、書き出し形式(auto/jpeg/webp)と品質、頭部の未使用画像を消すか
+    ap.add_argument("--texture_max_size", type=int, default=0)
+    ap.add_argument("--texture_format", default="auto", choices=("auto", "jpeg", "webp"))
+    ap.add_argument("--texture_quality", type=int, default=None)
+    ap.add_argument("--drop_unused_images", default="false")
 
     args = parse_after_double_dash(ap)
 
-    reset_scene()
-
-    # 1) template import
-    import_fbx(args.template)
-    arm = find_armature()
+    if args.compile:
+        if not args.compiled_dir:
+            ap.error("--compile requires --compiled_dir")
+        for path in args.compile:
+            compile_template(path, args.head_bone, args.compiled_dir)
+        return
 
-    # FBXインポート時のアーマチュアスケールをそのまま使用
-    print(f"Armature scale: {arm.scale}")
+    if args.serve:
+        serve(args.serve, args.preload, args.max_jobs, args.max_rss_mb, args.compiled_dir, args.head_bone)
+        return
 
+    targets = list(args.target)
+    if args.template and args.out:
+        targets.insert(0, [args.template, args.out])
+    if not (args.head and targets):
+        ap.error("--head and --template/--out (or --target) are required")
+    compression = {out: json.loads(settings) for out, settings in args.compression}
+    targets = [[template, out, compression.get(out)] for template, out in targets]
+    run_job({
+        "targets": targets,
+        "head": args.head,
+        "head_bone": args.head_bone,
+        "calib": args.calib,
+        "delete_template_head": args.delete_template_head,
+        "decimate_ratio": args.decimate_ratio,
+        "compiled_dir": args.compiled_dir,
+        "bulk_ops": args.bulk_ops,
+        "texture_max_size": args.texture_max_size,
+        "texture_format": args.texture_format,
+        "texture_quality": args.texture_quality,
+        "drop_unused_images": args.drop_unused_images,
+    }, on_event=lambda event: print(EVENT_MARKER + json.dumps(event), flush=True))
+
+def run_job(job: dict, snapshots: dict | None = None, on_event=None):
+    """
+    1つの頭部を、targets の各テンプレートに付けてそれぞれ書き出す。
+    頭部の読み込み・デシメート・キャリブレーションは最初の1回だけ行い、
+    2つ目以降のテンプレートには一時.blendに保存した処理済みの頭部を追加する。
+    """
+    args = argparse.Namespace(**{
+        "head_bone": "mixamorig7:Head",
+        "calib": None,
+        "delete_template_head": "false",
+        "decimate_ratio": 1.0,
+        "targets": None,
+        "compiled_dir": None,
+        "bulk_ops": None,
+        "texture_max_size": 0,
+        "texture_format": "auto",
+        "texture_quality": None,
+        "drop_unused_images": "false",
+        **job,
+    })
+    global BULK_OPS
+    BULK_OPS = BULK_OPS_DEFAULT if args.bulk_ops is None else str(args.bulk_ops).lower() in ("1", "true", "yes")
+    delete_head = str(args.delete_template_head).lower() in ("1","true","yes","y")
+    targets = args.targets or [[args.template, args.out]]
+
+    work_dir = tempfile.mkdtemp(prefix="attach_head_job_") if len(targets) > 1 else None
+    head_blend = None
+    reset_peak_rss()
+    try:
+        # target: [TEMPLATE, OUT] または [TEMPLATE, OUT, 圧縮設定]
+        for template, out, *rest in targets:
+            # 1) template import
+            # コンパイル済みテンプレートは頭メッシュ削除済みなので、削除する設定のジョブだけで使う
+            with timed(on_event, "load_template", out):
+                manifest = find_compiled(template, args.head_bone, args.compiled_dir) if delete_head else None
+                if manifest:
+                    bpy.ops.wm.open_mainfile(filepath=manifest["blend"])
+                    arm = bpy.data.objects[manifest["armature"]]
+                else:
+                    load_template(template, snapshots)
+                    arm = find_armature()
+
+            # FBXインポート時のアーマチュアスケールをそのまま使用
+            print(f"Armature scale: {arm.scale}")
+
+            if head_blend is None:
+                head_obj = prepare_head(args, on_event)
+                if work_dir:
+                    with timed(on_event, "save_head"):
+                        head_blend = save_head(head_obj, work_dir)
+            else:
+                with timed(on_event, "load_head", out):
+                    head_obj = append_head(head_blend)
+
+            attach_and_export(arm, head_obj, args, out, manifest, on_event, compression=rest[0] if rest else None)
+            if on_event:
+                on_event({"event": "output", "out": out})
+        if on_event:
+            on_event({"event": "resources", "peak_rss_mb": round(peak_rss_mb(), 1)})
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def save_head(head_obj, work_dir: str) -> str:
+    # 処理済み(デシメート・キャリブレーション・transform_apply済み)の頭部だけを.blendに書き出す
+    path = os.path.join(work_dir, "head.blend")
+    bpy.data.libraries.write(path, {head_obj}, fake_user=True)
+    return path
+
+def append_head(path: str):
+    with bpy.data.libraries.load(path, link=False) as (data_from, data_to):
+        data_to.objects = list(data_from.objects)
+    head_obj = data_to.objects[0]
+    bpy.context.scene.collection.objects.link(head_obj)
+    head_obj.use_fake_user = False
+    print(f"Reused prepared head: {head_obj.name}")
+    return head_obj
+
+def prepare_head(args, on_event=None):
     # 2) head import
     head_path = args.head.lower()
     before_meshes = set([o.name for o in bpy.data.objects if o.type == "MESH"])
-    if head_path.endswith(".obj"):
-        import_obj(args.head)
-    elif head_path.endswith(".glb") or head_path.endswith(".gltf"):
-        import_gltf(args.head)
-    else:
-        raise RuntimeError("Unsupported head format. Use .obj or .glb/.gltf")
+    before_images = set(bpy.data.images)
+    with timed(on_event, "import_head"):
+        if head_path.endswith(".obj"):
+            import_obj(args.head)
+        elif head_path.endswith(".glb") or head_path.endswith(".gltf"):
+            import_gltf(args.head)
+        else:
+            raise RuntimeError("Unsupported head format. Use .obj or .glb/.gltf")
 
     after_meshes = [o for o in bpy.data.objects if o.type == "MESH" and o.name not in before_meshes]
     if not after_meshes:
         raise RuntimeError("No mesh imported for head")
 
     # デバッグ: インポートされたメッシュの情報を出力
-    print(f"DEBUG: Imported {len(after_meshes)} mesh(es) from head file:")
+    debug(f"DEBUG: Imported {len(after_meshes)} mesh(es) from head file:")
     for m in after_meshes:
         poly_count = len(m.data.polygons)
         vert_count = len(m.data.vertices)
-        print(f"  - {m.name}: {poly_count} polygons, {vert_count} vertices")
+        debug(f"  - {m.name}: {poly_count} polygons, {vert_count} vertices")
 
     # headメッシュが複数入ることがあるので、最大ポリゴンのものを採用し、他は削除
     def poly_count(obj):
@@ -408,58 +957,101 @@ def main():
             print(f"Removing extra mesh: {m.name}")
             bpy.data.objects.remove(m, do_unlink=True)
 
+    stats = {"vertices": len(head_obj.data.vertices), "polygons": len(head_obj.data.polygons)}
+
+    # 2.5) textures: 縮小と未使用画像の削除
+    with timed(on_event, "textures"):
+        stats.update(process_textures(
+            head_obj,
+            set(bpy.data.images) - before_images,
+            int(args.texture_max_size or 0),
+            str(args.drop_unused_images).lower() in ("1", "true", "yes"),
+        ))
+
     # 3) optional decimate
-    apply_decimate(head_obj, args.decimate_ratio)
+    with timed(on_event, "decimate"):
+        apply_decimate(head_obj, args.decimate_ratio)
+    stats.update({
+        "vertices_decimated": len(head_obj.data.vertices),
+        "polygons_decimated": len(head_obj.data.polygons),
+    })
+    if on_event:
+        on_event({"event": "head_stats", **stats})
 
     # 4) apply calib transform
-    calib = load_calib(args.calib)
-    apply_transform(head_obj, calib)
+    with timed(on_event, "calibrate"):
+        calib = load_calib(args.calib)
+        apply_transform(head_obj, calib)
 
-    # 4.6) apply all transforms before parenting to prevent scale issues
-    bpy.context.view_layer.objects.active = head_obj
-    bpy.ops.object.select_all(action='DESELECT')
-    head_obj.select_set(True)
-    bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
+        # 4.6) apply all transforms before parenting to prevent scale issues
+        bake_mesh_transform(head_obj)
     print(f"Applied transforms to head mesh: scale={head_obj.scale}, location={head_obj.location}")
 
+    return head_obj
+
+def attach_and_export(
+    arm, head_obj, args, out: str, manifest: dict | None = None, on_event=None, compression: dict | None = None
+):
     # 5) parent to head bone
     # GLBではボーン親子付けより、スキニングの方が崩れにくい
-    head_bone = resolve_bone_name(arm, args.head_bone)
-    rigid_skin_to_bone(head_obj, arm, head_bone)
+    with timed(on_event, "bind", out):
+        head_bone = manifest["head_bone"] if manifest else resolve_bone_name(arm, args.head_bone)
+        rigid_skin_to_bone(head_obj, arm, head_bone)
     print(f"After bind: scale={head_obj.scale}, location={head_obj.location}")
 
-    # 6) delete template head (optional)
-    if str(args.delete_template_head).lower() in ("1","true","yes","y"):
-        delete_template_head_mesh(arm, head_bone)
+    # 6) delete template head (optional, コンパイル済みテンプレートでは削除済み)
+    if not manifest and str(args.delete_template_head).lower() in ("1","true","yes","y"):
+        with timed(on_event, "delete_head", out):
+            delete_template_head_mesh(arm, head_bone)
 
     # 7) export
     # エクスポート前のシーン状態をデバッグ
-    print("DEBUG: All objects before export:")
+    debug("DEBUG: All objects before export:")
     for o in bpy.data.objects:
-        print(f"  - {o.name} (type: {o.type}, parent: {o.parent.name if o.parent else None})")
-
-    out_lower = args.out.lower()
-    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
-    if out_lower.endswith(".fbx"):
-        export_fbx(args.out)
-    elif out_lower.endswith(".glb") or out_lower.endswith(".gltf"):
-        # GLBはArmature scale(例:0.01)が残るとビューア側でスキンが崩れやすいので、
-        # 一時複製を作ってスケールを焼き込んでからエクスポートする。
-        mesh_objs = []
-        for o in bpy.data.objects:
-            if o.type != "MESH":
-                continue
-            if o.parent == arm:
-                mesh_objs.append(o)
-                continue
-            for mod in o.modifiers:
-                if mod.type == "ARMATURE" and mod.object == arm:
-                    mesh_objs.append(o)
-                    break
-
-        export_gltf_normalized(args.out, armature_obj=arm, mesh_objs=mesh_objs, export_selected_only=True)
-    else:
-        raise RuntimeError("Unsupported output format. Use .fbx or .glb")
+        debug(f"  - {o.name} (type: {o.type}, parent: {o.parent.name if o.parent else None})")
+
+    out_lower = out.lower()
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with timed(on_event, "export", out):
+        if out_lower.endswith(".fbx"):
+            export_fbx(out)
+        elif out_lower.endswith(".glb") or out_lower.endswith(".gltf"):
+            # GLBはArmature scale(例:0.01)が残るとビューア側でスキンが崩れやすいので、
+            # 一時複製を作ってスケールを焼き込んでからエクスポートする。
+            if manifest:
+                mesh_objs = [bpy.data.objects[n] for n in manifest["export_meshes"]] + [head_obj]
+            else:
+                mesh_objs = skinned_meshes(arm)
+
+            codec = export_gltf_normalized(
+                out,
+                armature_obj=arm,
+                mesh_objs=mesh_objs,
+                export_selected_only=True,
+                compression=compression,
+                textures={"format": args.texture_format, "quality": args.texture_quality},
+            )
+        else:
+            raise RuntimeError("Unsupported output format. Use .fbx or .glb")
+
+    if not out_lower.endswith((".glb", ".gltf")):
+        return
+    # 8) optional meshopt (書き出し後のGLBを置き換える)
+    uncompressed = None
+    if (compression or {}).get("codec") == "meshopt":
+        uncompressed = os.path.getsize(out)
+        with timed(on_event, "compress", out):
+            codec = "meshopt" if meshopt_compress(out, compression) else "none"
+    if on_event:
+        on_event({
+            "event": "output_stats",
+            "out": out,
+            "codec": codec,
+            "settings": {k: v for k, v in compression.items() if k not in ("codec", "gltfpack")} if codec != "none" else {},
+            "bytes": os.path.getsize(out),
+            "bytes_uncompressed": uncompressed,
+            "image_bytes": glb_image_bytes(out),
+        })
 
 if __name__ == "__main__":
     main()
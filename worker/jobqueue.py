@@ -0,0 +1,250 @@
+"""
+scanジョブの優先度付き・at-least-once 処理。
+
+- lanes: hubはジョブを queue:lane:{interactive,bulk,reprocess} のzsetに入れる。
+  スコアは投入時刻+推定処理コスト（上限あり）で、レーン内は小さい順＝短いジョブ優先、
+  ただし後から来たジョブに抜かれ続けることはない
+- reserve: 空でないレーンを LANE_WEIGHTS の重みで選び、ZPOPMIN したジョブを
+  queue:processing:{slot_id} へ同じLuaスクリプト内で移してから処理する
+  （処理中にプロセスが落ちてもジョブはprocessingリストに残る）。
+  空なら queue:scans:wakeup をBLPOPしてジョブ投入を待つ（wakeupはreserveのたびに残りのジョブ数まで切り詰める）
+- lease: 各スロットは worker:lease:{slot_id} をTTL付きで更新し続ける
+- reap: leaseが切れたスロットのprocessingリストを元のレーン・スコアへ戻し、scanの状態もqueuedへ戻す。
+  試行回数を使い切ったものはdead-letterへ
+- retry: 失敗したジョブは指数バックオフで queue:scans:delayed に入り、時刻が来たら元のレーンへ戻る
+"""
+import os
+import random
+import time
+import redis
+
+SCAN_LANES = ("interactive", "bulk", "reprocess")
+# レーンの選択比率。空のレーンは除いて、残りの重みで按分する
+LANE_WEIGHTS = {
+    lane: max(float(w), 0.001)
+    for lane, w in (
+        item.split("=", 1) for item in os.environ.get("LANE_WEIGHTS", "interactive=8,bulk=2,reprocess=1").split(",")
+    )
+}
+# 優先度レーン導入前のキュー（起動時にinteractiveレーンへ移す）
+LEGACY_QUEUE_KEY = "queue:scans"
+WAKEUP_KEY = "queue:scans:wakeup"
+WAKEUP_MAX = 10000
+DELAYED_KEY = "queue:scans:delayed"
+DEAD_KEY = "queue:scans:dead"
+PROCESSING_SLOTS_KEY = "queue:processing"
+
+# 1ジョブの最大試行回数（workerの異常終了による再投入も1回と数える）
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+RETRY_BACKOFF = float(os.environ.get("RETRY_BACKOFF", 30))
+RETRY_BACKOFF_MAX = float(os.environ.get("RETRY_BACKOFF_MAX", 600))
+# leaseがこの秒数更新されなければ、そのスロットの処理中ジョブを回収する
+VISIBILITY_TIMEOUT = int(os.environ.get("VISIBILITY_TIMEOUT", 60))
+DEAD_LETTER_MAX = int(os.environ.get("DEAD_LETTER_MAX", 10000))
+
+def key_lane(lane: str) -> str:
+    return f"queue:lane:{lane}"
+
+def key_processing(slot_id: str) -> str:
+    return f"queue:processing:{slot_id}"
+
+def key_lease(slot_id: str) -> str:
+    return f"worker:lease:{slot_id}"
+
+# ジョブを scan:{id} の queue_lane / queue_score に従ってレーンへ戻す（Luaの各スクリプトで共有）
+REQUEUE_LUA = """
+local function requeue(scan_id, now, wakeup)
+  local lane = redis.call('HGET', 'scan:' .. scan_id, 'queue_lane') or 'interactive'
+  local score = redis.call('HGET', 'scan:' .. scan_id, 'queue_score') or now
+  redis.call('ZADD', 'queue:lane:' .. lane, score, scan_id)
+  redis.call('LPUSH', wakeup, scan_id)
+end
+"""
+
+# 空でないレーンを重みで選び、先頭(最小スコア)のジョブをprocessingリストへ移して試行回数を数える
+# （processingへ移した直後にスロットが落ちても、回収されたジョブの試行は数え済みになる）
+# wakeupリストは残りのジョブ数まで切り詰める（BLPOPしなかったスロットが取ったジョブの通知を残さない。
+# 古い通知が溜まると、空のスロットがBLPOPで待たずに空振りを繰り返す）
+# KEYS: processing, wakeup, lane...  ARGV: rand(0-1), weight...（KEYS[i] の重みは ARGV[i - 1]）
+# 戻り値: {scan_id, lane, attempts}
+RESERVE_LUA = """
+local total = 0
+local queued = 0
+local candidates = {}
+for i = 3, #KEYS do
+  local n = redis.call('ZCARD', KEYS[i])
+  if n > 0 then
+    total = total + tonumber(ARGV[i - 1])
+    queued = queued + n
+    table.insert(candidates, i)
+  end
+end
+if total == 0 then
+  redis.call('DEL', KEYS[2])
+  return false
+end
+local pick = tonumber(ARGV[1]) * total
+local chosen = candidates[#candidates]
+for _, i in ipairs(candidates) do
+  pick = pick - tonumber(ARGV[i - 1])
+  if pick < 0 then
+    chosen = i
+    break
+  end
+end
+local popped = redis.call('ZPOPMIN', KEYS[chosen])
+redis.call('LPUSH', KEYS[1], popped[1])
+if queued > 1 then
+  redis.call('LTRIM', KEYS[2], 0, queued - 2)
+else
+  redis.call('DEL', KEYS[2])
+end
+local attempts = redis.call('HINCRBY', 'scan:' .. popped[1], 'attempts', 1)
+return {popped[1], KEYS[chosen], attempts}
+"""
+
+# leaseが切れたprocessingリストを空にする。戻り値は dead-letter に送った scan_id
+# 戻したジョブの scan:{id} は status=processing なら queued にする（scans:status:* と scans:events は tasks.py と同じ形式）
+# KEYS: processing, dead, lease, processing_slots, wakeup  ARGV: max_attempts, slot_id, dead_max, force, now
+RECLAIM_LUA = REQUEUE_LUA + """
+if ARGV[4] ~= '1' and redis.call('EXISTS', KEYS[3]) == 1 then
+  return {}
+end
+local dead = {}
+while true do
+  local scan_id = redis.call('RPOP', KEYS[1])
+  if not scan_id then break end
+  local attempts = tonumber(redis.call('HGET', 'scan:' .. scan_id, 'attempts') or '0')
+  if attempts >= tonumber(ARGV[1]) then
+    redis.call('LPUSH', KEYS[2], scan_id)
+    table.insert(dead, scan_id)
+  else
+    -- 元のスコアのまま戻すので、レーン内では待っていた位置から再開する
+    requeue(scan_id, ARGV[5], KEYS[5])
+    -- 処理中のまま止まっていたscanは tasks.set_status と同じく queued へ戻し、索引の付け替えと通知も行う
+    local key = 'scan:' .. scan_id
+    if redis.call('HGET', key, 'status') == 'processing' then
+      local updated_at = tonumber(ARGV[5])
+      redis.call('HSET', key, 'status', 'queued', 'updated_at', ARGV[5])
+      redis.call('ZREM', 'scans:status:processing', scan_id)
+      local created_at = redis.call('ZSCORE', 'scans:index', scan_id)
+      if created_at then
+        redis.call('ZADD', 'scans:status:queued', created_at, scan_id)
+      end
+      redis.call('PUBLISH', 'scans:events', cjson.encode({scan_id = scan_id, event = 'status', status = 'queued', updated_at = updated_at}))
+    end
+  end
+end
+redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[3]) - 1)
+redis.call('SREM', KEYS[4], ARGV[2])
+return dead
+"""
+
+# 時刻が来た再試行ジョブを元のレーンへ戻す
+# KEYS: delayed, wakeup  ARGV: now, limit
+PROMOTE_LUA = REQUEUE_LUA + """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, scan_id in ipairs(due) do
+  redis.call('ZREM', KEYS[1], scan_id)
+  requeue(scan_id, ARGV[1], KEYS[2])
+end
+return #due
+"""
+
+# 優先度レーン導入前の queue:scans に残っているジョブを移す
+# KEYS: legacy, wakeup  ARGV: now
+MIGRATE_LUA = REQUEUE_LUA + """
+local n = 0
+while true do
+  local scan_id = redis.call('RPOP', KEYS[1])
+  if not scan_id then break end
+  requeue(scan_id, ARGV[1], KEYS[2])
+  n = n + 1
+end
+return n
+"""
+
+class JobQueue:
+    def __init__(self, r: redis.Redis, slot_id: str):
+        self.r = r
+        self.slot_id = slot_id
+        self.processing = key_processing(slot_id)
+        self.reclaim_script = r.register_script(RECLAIM_LUA)
+        self.reserve_script = r.register_script(RESERVE_LUA)
+        self.lane_keys = [key_lane(lane) for lane in SCAN_LANES]
+        self.lane_weights = [LANE_WEIGHTS.get(lane, 1.0) for lane in SCAN_LANES]
+
+    def renew_lease(self):
+        with self.r.pipeline(transaction=False) as pipe:
+            pipe.set(key_lease(self.slot_id), time.time(), ex=VISIBILITY_TIMEOUT)
+            pipe.sadd(PROCESSING_SLOTS_KEY, self.slot_id)
+            pipe.execute()
+
+    def release_lease(self):
+        self.r.delete(key_lease(self.slot_id))
+
+    def recover(self) -> list[str]:
+        # 同じslot_idの前のプロセスが落ちた後の起動時に、残っていたジョブを戻す
+        return reclaim(self.r, self.slot_id, force=True, script=self.reclaim_script)
+
+    def try_reserve(self) -> tuple[str, int] | None:
+        picked = self.reserve_script(
+            keys=[self.processing, WAKEUP_KEY, *self.lane_keys],
+            args=[random.random(), *self.lane_weights],
+        )
+        return (picked[0], int(picked[2])) if picked else None
+
+    def reserve(self, timeout: float = 2) -> tuple[str, int] | None:
+        """次のジョブを自分のprocessingリストへ移して (scan_id, 試行回数) を返す"""
+        picked = self.try_reserve()
+        if not picked:
+            # 投入の通知を待つ（通知は他のスロットが先に取ったジョブの分かもしれないので、もう一度試すだけ）
+            if not self.r.blpop(WAKEUP_KEY, timeout=timeout):
+                return None
+            picked = self.try_reserve()
+        return picked
+
+    def ack(self, scan_id: str):
+        self.r.lrem(self.processing, 1, scan_id)
+
+    def retry_delay(self, attempts: int) -> float | None:
+        # 次の試行までの秒数。試行回数を使い切っていれば None
+        if attempts >= JOB_MAX_ATTEMPTS:
+            return None
+        return min(RETRY_BACKOFF * 2 ** (attempts - 1), RETRY_BACKOFF_MAX)
+
+    def fail(self, scan_id: str, attempts: int):
+        """処理に失敗したジョブを、再試行待ちかdead-letterへ移す"""
+        delay = self.retry_delay(attempts)
+        with self.r.pipeline(transaction=True) as pipe:
+            pipe.lrem(self.processing, 1, scan_id)
+            if delay is None:
+                pipe.lpush(DEAD_KEY, scan_id)
+                pipe.ltrim(DEAD_KEY, 0, DEAD_LETTER_MAX - 1)
+            else:
+                pipe.zadd(DELAYED_KEY, {scan_id: time.time() + delay})
+            pipe.execute()
+
+def reclaim(r: redis.Redis, slot_id: str, force: bool = False, script=None) -> list[str]:
+    script = script or r.register_script(RECLAIM_LUA)
+    return script(
+        keys=[key_processing(slot_id), DEAD_KEY, key_lease(slot_id), PROCESSING_SLOTS_KEY, WAKEUP_KEY],
+        args=[JOB_MAX_ATTEMPTS, slot_id, DEAD_LETTER_MAX, "1" if force else "0", time.time()],
+    )
+
+def migrate_legacy_queue(r: redis.Redis) -> int:
+    return r.register_script(MIGRATE_LUA)(keys=[LEGACY_QUEUE_KEY, WAKEUP_KEY], args=[time.time()])
+
+def reap(r: redis.Redis) -> list[str]:
+    """
+    leaseが切れたスロットの処理中ジョブを回収し、再試行時刻が来たジョブをキューへ戻す。
+    どのworkerが実行してもよい（回収はスロット単位でLuaの中で原子的に行う）。
+    戻り値は dead-letter に送った scan_id。
+    """
+    script = r.register_script(RECLAIM_LUA)
+    dead = []
+    for slot_id in r.smembers(PROCESSING_SLOTS_KEY):
+        dead.extend(reclaim(r, slot_id, script=script))
+    r.register_script(PROMOTE_LUA)(keys=[DELAYED_KEY, WAKEUP_KEY], args=[time.time(), 100])
+    r.ltrim(WAKEUP_KEY, 0, WAKEUP_MAX - 1)
+    return dead
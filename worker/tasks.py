@@ -1,9 +1,15 @@
 import os
+import sys
+import json
+import shutil
+import socket
 import subprocess
 import tempfile
 import traceback
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 import boto3
+from boto3.s3.transfer import TransferConfig
 import redis
 
 REDIS_URL = os.environ["REDIS_URL"]
@@ -17,6 +23,76 @@ BLENDER_BIN = os.environ.get("BLENDER_BIN", "/opt/blender/blender")
 TEMPLATE_FBX = os.environ.get("TEMPLATE_FBX", "/app/blender/template.fbx")
 TEMPLATE_BLEND_FBX = os.environ.get("TEMPLATE_BLEND_FBX", "/app/blender/template_blend.fbx")
 HEAD_BONE = os.environ.get("HEAD_BONE", "mixamorig7:Head")
+ATTACH_HEAD_PY = "/app/blender/attach_head.py"
+CALIB_JSON = "/app/blender/calib.json"
+# テンプレートFBXをコンパイルした .blend と manifest の置き場（空ならコンパイルせず毎回FBXを読む）
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", "/app/blender/compiled")
+# attach_head.py を常駐させてテンプレートを使い回す（falseならジョブごとにBlenderを起動する）
+BLENDER_SERVER = os.environ.get("BLENDER_SERVER", "true").lower() in ("1", "true", "yes")
+BLENDER_MAX_JOBS = int(os.environ.get("BLENDER_MAX_JOBS", 50))
+BLENDER_MAX_RSS_MB = float(os.environ.get("BLENDER_MAX_RSS_MB", 4096))
+BLENDER_START_TIMEOUT = float(os.environ.get("BLENDER_START_TIMEOUT", 120))
+BLENDER_JOB_TIMEOUT = float(os.environ.get("BLENDER_JOB_TIMEOUT", 600))
+# Blenderのスレッド数（0はBlender任せ）。複数スロットで動かすときはsupervisorがスロットのコア数を入れる
+BLENDER_THREADS = int(os.environ.get("BLENDER_THREADS", 0))
+# Blenderプロセス1つあたりのアドレス空間上限(MB)。0で無制限
+JOB_MEMORY_LIMIT_MB = int(os.environ.get("JOB_MEMORY_LIMIT_MB", 0))
+# S3転送はマルチパートで並列に流す（使うメモリはおおよそ chunksize * concurrency まで）
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.environ.get("S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024)),
+    multipart_chunksize=int(os.environ.get("S3_MULTIPART_CHUNKSIZE", 8 * 1024 * 1024)),
+    max_concurrency=int(os.environ.get("S3_MAX_CONCURRENCY", 4)),
+)
+# ジョブの作業ディレクトリ。未指定なら空きが WORK_DIR_MIN_FREE_MB 以上あるときだけ /dev/shm を使う
+WORK_DIR = os.environ.get("WORK_DIR")
+WORK_DIR_MIN_FREE_MB = int(os.environ.get("WORK_DIR_MIN_FREE_MB", 512))
+# hubの待ち時間推定に使う処理時間の保持件数
+JOB_DURATION_SAMPLES = int(os.environ.get("JOB_DURATION_SAMPLES", 200))
+# 工程ごとの所要時間の時系列 stats:stage:{stage}（スコア=記録時刻）に残す期間と件数
+STAGE_STATS_RETENTION = float(os.environ.get("STAGE_STATS_RETENTION", 7 * 24 * 3600))
+STAGE_STATS_MAX = int(os.environ.get("STAGE_STATS_MAX", 10000))
+
+# 処理プロファイル。hubが混雑時(ADMISSION_POLICY=degrade)に "fast" を付けて投入する
+PROFILES = {
+    "standard": {"decimate_ratio": 0.15, "blend": True},
+    "fast": {
+        "decimate_ratio": float(os.environ.get("FAST_DECIMATE_RATIO", 0.05)),
+        "blend": os.environ.get("FAST_SKIP_BLEND", "true").lower() not in ("1", "true", "yes"),
+    },
+}
+
+# 成果物GLBの圧縮プロファイル。クライアント側にデコーダ(DRACOLoader / MeshoptDecoder)が要るので成果物ごとに選ぶ
+# *_bits は量子化のビット数（position / normal / texcoord / color / generic=ジョイント・ウェイト）
+COMPRESSION_PROFILES = {
+    "none": {},
+    # Blenderのエクスポータ内蔵のDraco(KHR_draco_mesh_compression)
+    "draco": {
+        "codec": "draco",
+        "level": int(os.environ.get("DRACO_LEVEL", 6)),
+        "position_bits": 14,
+        "normal_bits": 10,
+        "texcoord_bits": 12,
+        "color_bits": 10,
+        "generic_bits": 12,
+    },
+    # gltfpack による EXT_meshopt_compression + KHR_mesh_quantization（gltfpackがなければ非圧縮）
+    "meshopt": {
+        "codec": "meshopt",
+        "position_bits": 14,
+        "normal_bits": 8,
+        "texcoord_bits": 12,
+        "gltfpack": os.environ.get("GLTFPACK_BIN", "gltfpack"),
+    },
+}
+# 頭部テクスチャの長辺の上限(px、0で縮小しない)・書き出し形式(auto: 元の形式 / jpeg / webp)・品質(1-100)
+TEXTURE_MAX_SIZE = int(os.environ.get("TEXTURE_MAX_SIZE", 2048))
+TEXTURE_FORMAT = os.environ.get("TEXTURE_FORMAT", "auto")
+TEXTURE_QUALITY = int(os.environ.get("TEXTURE_QUALITY", 85))
+# 頭部GLBに入っているがマテリアルから参照されていない画像を捨てる
+TEXTURE_DROP_UNUSED = os.environ.get("TEXTURE_DROP_UNUSED", "true").lower() in ("1", "true", "yes")
+# avatar.glb / avatar_blend.glb それぞれの圧縮プロファイル
+OUTPUT_COMPRESSION = os.environ.get("OUTPUT_COMPRESSION", "none")
+OUTPUT_BLEND_COMPRESSION = os.environ.get("OUTPUT_BLEND_COMPRESSION", OUTPUT_COMPRESSION)
 
 r = redis.Redis.from_url(REDIS_URL, decode_responses=True)
 
@@ -44,102 +120,455 @@ def key_out(scan_id: str) -> str:
 def key_out_blend(scan_id: str) -> str:
     return f"out/{scan_id}/avatar_blend.glb"
 
-def process_scan(scan_id: str):
-    r.hset(f"scan:{scan_id}", mapping={"status": "processing", "error": "", "updated_at": time.time()})
+SCAN_STATUSES = ("queued", "processing", "done", "failed")
+# hubのSSE/ロングポーリングが購読しているチャンネル
+SCAN_EVENTS_CHANNEL = "scans:events"
+
+def event_payload(scan_id: str, event: str, **fields) -> str:
+    return json.dumps({"scan_id": scan_id, "event": event, **fields})
+
+def key_status_index(status: str) -> str:
+    return f"scans:status:{status}"
+
+def set_status(scan_id: str, status: str, mapping: dict | None = None):
+    """
+    scan:{id} の status 更新と、status別索引(scans:status:*)の付け替えを1トランザクションで行う。
+    索引のスコアは scans:index と同じ created_at を使う（hubの一覧がそのままページングできる）。
+    """
+    created_at = r.zscore("scans:index", scan_id)
+    updated_at = time.time()
+    pipe = r.pipeline(transaction=True)
+    pipe.hset(f"scan:{scan_id}", mapping={"status": status, "updated_at": updated_at, **(mapping or {})})
+    for s in SCAN_STATUSES:
+        if s != status:
+            pipe.zrem(key_status_index(s), scan_id)
+    if created_at is not None:
+        pipe.zadd(key_status_index(status), {scan_id: created_at})
+    pipe.publish(SCAN_EVENTS_CHANNEL, event_payload(scan_id, "status", status=status, updated_at=updated_at))
+    pipe.execute()
+
+def backfill_status_indexes(batch: int = 1000):
+    # status別索引の導入前に作られたscanを索引に載せる（一度だけ実行）
+    if not r.set("scans:status:backfilled", time.time(), nx=True):
+        return
+    rows = []
+    for row in r.zscan_iter("scans:index", count=batch):
+        rows.append(row)
+        if len(rows) >= batch:
+            _backfill_rows(rows)
+            rows = []
+    if rows:
+        _backfill_rows(rows)
+
+def _backfill_rows(rows: list):
+    pipe = r.pipeline(transaction=False)
+    for scan_id, _ in rows:
+        pipe.hget(f"scan:{scan_id}", "status")
+    statuses = pipe.execute()
+    pipe = r.pipeline(transaction=False)
+    for (scan_id, created_at), status in zip(rows, statuses):
+        if status in SCAN_STATUSES:
+            pipe.zadd(key_status_index(status), {scan_id: created_at})
+    pipe.execute()
+
+def fail_lost_scans(scan_ids: list[str]):
+    # workerの異常終了が続いて試行回数を使い切ったジョブ（dead-letter行き）を失敗にする
+    for scan_id in scan_ids:
+        set_status(scan_id, "failed", {"error": "worker stopped while processing (attempts exhausted)"})
+
+def record_asset(scan_id: str, asset: str, mapping: dict):
+    # 成果物ごとに scan:{id} へ書き、SSEでも「このassetが取れるようになった」を通知する
+    updated_at = time.time()
+    pipe = r.pipeline(transaction=True)
+    pipe.hset(f"scan:{scan_id}", mapping={**mapping, "updated_at": updated_at})
+    pipe.publish(
+        SCAN_EVENTS_CHANNEL,
+        event_payload(scan_id, "asset", asset=asset, key=mapping[f"{asset}_key"], updated_at=updated_at),
+    )
+    pipe.execute()
+
+def publish_output(path: str, key: str, content_type: str) -> dict:
+    """成果物をS3へ置き、HEADで確認したサイズとETagを返す（hubはこれを見てHEADを省略する）"""
+    s3.upload_file(path, S3_BUCKET, key, ExtraArgs={"ContentType": content_type}, Config=S3_TRANSFER_CONFIG)
+    head = s3.head_object(Bucket=S3_BUCKET, Key=key)
+    return {"size": head["ContentLength"], "etag": head["ETag"]}
+
+def publish_asset(scan_id: str, asset: str, path: str, key: str, filename: str, extra: dict | None = None) -> float:
+    """成果物をアップロードして scan:{id} に記録し、かかった秒数を返す。extra（圧縮の記録など）も一緒に書く"""
+    t0 = time.perf_counter()
+    content_type = "model/gltf-binary"
+    published = publish_output(path, key, content_type)
+    record_asset(
+        scan_id,
+        asset,
+        {
+            f"{asset}_key": key,
+            f"{asset}_size": published["size"],
+            f"{asset}_etag": published["etag"],
+            f"{asset}_content_type": content_type,
+            f"{asset}_filename": filename,
+            **(extra or {}),
+        },
+    )
+    return time.perf_counter() - t0
 
+# 成果物のアップロード用（Blenderで次のテンプレートを処理している間に裏で送る）
+upload_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="upload")
+
+def work_dir() -> str | None:
+    if WORK_DIR:
+        return WORK_DIR
     try:
-        with tempfile.TemporaryDirectory() as td:
+        if shutil.disk_usage("/dev/shm").free >= WORK_DIR_MIN_FREE_MB * 1024 * 1024:
+            return "/dev/shm"
+    except OSError:
+        pass
+    return None
+
+def blender_cmd() -> list[str]:
+    cmd = [BLENDER_BIN, "-b", "-noaudio"]
+    if BLENDER_THREADS > 0:
+        cmd += ["-t", str(BLENDER_THREADS)]
+    return cmd + ["--python", ATTACH_HEAD_PY, "--"]
+
+def limit_job_memory(cmd: list[str]) -> list[str]:
+    # 暴走したBlenderが同じホストの他スロットを巻き込まないよう、util-linux の prlimit 越しに起動する。
+    # スロットにはheartbeatやアップロードのスレッドがあるので、fork後にPythonを動かす preexec_fn は使わない
+    if JOB_MEMORY_LIMIT_MB <= 0:
+        return cmd
+    return ["prlimit", f"--as={JOB_MEMORY_LIMIT_MB * 1024 * 1024}", "--"] + cmd
+
+class BlenderServer:
+    """
+    attach_head.py --serve を常駐させ、Unixソケット越しにジョブを1件ずつ渡す。
+    Blenderの起動・アドオン登録・テンプレートFBXの読み込みは起動時の1回だけで済む。
+    サーバが自分から終了(recycle)したり落ちたりした場合は、次のジョブで起動し直す。
+    """
+
+    def __init__(self, templates: list[str]):
+        self.templates = templates
+        self.proc: subprocess.Popen | None = None
+        self.conn: socket.socket | None = None
+        self.rfile = None
+        self.sock_path = os.path.join(tempfile.gettempdir(), f"attach_head_{os.getpid()}.sock")
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None and self.conn is not None
+
+    def start(self):
+        self.stop()
+        cmd = blender_cmd() + [
+            "--serve", self.sock_path,
+            "--max_jobs", str(BLENDER_MAX_JOBS),
+            "--max_rss_mb", str(BLENDER_MAX_RSS_MB),
+            "--head_bone", HEAD_BONE,
+        ]
+        if TEMPLATE_CACHE_DIR:
+            cmd += ["--compiled_dir", TEMPLATE_CACHE_DIR]
+        for t in self.templates:
+            cmd += ["--preload", t]
+        if os.path.exists(self.sock_path):
+            os.unlink(self.sock_path)
+        self.proc = subprocess.Popen(limit_job_memory(cmd))
+
+        deadline = time.time() + BLENDER_START_TIMEOUT
+        while True:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"blender server exited during startup (code {self.proc.returncode})")
+            if os.path.exists(self.sock_path):
+                try:
+                    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    conn.connect(self.sock_path)
+                    break
+                except OSError:
+                    conn.close()
+            if time.time() > deadline:
+                self.stop()
+                raise RuntimeError("blender server did not start in time")
+            time.sleep(0.2)
+        conn.settimeout(BLENDER_JOB_TIMEOUT)
+        self.conn = conn
+        self.rfile = conn.makefile("rb")
+
+    def stop(self):
+        if self.rfile is not None:
+            self.rfile.close()
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = self.rfile = None
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.proc = None
+
+    def run(self, job: dict, on_event=None):
+        if not self.alive():
+            t0 = time.perf_counter()
+            self.start()
+            if on_event:
+                on_event({"event": "timing", "stage": "blender_start", "seconds": round(time.perf_counter() - t0, 4)})
+        try:
+            self.conn.sendall((json.dumps(job) + "\n").encode())
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                resp = json.loads(line)
+                if "event" not in resp:
+                    break
+                if on_event:
+                    on_event(resp)
+        except (OSError, socket.timeout) as e:
+            # 固まった・落ちたBlenderは捨てる（次のジョブで起動し直す）
+            self.stop()
+            raise RuntimeError(f"blender server failed: {e}") from e
+        if not line:
+            code = self.proc.poll() if self.proc else None
+            self.stop()
+            raise RuntimeError(f"blender server exited (code {code})")
+        if resp.get("recycle"):
+            # ジョブ自体は終わっているので、終了が遅いだけなら殺して結果はそのまま返す
+            try:
+                self.proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                print("WARN: blender server did not exit after recycle, killing", self.proc.pid)
+                self.proc.kill()
+                self.proc.wait()
+            self.stop()
+        if not resp.get("ok"):
+            raise RuntimeError(f"attach_head failed: {resp.get('error')}\n{resp.get('traceback', '')}")
+        return resp
+
+_blender_server: BlenderServer | None = None
+# attach_head.py がCLIモードでイベント(書き出し済みの成果物・工程の所要時間など)を知らせる行の接頭辞
+EVENT_MARKER = "@@EVENT "
+
+def shutdown_blender():
+    global _blender_server
+    if _blender_server is not None:
+        _blender_server.stop()
+        _blender_server = None
+
+def run_attach_head(job: dict, on_event=None):
+    """
+    attach_head.py のジョブを実行する（常駐サーバ、または1回ごとのBlender起動）。
+    on_event(dict) はジョブ全体の完了を待たずに呼ばれる:
+      {"event": "output", "out": path}  各targetの書き出しが終わった
+      {"event": "timing", "stage": ..., "seconds": ..., "out": path|None}  工程の所要時間
+      {"event": "head_stats", ...}  頭部メッシュの頂点数・ポリゴン数（デシメート前後）
+      {"event": "output_stats", "out": path, "codec": ..., "bytes": ..., "image_bytes": ...}  成果物の圧縮とサイズ
+      {"event": "resources", "peak_rss_mb": ...}  このジョブの間のBlenderのピークRSS
+    """
+    global _blender_server
+    if BLENDER_SERVER:
+        if _blender_server is None:
+            _blender_server = BlenderServer([TEMPLATE_FBX, TEMPLATE_BLEND_FBX])
+        return _blender_server.run(job, on_event=on_event)
+
+    cmd = blender_cmd()
+    for k, v in job.items():
+        if v is None:
+            continue
+        if k == "targets":
+            for template, out, *rest in v:
+                cmd += ["--target", template, out]
+                if rest and rest[0]:
+                    cmd += ["--compression", out, json.dumps(rest[0])]
+        else:
+            cmd += [f"--{k}", str(v)]
+    t0 = time.perf_counter()
+    started = False
+    proc = subprocess.Popen(limit_job_memory(cmd), stdout=subprocess.PIPE, text=True)
+    for line in proc.stdout:
+        if not line.startswith(EVENT_MARKER):
+            sys.stdout.write(line)
+            continue
+        event = json.loads(line[len(EVENT_MARKER):])
+        if on_event and not started:
+            # 最初の工程が始まるまで = Blenderの起動とアドオンの読み込み
+            started = True
+            startup = time.perf_counter() - t0 - float(event.get("seconds") or 0)
+            on_event({"event": "timing", "stage": "blender_start", "seconds": round(max(startup, 0), 4)})
+        if on_event:
+            on_event(event)
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+def compression_settings(name: str) -> dict:
+    if name not in COMPRESSION_PROFILES:
+        print("WARN: unknown compression profile, writing uncompressed", name)
+        return {}
+    return COMPRESSION_PROFILES[name]
+
+def output_fields(asset: str, event: dict | None) -> dict:
+    # attach_head の {"event": "output_stats"} を scan:{id} の {asset}_compression* / {asset}_image_bytes にする
+    if not event:
+        return {}
+    fields = {
+        f"{asset}_compression": event["codec"],
+        f"{asset}_compression_settings": json.dumps(event.get("settings") or {}),
+    }
+    if event.get("bytes_uncompressed"):
+        fields[f"{asset}_uncompressed_size"] = event["bytes_uncompressed"]
+    if event.get("image_bytes") is not None:
+        fields[f"{asset}_image_bytes"] = event["image_bytes"]
+    return fields
+
+def blender_job(targets: list, head_path: str, decimate_ratio: float) -> dict:
+    """
+    targets: [(template, out_path, 圧縮設定), ...] 頭部の前処理は1回だけで、各テンプレートへ書き出す。
+    圧縮設定は COMPRESSION_PROFILES の値（省略・空なら非圧縮）
+    """
+    return {
+        "targets": [list(t) for t in targets],
+        "head": head_path,
+        "head_bone": HEAD_BONE,
+        "calib": CALIB_JSON,
+        "delete_template_head": "true",
+        "decimate_ratio": decimate_ratio,
+        "compiled_dir": TEMPLATE_CACHE_DIR or None,
+        "texture_max_size": TEXTURE_MAX_SIZE,
+        "texture_format": TEXTURE_FORMAT,
+        "texture_quality": TEXTURE_QUALITY,
+        "drop_unused_images": str(TEXTURE_DROP_UNUSED).lower(),
+    }
+
+def compile_templates():
+    """
+    テンプレートFBXを頭メッシュ削除済みの.blendへコンパイルしておく（内容のハッシュで管理するので、
+    テンプレートが変わっていなければ何もしない）。失敗してもジョブはFBXを直接読むので止めない。
+    """
+    if not TEMPLATE_CACHE_DIR:
+        return
+    cmd = blender_cmd() + [
+        "--compile", TEMPLATE_FBX,
+        "--compile", TEMPLATE_BLEND_FBX,
+        "--compiled_dir", TEMPLATE_CACHE_DIR,
+        "--head_bone", HEAD_BONE,
+    ]
+    try:
+        subprocess.check_call(limit_job_memory(cmd))
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("WARN: template compile failed; jobs will import the FBX templates", e)
+
+def record_timings(scan_id: str, timings: dict, head_stats: dict, series: bool = True, extra: dict | None = None):
+    """
+    工程ごとの所要時間を scan:{id} に timing_{stage} として書き、頭部の統計を head_* として、
+    extra（BlenderのRSSなど）はそのままのフィールド名で書く。
+    series なら stats:stage:{stage}（スコア=時刻, メンバー="秒数:scan_id"）にも積む（hubがp50/p95を出す）。
+    """
+    now = time.time()
+    pipe = r.pipeline(transaction=False)
+    fields = {f"timing_{stage}": round(sec, 4) for stage, sec in timings.items()}
+    fields.update({f"head_{k}": v for k, v in head_stats.items()})
+    fields.update(extra or {})
+    if fields:
+        pipe.hset(f"scan:{scan_id}", mapping=fields)
+    if series:
+        for stage, sec in timings.items():
+            key = f"stats:stage:{stage}"
+            pipe.sadd("stats:stages", stage)
+            pipe.zadd(key, {f"{sec:.4f}:{scan_id}": now})
+            pipe.zremrangebyscore(key, "-inf", now - STAGE_STATS_RETENTION)
+            pipe.zremrangebyrank(key, 0, -STAGE_STATS_MAX - 1)
+    pipe.execute()
+
+def record_job_duration(seconds: float):
+    pipe = r.pipeline(transaction=False)
+    pipe.lpush("stats:job_durations", round(seconds, 3))
+    pipe.ltrim("stats:job_durations", 0, JOB_DURATION_SAMPLES - 1)
+    pipe.execute()
+
+def process_scan(scan_id: str, retry_delay: float | None = None):
+    """retry_delay: 失敗時に再試行する場合の待ち秒数。None なら失敗で確定させる"""
+    started_at = time.time()
+    set_status(scan_id, "processing", {"error": "", "started_at": started_at})
+    profile_name = r.hget(f"scan:{scan_id}", "profile") or "standard"
+    profile = PROFILES.get(profile_name, PROFILES["standard"])
+
+    # 工程ごとの所要時間（blend版テンプレート向けの工程は *_blend）
+    timings: dict = {}
+    head_stats: dict = {}
+    resources: dict = {}
+
+    def add_timing(stage: str, seconds: float):
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+    try:
+        with tempfile.TemporaryDirectory(dir=work_dir()) as td:
             head_path = os.path.join(td, "head.glb")
             out_path = os.path.join(td, "out.glb")
             out_blend_path = os.path.join(td, "out_blend.glb")
 
-            # download head.glb
-            obj = s3.get_object(Bucket=S3_BUCKET, Key=key_raw(scan_id))
-            with open(head_path, "wb") as f:
-                f.write(obj["Body"].read())
+            # download head.glb（メモリに載せずにファイルへ直接）
+            t0 = time.perf_counter()
+            s3.download_file(S3_BUCKET, key_raw(scan_id), head_path, Config=S3_TRANSFER_CONFIG)
+            add_timing("download", time.perf_counter() - t0)
 
+            # 書き出し済みの成果物から順にアップロードする
+            # （avatar.glb の送信は blend版のBlender処理と並行して進む）
+            outputs = {out_path: ("asset", key_out(scan_id), "avatar.glb")}
             # run blender headless
-            cmd = [
-                BLENDER_BIN, "-b", "-noaudio",
-                "--python", "/app/blender/attach_head.py", "--",
-                "--template", TEMPLATE_FBX,
-                "--head", head_path,
-                "--out", out_path,
-                "--head_bone", HEAD_BONE,
-                "--calib", '/app/blender/calib.json',
-                "--delete_template_head", "true",
-                "--decimate_ratio", "0.15",
-            ]
-            subprocess.check_call(cmd)
-
-            # upload out.glb
-            out_key = key_out(scan_id)
-            with open(out_path, "rb") as f:
-                s3.put_object(
-                    Bucket=S3_BUCKET,
-                    Key=out_key,
-                    Body=f.read(),
-                    ContentType="model/gltf-binary",
-                )
-            r.hset(
-                f"scan:{scan_id}",
-                mapping={
-                    "asset_key": out_key,
-                    "asset_content_type": "model/gltf-binary",
-                    "asset_filename": "avatar.glb",
-                    "updated_at": time.time(),
-                },
-            )
-
-            # run blender headless (blend body template)
-            cmd_blend = [
-                BLENDER_BIN,
-                "-b",
-                "-noaudio",
-                "--python",
-                "/app/blender/attach_head.py",
-                "--",
-                "--template",
-                TEMPLATE_BLEND_FBX,
-                "--head",
-                head_path,
-                "--out",
-                out_blend_path,
-                "--head_bone",
-                HEAD_BONE,
-                "--calib",
-                "/app/blender/calib.json",
-                "--delete_template_head",
-                "true",
-                "--decimate_ratio",
-                "0.15",
-            ]
-            subprocess.check_call(cmd_blend)
-
-            # upload out_blend.glb
-            out_blend_key = key_out_blend(scan_id)
-            with open(out_blend_path, "rb") as f:
-                s3.put_object(
-                    Bucket=S3_BUCKET,
-                    Key=out_blend_key,
-                    Body=f.read(),
-                    ContentType="model/gltf-binary",
-                )
-            r.hset(
-                f"scan:{scan_id}",
-                mapping={
-                    "asset_blend_key": out_blend_key,
-                    "asset_blend_content_type": "model/gltf-binary",
-                    "asset_blend_filename": "avatar_blend.glb",
-                    "updated_at": time.time(),
-                },
-            )
+            # 頭部の前処理は共通なので、blend版も同じ実行でまとめて書き出す
+            # ("fast" プロファイルはblend版を作らない)
+            targets = [(TEMPLATE_FBX, out_path, compression_settings(OUTPUT_COMPRESSION))]
+            if profile["blend"]:
+                targets.append((TEMPLATE_BLEND_FBX, out_blend_path, compression_settings(OUTPUT_BLEND_COMPRESSION)))
+                outputs[out_blend_path] = ("asset_blend", key_out_blend(scan_id), "avatar_blend.glb")
+            uploads = {}
+            output_stats = {}
+
+            def stage_suffix(path: str | None) -> str:
+                return "_blend" if path == out_blend_path else ""
+
+            def upload(path: str):
+                if path in outputs and path not in uploads:
+                    asset, key, filename = outputs[path]
+                    extra = output_fields(asset, output_stats.get(path))
+                    uploads[path] = upload_pool.submit(publish_asset, scan_id, asset, path, key, filename, extra)
+
+            def on_event(event: dict):
+                kind = event.get("event")
+                if kind == "output":
+                    upload(event["out"])
+                elif kind == "timing":
+                    add_timing(event["stage"] + stage_suffix(event.get("out")), float(event["seconds"]))
+                elif kind == "output_stats":
+                    output_stats[event["out"]] = event
+                elif kind == "head_stats":
+                    head_stats.update({k: v for k, v in event.items() if k != "event"})
+                elif kind == "resources":
+                    # Blender自身が測ったこのジョブの間のピークRSS
+                    resources["blender_rss_mb"] = float(event["peak_rss_mb"])
+
+            t0 = time.perf_counter()
+            try:
+                run_attach_head(blender_job(targets, head_path, profile["decimate_ratio"]), on_event=on_event)
+                add_timing("blender", time.perf_counter() - t0)
+                # 書き出し通知が来なかった成果物もここで送る
+                for path in outputs:
+                    upload(path)
+            finally:
+                # 一時ディレクトリを消す前に、送信中のアップロードを待つ
+                wait(uploads.values())
+            for path, f in uploads.items():
+                add_timing("upload" + stage_suffix(path), f.result())
     except Exception as e:
         tb = traceback.format_exc(limit=10)
-        r.hset(
-            f"scan:{scan_id}",
-            mapping={"status": "failed", "error": (str(e) + "\n" + tb)[:4000]},
-        )
+        error = (str(e) + "\n" + tb)[:4000]
+        # 失敗したscanにも途中までの所要時間は残す（時系列には入れない）
+        record_timings(scan_id, timings, head_stats, series=False, extra=resources)
+        if retry_delay is None:
+            set_status(scan_id, "failed", {"error": error})
+        else:
+            set_status(scan_id, "queued", {"error": error, "retry_at": time.time() + retry_delay})
         raise
     else:
-        r.hset(f"scan:{scan_id}", mapping={"status": "done", "updated_at": time.time()})
+        add_timing("total", time.time() - started_at)
+        record_timings(scan_id, timings, head_stats, extra=resources)
+        set_status(scan_id, "done")
+        record_job_duration(time.time() - started_at)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# jobqueue.py などは worker/ 直下のモジュールとして import する（コンテナ内と同じ）
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,154 @@
+"""
+jobqueue のLuaスクリプト（reserve / reclaim / promote / migrate）。
+Redisは fakeredis（Luaの実行に lupa が要る）で代用する。
+"""
+import json
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+import jobqueue
+
+@pytest.fixture
+def r():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+def add_scan(r, scan_id: str, lane: str = "interactive", score: float = 100.0, status: str = "queued", **fields):
+    # hub の enqueue_scan と同じ形でキューと索引に載せる
+    r.hset(f"scan:{scan_id}", mapping={
+        "status": status, "queue_lane": lane, "queue_score": score, "created_at": score, **fields,
+    })
+    r.zadd("scans:index", {scan_id: score})
+    r.zadd(f"scans:status:{status}", {scan_id: score})
+    if status == "queued":
+        r.zadd(jobqueue.key_lane(lane), {scan_id: score})
+        r.lpush(jobqueue.WAKEUP_KEY, scan_id)
+
+def start_processing(r, scan_id: str):
+    # tasks.set_status(scan_id, "processing") 相当
+    r.hset(f"scan:{scan_id}", "status", "processing")
+    r.zrem("scans:status:queued", scan_id)
+    r.zadd("scans:status:processing", {scan_id: r.zscore("scans:index", scan_id)})
+
+def test_reserve_counts_attempt_in_the_same_script(r):
+    add_scan(r, "s1")
+    jq = jobqueue.JobQueue(r, "slot-a")
+    assert jq.try_reserve() == ("s1", 1)
+    # processingリストへの移動と試行回数は同じスクリプトで済んでいる
+    assert r.lrange(jq.processing, 0, -1) == ["s1"]
+    assert r.hget("scan:s1", "attempts") == "1"
+    assert r.zcard(jobqueue.key_lane("interactive")) == 0
+
+def test_reserve_picks_smallest_score_in_lane(r):
+    add_scan(r, "late", score=200.0)
+    add_scan(r, "early", score=100.0)
+    jq = jobqueue.JobQueue(r, "slot-a")
+    assert jq.reserve(timeout=0.1)[0] == "early"
+    assert jq.reserve(timeout=0.1)[0] == "late"
+    assert jq.try_reserve() is None
+
+def test_reclaim_keeps_jobs_of_live_lease(r):
+    add_scan(r, "s1")
+    jq = jobqueue.JobQueue(r, "slot-a")
+    jq.renew_lease()
+    jq.try_reserve()
+    assert jobqueue.reap(r) == []
+    assert r.lrange(jq.processing, 0, -1) == ["s1"]
+
+def test_reclaim_requeues_and_marks_scan_queued(r):
+    add_scan(r, "s1", lane="bulk", score=123.0)
+    jq = jobqueue.JobQueue(r, "slot-a")
+    jq.renew_lease()
+    jq.try_reserve()
+    start_processing(r, "s1")
+    jq.release_lease()
+
+    pubsub = r.pubsub()
+    pubsub.subscribe("scans:events")
+    pubsub.get_message(timeout=1)  # subscribe の確認
+
+    assert jobqueue.reap(r) == []
+    assert r.lrange(jq.processing, 0, -1) == []
+    # 元のレーン・スコアへ戻る
+    assert r.zscore(jobqueue.key_lane("bulk"), "s1") == 123.0
+    assert "s1" in r.lrange(jobqueue.WAKEUP_KEY, 0, -1)
+    assert not r.sismember(jobqueue.PROCESSING_SLOTS_KEY, "slot-a")
+    # scanの状態と索引も queued へ
+    assert r.hget("scan:s1", "status") == "queued"
+    assert r.zscore("scans:status:queued", "s1") == 123.0
+    assert r.zscore("scans:status:processing", "s1") is None
+    message = pubsub.get_message(timeout=1)
+    assert message and json.loads(message["data"])["status"] == "queued"
+    assert json.loads(message["data"])["scan_id"] == "s1"
+
+def test_reclaim_leaves_finished_scan_status(r):
+    # done を書いた後、ack前に落ちたジョブ: キューには戻すが状態は戻さない
+    add_scan(r, "s1")
+    jq = jobqueue.JobQueue(r, "slot-a")
+    jq.try_reserve()
+    r.hset("scan:s1", "status", "done")
+    jq.recover()
+    assert r.hget("scan:s1", "status") == "done"
+    assert r.zscore(jobqueue.key_lane("interactive"), "s1") is not None
+
+def test_reclaim_dead_letters_after_max_attempts(r, monkeypatch):
+    monkeypatch.setattr(jobqueue, "JOB_MAX_ATTEMPTS", 2)
+    add_scan(r, "s1")
+    jq = jobqueue.JobQueue(r, "slot-a")
+    for attempt in (1, 2):
+        assert jq.try_reserve() == ("s1", attempt)
+        dead = jq.recover()
+    assert dead == ["s1"]
+    assert r.lrange(jobqueue.DEAD_KEY, 0, -1) == ["s1"]
+    assert r.zcard(jobqueue.key_lane("interactive")) == 0
+
+def test_fail_then_promote_when_due(r):
+    add_scan(r, "s1", lane="reprocess", score=50.0)
+    jq = jobqueue.JobQueue(r, "slot-a")
+    scan_id, attempts = jq.try_reserve()
+    jq.fail(scan_id, attempts)
+    assert r.lrange(jq.processing, 0, -1) == []
+    assert r.zscore(jobqueue.DELAYED_KEY, "s1") > time.time()
+
+    jobqueue.reap(r)
+    assert r.zcard(jobqueue.key_lane("reprocess")) == 0
+    r.zadd(jobqueue.DELAYED_KEY, {"s1": time.time() - 1})
+    jobqueue.reap(r)
+    assert r.zscore(jobqueue.key_lane("reprocess"), "s1") == 50.0
+    assert r.zcard(jobqueue.DELAYED_KEY) == 0
+
+def test_fail_dead_letters_last_attempt(r, monkeypatch):
+    monkeypatch.setattr(jobqueue, "JOB_MAX_ATTEMPTS", 1)
+    add_scan(r, "s1")
+    jq = jobqueue.JobQueue(r, "slot-a")
+    jq.fail(*jq.try_reserve())
+    assert r.lrange(jobqueue.DEAD_KEY, 0, -1) == ["s1"]
+    assert r.zcard(jobqueue.DELAYED_KEY) == 0
+
+def test_migrate_legacy_queue(r):
+    r.hset("scan:old", mapping={"status": "queued"})
+    r.lpush(jobqueue.LEGACY_QUEUE_KEY, "old")
+    assert jobqueue.migrate_legacy_queue(r) == 1
+    assert r.llen(jobqueue.LEGACY_QUEUE_KEY) == 0
+    # queue_lane の無いscanは interactive へ
+    assert r.zscore(jobqueue.key_lane("interactive"), "old") is not None
+
+def test_reserve_trims_stale_wakeups(r):
+    add_scan(r, "s1")
+    add_scan(r, "s2")
+    # 他のスロットが通知を待たずに取ったジョブの分などで溜まった古い通知
+    r.lpush(jobqueue.WAKEUP_KEY, *[f"stale-{i}" for i in range(100)])
+    jq = jobqueue.JobQueue(r, "slot-a")
+    jq.try_reserve()
+    assert r.llen(jobqueue.WAKEUP_KEY) == 1
+    jq.try_reserve()
+    assert r.llen(jobqueue.WAKEUP_KEY) == 0
+
+def test_idle_reserve_clears_wakeups_and_blocks(r):
+    r.lpush(jobqueue.WAKEUP_KEY, *[f"stale-{i}" for i in range(100)])
+    jq = jobqueue.JobQueue(r, "slot-a")
+    assert jq.try_reserve() is None
+    assert r.llen(jobqueue.WAKEUP_KEY) == 0
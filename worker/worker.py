@@ -1,19 +1,178 @@
 import os
+import signal
+import socket
+import threading
 import time
+import multiprocessing as mp
 import redis
-from tasks import process_scan
+import jobqueue
 
 REDIS_URL = os.environ["REDIS_URL"]
-r = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", 5))
+# 同時に処理するジョブ数。auto ならCPU数と1ジョブあたりのメモリ予算から決める
+WORKER_SLOTS = os.environ.get("WORKER_SLOTS", "auto")
+CPUS_PER_SLOT = int(os.environ.get("CPUS_PER_SLOT", 1))
+JOB_MEMORY_MB = int(os.environ.get("JOB_MEMORY_MB", 3072))
+# true なら各スロットを専用のCPUコアに固定する（Blenderも同じコアで動く）
+CPU_PINNING = os.environ.get("CPU_PINNING", "false").lower() in ("1", "true", "yes")
+# SIGTERM後、処理中のジョブを待つ最大秒数
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 900))
+# 落ちたスロットの処理中ジョブの回収と、再試行待ちジョブの投入を行う間隔
+REAPER_INTERVAL = float(os.environ.get("REAPER_INTERVAL", 10))
 
-print("worker started")
+def available_cpus() -> list[int]:
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+def available_memory_mb() -> float:
+    # コンテナのメモリ上限(cgroup v2/v1)があればそちらを優先する
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value) / (1024 * 1024)
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) / 1024
+    return float(JOB_MEMORY_MB)
+
+def slot_count() -> int:
+    if WORKER_SLOTS != "auto":
+        return max(int(WORKER_SLOTS), 1)
+    by_cpu = len(available_cpus()) // max(CPUS_PER_SLOT, 1)
+    by_memory = int(available_memory_mb() // max(JOB_MEMORY_MB, 1))
+    return max(min(by_cpu, by_memory), 1)
+
+def slot_cpus(slot: int) -> list[int]:
+    cpus = available_cpus()
+    n = max(CPUS_PER_SLOT, 1)
+    start = (slot * n) % len(cpus)
+    return [cpus[(start + i) % len(cpus)] for i in range(min(n, len(cpus)))]
+
+def run_slot(slot: int, slot_id: str, cpus: list[int] | None):
+    """1スロット = 1プロセス。自分専用のBlenderを持ち、キューから1件ずつ処理する"""
+    stopping = threading.Event()
+    # SIGTERMは「今のジョブを終えたら抜ける」。SIGINTはsupervisor側で扱う
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    if CPUS_PER_SLOT > 0:
+        os.environ.setdefault("BLENDER_THREADS", str(CPUS_PER_SLOT))
+
+    # tasks はBLENDER_THREADS等を読み込み時に参照するので、環境を整えてからimportする
+    from tasks import process_scan, shutdown_blender, fail_lost_scans
+
+    r = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    jq = jobqueue.JobQueue(r, slot_id)
+    # 同じslot_idの前のプロセスが処理途中で落ちていれば、そのジョブをキューへ戻す
+    fail_lost_scans(jq.recover())
+
+    def heartbeat_loop():
+        # hubは workers:heartbeat の新しさで稼働中スロット数を数え、待ち時間を推定する
+        # worker:lease:{slot_id} が切れると、処理中のジョブは他のworkerの reaper に回収される
+        while not stopping.is_set():
+            try:
+                now = time.time()
+                jq.renew_lease()
+                r.zadd("workers:heartbeat", {slot_id: now})
+                r.zremrangebyscore("workers:heartbeat", "-inf", now - 3600)
+            except redis.RedisError as e:
+                print("WARN: heartbeat failed", slot_id, e)
+            stopping.wait(HEARTBEAT_INTERVAL)
+
+    jq.renew_lease()
+    threading.Thread(target=heartbeat_loop, daemon=True).start()
+    print("slot started", slot_id, "cpus", cpus or "any")
 
-while True:
-    scan_id = r.brpop("queue:scans", timeout=2)
-    if not scan_id:
-        continue
-    _, scan_id = scan_id
     try:
-        process_scan(scan_id)
-    except Exception as e:
-        print("ERROR", scan_id, e)
+        while not stopping.is_set():
+            job = jq.reserve(timeout=2)
+            if not job:
+                continue
+            scan_id, attempts = job
+            try:
+                process_scan(scan_id, retry_delay=jq.retry_delay(attempts))
+            except Exception as e:
+                print("ERROR", scan_id, "attempt", attempts, e)
+                jq.fail(scan_id, attempts)
+            else:
+                jq.ack(scan_id)
+    finally:
+        shutdown_blender()
+        try:
+            jq.release_lease()
+            r.zrem("workers:heartbeat", slot_id)
+        except redis.RedisError:
+            pass
+        print("slot stopped", slot_id)
+
+def main():
+    from tasks import backfill_status_indexes, compile_templates, fail_lost_scans
+
+    backfill_status_indexes()
+    # スロットのBlenderが起動する前に、テンプレートのコンパイル結果を揃えておく
+    compile_templates()
+    r = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    migrated = jobqueue.migrate_legacy_queue(r)
+    if migrated:
+        print("moved legacy queue:scans jobs to lanes", migrated)
+
+    ctx = mp.get_context("spawn")
+    n = slot_count()
+    print("worker started", WORKER_ID, "slots", n)
+
+    def start_slot(slot: int):
+        cpus = slot_cpus(slot) if CPU_PINNING else None
+        p = ctx.Process(target=run_slot, args=(slot, f"{WORKER_ID}/{slot}", cpus), name=f"slot-{slot}")
+        p.start()
+        return p
+
+    procs = {slot: start_slot(slot) for slot in range(n)}
+
+    draining = threading.Event()
+    def drain(signum, _frame):
+        if draining.is_set():
+            return
+        print("draining: waiting for running jobs", signal.Signals(signum).name)
+        draining.set()
+        for p in procs.values():
+            if p.is_alive():
+                p.terminate()  # 子側ではSIGTERM = 今のジョブを終えたら停止
+    signal.signal(signal.SIGTERM, drain)
+    signal.signal(signal.SIGINT, drain)
+
+    next_reap = 0.0
+    while not draining.is_set():
+        for slot, p in list(procs.items()):
+            if not p.is_alive():
+                print("WARN: slot exited, restarting", slot, p.exitcode)
+                procs[slot] = start_slot(slot)
+        if time.time() >= next_reap:
+            next_reap = time.time() + REAPER_INTERVAL
+            try:
+                fail_lost_scans(jobqueue.reap(r))
+            except redis.RedisError as e:
+                print("WARN: reaper failed", e)
+        draining.wait(1)
+
+    deadline = time.time() + DRAIN_TIMEOUT
+    for p in procs.values():
+        p.join(max(deadline - time.time(), 0))
+    for p in procs.values():
+        if p.is_alive():
+            print("WARN: slot did not finish in time, killing", p.name)
+            p.kill()
+            p.join()
+    print("worker stopped", WORKER_ID)
+
+if __name__ == "__main__":
+    main()